@@ -19,13 +19,40 @@ Workflow locale UNICO per MILKY_DJ:
 
 Caratteristiche:
 - Separazione 4 stems con Demucs (modello htdemucs).
-- Analisi onset + features (BPM, onset_strength, contrast, spread) per ogni stem.
-- Cache dei risultati di analisi (.onset_cache/) per evitare ricalcoli.
+- Analisi onset + features (BPM, onset_strength, contrast, spread) per ogni stem,
+  con analysis_pipeline (la stessa del server OSC analize_onsets_simple.py).
+- Cache dei risultati di analisi (.onset_cache/ accanto agli script,
+  condivisa con il server OSC) per evitare ricalcoli:
+  indice SQLite (path, size, mtime, inode) -> hash contenuto, limite di
+  spazio con eviction LRU, entry in formato colonnare binario lette via
+  mmap (vedi analysis_cache.py). Cache per stadio (beats, onsets, features,
+  analysis) con chiave = hash dei parametri dello stadio + stadi a monte:
+  cambiare un parametro ricalcola solo lo stadio interessato e i successivi.
 - Opzioni CLI semplici (separazione + analisi è il comportamento di default).
 - Nessun output disperse: tutto dentro la cartella stems/<basename>/.
 - Se la cartella esiste e contiene già le stems, per default NON rigenera (usa --force).
 - Analisi-only su intera cartella stems o su singolo file stem.
+- Backend di analisi a thread o a processi (audio in shared memory, timeout
+  per file, isolamento crash, worker = core disponibili).
 - Tutti i JSON finiscono nella stessa cartella delle stems.
+- Modalità batch (cartella o playlist): pipeline a 2 stadi con code limitate,
+  separazione e analisi si sovrappongono; stampa throughput e utilizzo stadi.
+- Demucs in-process (torch/demucs importabili): modello residente, stems
+  passate all'analisi in memoria, WAV scritti in background; --service
+  avvia un servizio persistente che riceve job via OSC
+  (vedi separation_service.py).
+- Streaming per file lunghi (--stream, automatico oltre 20 min): lettura a
+  blocchi, memoria indipendente dalla durata (vedi streaming_analysis.py).
+- --analysis-sr SR: analisi a sample rate ridotto (es. 22050, ricampionamento
+  polifase; tempi e features restano nel tempo della sorgente).
+- --beat-grid drums|sum: una griglia dei beat per brano (stem drums o somma
+  delle stem) usata dal beat mapping di tutte le stem: posizioni coerenti
+  tra le stem e un solo beat tracking per brano.
+- --watch CARTELLE: daemon che sorveglia le cartelle musicali (inotify o
+  polling) e prepara stems/<brano>/ per ogni traccia nuova o modificata, a
+  priorità minima e cedendo il passo al server OSC (vedi hot_folder.py).
+- --trace FILE: tempi per stadio (separazione, decode, beat, onset, features,
+  scritture) come trace Chrome JSON, anche dai worker di processo (tracing.py).
 
 Uso rapido:
     # Workflow completo (separa + analizza)
@@ -43,28 +70,47 @@ Uso rapido:
     # Forza nuova separazione (ignora stems esistenti)
     python ambisonics_automation.py /path/to/song.mp3 --force
 
-    # Pulisci cache
+    # Batch libreria (separa N+1 mentre analizza N)
+    python ambisonics_automation.py --batch /path/to/music/
+    python ambisonics_automation.py --batch /path/to/playlist.m3u
+
+    # Pulisci cache / statistiche cache
     python ambisonics_automation.py --clear-cache
+    python ambisonics_automation.py --cache-stats
 
 Note:
-- Richiede Demucs installato nell'env (es. /opt/anaconda3/envs/dj_ambisonics/bin/demucs).
+- Richiede Demucs installato nell'env (es. /opt/anaconda3/envs/dj_ambisonics/bin/demucs);
+  se torch/demucs sono importabili dall'interprete corrente la separazione
+  avviene in-process (--separator cli per forzare il subprocess).
 - Richiede: librosa, numpy, scipy (per analisi).
 """
 
 import os
 import sys
 import argparse
+import atexit
 import subprocess
 import shutil
 import platform
 import logging
 import time
-import hashlib
 import json
+import queue
+import threading
 import warnings
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from functools import lru_cache
+
+_T_START = time.perf_counter()
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor, as_completed,
+                                wait, FIRST_COMPLETED)
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import multiprocessing
+
+from hot_folder import HotFolderDaemon, lower_priority
+from separation_service import (DEMUCS_OPTIONS, DemucsSeparator, SeparationService,
+                                inprocess_available, SERVICE_PORT)
+import tracing
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
 warnings.filterwarnings('ignore')
@@ -81,12 +127,13 @@ log = logging.getLogger("ambisonics")
 # ---------------------------------------
 # COSTANTI GENERALI
 # ---------------------------------------
-VALID_EXTENSIONS = {".wav", ".wave", ".aif", ".aiff", ".mp3", ".flac", ".ogg", ".m4a"}
 STEM_NAMES = ["vocals", "drums", "bass", "other"]
 
-CACHE_DIR = ".onset_cache"
 MAX_WORKERS = 4
-HOP_LENGTH = 512
+
+PLAYLIST_EXTENSIONS = {".m3u", ".m3u8", ".txt"}
+BATCH_QUEUE_SIZE = 2
+ANALYSIS_TIMEOUT = 600.0  # s per file (backend process)
 
 # ---------------------------------------
 # FUNZIONI UTILI PATH
@@ -185,12 +232,11 @@ def separate_4stems(input_file: str, force=False, device=None) -> dict:
     ]
 
     # Ottimizzazioni base (segment/overlap/varianti)
-    if device == "mps":
-        cmd += ["--segment", "7", "--overlap", "0.05", "--shifts", "1", "--jobs", "1"]
-    elif device == "cuda":
-        cmd += ["--segment", "7", "--overlap", "0.1", "--shifts", "1"]
-    else:
-        cmd += ["--segment", "6", "--overlap", "0.15", "--shifts", "1"]
+    opts = DEMUCS_OPTIONS.get(device, DEMUCS_OPTIONS["cpu"])
+    cmd += ["--segment", str(opts["segment"]), "--overlap", str(opts["overlap"]),
+            "--shifts", str(opts["shifts"])]
+    if "jobs" in opts:
+        cmd += ["--jobs", str(opts["jobs"])]
 
     cmd.append(str(src))
 
@@ -204,7 +250,8 @@ def separate_4stems(input_file: str, force=False, device=None) -> dict:
     env_vars["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
     
     # 3. Passa 'env=env_vars' al comando subprocess
-    result = subprocess.run(cmd, capture_output=True, text=True, env=env_vars)
+    with tracing.span("demucs", cat="separation", file=src.name, device=device):
+        result = subprocess.run(cmd, capture_output=True, text=True, env=env_vars)
     # -----------------------------
 
     if result.returncode != 0:
@@ -217,7 +264,8 @@ def separate_4stems(input_file: str, force=False, device=None) -> dict:
         sfile = demucs_out / f"{stem}.wav"
         if sfile.exists():
             dst = out_dir / f"{stem}.wav"
-            shutil.copy2(sfile, dst)
+            with tracing.span("copy_stem", cat="separation", file=dst.name):
+                shutil.copy2(sfile, dst)
             paths[stem] = str(dst)
             size_mb = dst.stat().st_size / (1024 * 1024)
             log.info(f"✓ {stem}.wav ({size_mb:.1f} MB)")
@@ -228,264 +276,64 @@ def separate_4stems(input_file: str, force=False, device=None) -> dict:
     log.info(f"Separazione completata in {time.time()-t0:.1f}s")
     return paths
 
-# ---------------------------------------
-# CACHE ANALISI
-# ---------------------------------------
-def file_hash(path: str) -> str:
-    h = hashlib.md5()
-    with open(path, "rb") as f:
-        while True:
-            chunk = f.read(8192)
-            if not chunk:
-                break
-            h.update(chunk)
-    return h.hexdigest()
-
-def cache_path(path: str) -> Path:
-    ensure_dir(Path(CACHE_DIR))
-    fn = Path(path).name
-    safe = "".join(c if c.isalnum() else "_" for c in fn)
-    return Path(CACHE_DIR) / f"{safe}_{file_hash(path)}.json"
-
-def load_cache(path: str):
-    cp = cache_path(path)
-    if cp.exists():
-        try:
-            return json.loads(cp.read_text())
-        except Exception:
-            return None
-    return None
+def make_separator(mode: str = "auto", device=None):
+    """
+    DemucsSeparator (modello residente) se mode è "inprocess", o "auto" e
+    torch/demucs sono importabili; None = CLI demucs in subprocess.
+    """
+    if mode == "cli" or (mode == "auto" and not inprocess_available()):
+        return None
+    if mode == "inprocess" and not inprocess_available():
+        raise RuntimeError("torch/demucs non importabili: usa --separator cli")
+    sep = DemucsSeparator(device or auto_device())
+    log.info(f"Separazione in-process ({sep.model_name} su {sep.device})")
+    return sep
 
-def save_cache(path: str, data: dict):
-    cp = cache_path(path)
-    try:
-        cp.write_text(json.dumps(data))
-    except Exception as e:
-        log.warning(f"Cache write error: {e}")
+def separate_inprocess(input_file: str, separator: DemucsSeparator, force=False):
+    """
+    Come separate_4stems ma con il modello residente: ritorna SeparatedTrack
+    (stems in memoria, WAV in scrittura in background) oppure None se le
+    stems esistono già e force=False.
+    """
+    src = safe_path(Path(input_file))
+    if not src.exists():
+        raise FileNotFoundError(f"File non trovato: {src}")
+    out_dir = stems_dir_for_input(str(src))
+    if all((out_dir / f"{stem}.wav").exists() for stem in STEM_NAMES) and not force:
+        log.info("Stems già presenti — salto separazione (usa --force per rigenerare).")
+        return None
+    track = separator.separate(str(src), out_dir)
+    log.info(f"Separazione in-process: decodifica {track.timings['load_s']:.1f}s, "
+             f"inferenza {track.timings['infer_s']:.1f}s")
+    return track
 
 # ---------------------------------------
 # ANALISI AUDIO
 # ---------------------------------------
 import numpy as np
-import librosa
-from scipy.signal import butter, sosfilt
-
-@lru_cache(maxsize=8)
-def band_filter(sr):
-    ny = sr / 2
-    low = min(50.0 / ny, 0.99)
-    high = min(8000.0 / ny, 0.99)
-    return butter(4, [low, high], btype="band", output="sos")
-
-@lru_cache(maxsize=8)
-def lowpass_filter(sr):
-    ny = sr / 2
-    cutoff = min(15.0 / ny, 0.99)
-    return butter(4, cutoff, btype="low", output="sos")
-
-def calc_bpm(path: str):
-    try:
-        y, sr = librosa.load(path, sr=None, mono=True)
-        if y.size == 0:
-            return 0.0, None, None, None
-        if np.abs(y).max() > 0:
-            y = librosa.util.normalize(y)
-        tempo, beat_frames = librosa.beat.beat_track(
-            y=y, sr=sr, hop_length=HOP_LENGTH, trim=False
-        )
-        bpm = float(tempo) if tempo and tempo > 0 else 0.0
-        return bpm, y, sr, beat_frames
-    except Exception:
-        return 0.0, None, None, None
-
-def envelope_features(y, sr, onset_samples):
-    if onset_samples.size == 0:
-        return []
-
-    sos_b = band_filter(sr)
-    sos_l = lowpass_filter(sr)
-    y_f = sosfilt(sos_b, y)
-    env = sosfilt(sos_l, np.abs(y_f))
-    vmax = env.max()
-    if vmax > 0:
-        env /= vmax
-
-    n_fft = 2048
-    hop = 512
-    S = np.abs(librosa.stft(y_f, n_fft=n_fft, hop_length=hop))
-    freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
-    max_win = int(0.5 * sr)
-
-    feats = []
-    for i, onset in enumerate(onset_samples):
-        # finestra fino a prossimo onset o max_win
-        if i < len(onset_samples) - 1:
-            end = min(onset + max_win, onset_samples[i+1])
-        else:
-            end = min(onset + max_win, len(env))
-        if end <= onset:
-            feats.append(dict(attack_time=0.0,
-                              release_time=0.0,
-                              velocity_value=0.0,
-                              spectral_mean_freq=0.0))
-            continue
-
-        w = env[onset:end]
-        peak = w.argmax()
-        attack = peak / sr
-        peak_val = w[peak]
-        thr = peak_val * 0.5
-        decay = w[peak:]
-        below = np.where(decay < thr)[0]
-        release = (below[0]/sr) if below.size else (decay.size/sr)
-
-        onset_f = onset // hop
-        end_f = end // hop
-        onset_f = min(onset_f, S.shape[1]-1)
-        end_f = min(max(end_f, onset_f+1), S.shape[1])
-        spec_slice = S[:, onset_f:end_f]
-        if spec_slice.size == 0:
-            centroid = 0.0
-        else:
-            slic_sum = spec_slice.sum(axis=0)
-            mask = slic_sum > 0
-            if mask.any():
-                weighted = (freqs[:, None] * spec_slice[:, mask]).sum(axis=0)
-                centroid = (weighted / slic_sum[mask]).mean()
-            else:
-                centroid = 0.0
-
-        a_norm = np.clip(attack / 0.1, 0, 1)
-        r_norm = np.clip(release / 0.5, 0, 1)
-        velocity = 1.0 - (0.3 * a_norm + 0.7 * r_norm)
 
-        feats.append(dict(
-            attack_time=attack,
-            release_time=release,
-            velocity_value=velocity,
-            spectral_mean_freq=centroid
-        ))
-    return feats
-
-def analyze_file(path: str):
-    """
-    Analizza un singolo file (usa cache se disponibile).
-    Ritorna: (is_valid, bpm, grouped_data(list))
-    grouped_data elementi con onset_time, velocity_value ecc.
+from analysis_engine import enable_numba_cache
+from analysis_pipeline import (VALID_EXTENSIONS, load_audio, analyze_file, analyze_audio,
+                               prepare_json_analysis, json_default, cached_beats, warm_up,
+                               configure_analysis_sr, ANALYSIS_SR_CHOICES, song_grid,
+                               song_stems, BEAT_GRID_MODES)
+import analysis_pipeline
+from waveform_peaks import save_peaks
+from control_curves import save_curves
+import compute_backends
+from streaming_analysis import should_stream
+from analysis_cache import (clear_cache, cache_stats, configure_cache, sweep_orphans, evict,
+                            CACHE_MAX_BYTES)
+
+def save_analysis_json(stem_path: str, bpm: float, data: dict, target_dir: Path,
+                       y=None, sr=None, grid=None) -> Path:
     """
-    ext = Path(path).suffix.lower()
-    if ext not in VALID_EXTENSIONS or not Path(path).is_file():
-        return False, 0.0, []
-
-    cached = load_cache(path)
-    if cached:
-        return cached['is_valid'], cached['bpm'], cached['grouped_data']
-
-    bpm, y, sr, beat_frames = calc_bpm(path)
-    if y is None:
-        data = dict(is_valid=False, bpm=bpm, grouped_data=[])
-        save_cache(path, data)
-        return False, bpm, []
-
-    onset_samples = librosa.onset.onset_detect(
-        y=y, sr=sr, hop_length=HOP_LENGTH, units="samples", backtrack=True
-    )
-    onset_times = onset_samples / sr
-    feats = envelope_features(y, sr, onset_samples)
-
-    # Beat mapping semplificato
-    if beat_frames is not None and beat_frames.size > 0:
-        beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=HOP_LENGTH)
-        period = np.median(np.diff(beat_times)) if beat_times.size > 1 else 1.0
-        start = beat_times[0]
-        positions = (onset_times - start) / period
-        beat_indices = np.round(positions).astype(int)
-        beat_fracs = positions - beat_indices
-    else:
-        positions = onset_times.copy()
-        beat_indices = np.zeros_like(positions, dtype=int)
-        beat_fracs = np.zeros_like(positions)
-
-    grouped = []
-    for i, t in enumerate(onset_times):
-        f = feats[i]
-        grouped.append(dict(
-            onset_time=float(t),
-            beat_index=int(beat_indices[i]),
-            beat_position=float(positions[i]),
-            beat_fraction=float(beat_fracs[i]),
-            attack_time=float(f['attack_time']),
-            release_time=float(f['release_time']),
-            velocity_value=float(f['velocity_value']),
-            spectral_mean_freq=float(f['spectral_mean_freq'])
-        ))
-
-    data = dict(is_valid=True, bpm=bpm, grouped_data=grouped)
-    save_cache(path, data)
-    return True, bpm, grouped
-
-def prepare_json_analysis(filename: str, bpm: float, grouped: list):
+    Scrive <stem>_analysis.json, il sidecar <stem>_peaks.mkp (waveform per
+    la GUI, vedi waveform_peaks; y/sr: mono già in memoria, se c'è) e le
+    curve di automazione curves/<stem>.wav per SC (vedi control_curves).
+    grid: griglia del brano usata dall'analisi (song_grid), per l'header
+    del sidecar.
     """
-    Converte la lista grouped in struttura sintetica per JSON:
-      onset_times, beat_positions, onset_strength (velocity^gamma), contrast, spread
-    """
-    if not grouped:
-        return {
-            'filename': filename,
-            'num_onsets': 0,
-            'onset_times': [],
-            'beat_positions': [],
-            'onset_strength': [],
-            'onset_contrast': [],
-            'onset_spread': []
-        }
-
-    onset_times = np.array([g['onset_time'] for g in grouped], dtype=np.float32)
-    beat_positions = np.array([g['beat_position'] for g in grouped], dtype=np.float32)
-    velocity = np.array([g['velocity_value'] for g in grouped], dtype=np.float32)
-    spectral = np.array([g['spectral_mean_freq'] for g in grouped], dtype=np.float32)
-    release = np.array([g['release_time'] for g in grouped], dtype=np.float32)
-
-    # Smooth retroattivo
-    win = 10
-    v_smooth = np.zeros_like(velocity)
-    for i in range(len(velocity)):
-        s = max(0, i - win + 1)
-        v_smooth[i] = velocity[s:i+1].mean()
-
-    v_exp = np.power(v_smooth, 10.0)
-
-    if onset_times.size > 1:
-        gaps = np.diff(onset_times)
-        beat_gaps = np.abs(np.diff(beat_positions))
-        mask = (gaps > 2.0) | (beat_gaps > 8.0)
-        v_exp[:-1][mask] = np.minimum(v_exp[:-1][mask] + 0.2, 1.0)
-
-    # Contrast normalizzato
-    if spectral.size > 0:
-        mn, mx = spectral.min(), spectral.max()
-        contrast = (spectral - mn) / (mx - mn) if mx > mn else np.full_like(spectral, 0.5)
-    else:
-        contrast = np.array([])
-
-    # Spread (release time)
-    if release.size > 0:
-        rmn, rmx = release.min(), release.max()
-        spread = (release - rmn) / (rmx - rmn) if rmx > rmn else np.full_like(release, 0.5)
-    else:
-        spread = np.array([])
-
-    return {
-        'filename': filename,
-        'num_onsets': int(onset_times.size),
-        'onset_times': onset_times.tolist(),
-        'beat_positions': beat_positions.tolist(),
-        'onset_strength': v_exp.tolist(),
-        'onset_contrast': contrast.tolist(),
-        'onset_spread': spread.tolist()
-    }
-
-def save_analysis_json(stem_path: str, bpm: float, data: dict, target_dir: Path) -> Path:
     ensure_dir(target_dir)
     base = Path(stem_path).stem
     out = target_dir / f"{base}_analysis.json"
@@ -494,17 +342,75 @@ def save_analysis_json(stem_path: str, bpm: float, data: dict, target_dir: Path)
         'bpm': float(bpm),
         'analysis': data
     }
-    out.write_text(json.dumps(payload, indent=2))
+    with tracing.span("save_json", file=out.name):
+        out.write_text(json.dumps(payload, indent=2, default=json_default))
     log.info(f"JSON salvato: {out}")
+    try:
+        with tracing.span("save_peaks", file=Path(stem_path).name):
+            beats = cached_beats(stem_path, grid) or (bpm, None)
+            save_peaks(stem_path, target_dir, y=y, sr=sr, bpm=beats[0], beats=beats[1])
+    except Exception as e:
+        log.warning(f"Peaks non salvati per {Path(stem_path).name}: {e}")
+    try:
+        duration = len(y) / sr if y is not None and sr else None
+        with tracing.span("save_curves", file=Path(stem_path).name):
+            save_curves(stem_path, data, target_dir, duration=duration)
+    except Exception as e:
+        log.warning(f"Curve non salvate per {Path(stem_path).name}: {e}")
     return out
 
+def save_mix_peaks(input_file: str, stems_dir: Path, force: bool = False,
+                   beat_grid: str = "stem"):
+    """
+    Sidecar mix_peaks.mkp della traccia originale nella cartella stems:
+    la GUI lo usa al caricamento del deck. Griglia beat dalla stem drums
+    (stessa timeline del mix), se già analizzata; con beat_grid
+    "drums"/"sum" la griglia del brano (song_grid, dalla cache).
+    """
+    grid = None
+    if beat_grid != "stem":
+        wavs = [stems_dir / f"{s}.wav" for s in STEM_NAMES]
+        song = song_grid([w for w in wavs if w.is_file()], beat_grid, compute=False)
+        if song is not None:
+            grid = cached_beats(str(wavs[0]), song)
+    for s in ["drums"] + [s for s in STEM_NAMES if s != "drums"]:
+        wav = stems_dir / f"{s}.wav"
+        if grid is None and wav.is_file():
+            grid = cached_beats(str(wav))
+            if grid is not None:
+                break
+    bpm, beats = grid or (0.0, None)
+    try:
+        fp = save_peaks(input_file, stems_dir, name="mix", bpm=bpm, beats=beats, force=force)
+        log.info(f"Peaks mix salvati: {fp}")
+    except Exception as e:
+        log.warning(f"Peaks mix non salvati per {Path(input_file).name}: {e}")
+
 # ---------------------------------------
 # ANALISI CARTELLA / FILE
 # ---------------------------------------
-def analyze_folder(folder: str) -> list:
+def default_workers() -> int:
+    """Core disponibili per questo processo (rispetta affinity/cgroup su Linux)."""
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    return max(1, n)
+
+def analyze_folder(folder: str, backend: str = "thread", workers: int | None = None,
+                   timeout: float | None = ANALYSIS_TIMEOUT, stream: bool = False,
+                   beat_grid: str = "stem") -> list:
     """
     Analizza tutti i file audio in una cartella (solo stems generati).
     Salva ogni JSON nella cartella stessa.
+    backend="thread": ThreadPoolExecutor (MAX_WORKERS).
+    backend="process": pool di processi con audio in shared memory,
+    timeout per file e isolamento dei crash (vedi analyze_files_process).
+    stream=True: analisi a blocchi per tutti i file (automatica per i file
+    più lunghi di STREAM_MIN_S).
+    beat_grid="drums"/"sum": una griglia dei beat per il brano (song_grid),
+    usata dalle sue stem (vocals, drums, bass, other) al posto di quella
+    propria; gli altri file della cartella restano indipendenti.
     """
     dirp = safe_path(Path(folder))
     if not dirp.is_dir():
@@ -517,49 +423,506 @@ def analyze_folder(folder: str) -> list:
         log.warning("Nessun file audio da analizzare.")
         return []
 
+    grids = {}
+    if beat_grid != "stem":
+        grid = song_grid(audio_files, beat_grid)
+        if grid is not None:
+            grids = {p: grid for p in song_stems(audio_files).values()}
+            log.info(f"Griglia del brano ({beat_grid}): BPM={grid['bpm']:.1f}")
+        else:
+            log.warning(f"Griglia del brano ({beat_grid}) non disponibile: una griglia per stem")
+
     results = []
     valid_bpms = []
 
-    log.info(f"Analisi parallela: {len(audio_files)} file")
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-        fut_map = {ex.submit(analyze_file, str(f)): f for f in audio_files}
-        for fut in as_completed(fut_map):
-            f = fut_map[fut]
+    def finish(f: Path, is_valid, bpm, grouped):
+        if is_valid and bpm > 0:
+            valid_bpms.append(bpm)
+        with tracing.span("prepare_json", file=f.name):
+            data = prepare_json_analysis(f.name, bpm, grouped)
+        save_analysis_json(str(f), bpm, data, dirp, grid=grids.get(str(f)))
+        log.info(f"[Analizzato] {f.name} BPM={bpm:.1f}")
+        results.append(f)
+
+    if backend == "process":
+        n = min(workers or default_workers(), len(audio_files))
+        log.info(f"Analisi multiprocesso: {len(audio_files)} file, {n} worker")
+        for f, res in analyze_files_process(audio_files, n, timeout, stream, grids):
+            if isinstance(res, Exception):
+                log.error(f"Errore analisi {f.name}: {res}")
+                continue
             try:
-                is_valid, bpm, grouped = fut.result()
-                if is_valid and bpm > 0:
-                    valid_bpms.append(bpm)
-                data = prepare_json_analysis(f.name, bpm, grouped)
-                save_analysis_json(str(f), bpm, data, dirp)
-                log.info(f"[Analizzato] {f.name} BPM={bpm:.1f}")
-                results.append(f)
+                finish(f, *res)
             except Exception as e:
                 log.error(f"Errore analisi {f.name}: {e}")
+    else:
+        log.info(f"Analisi parallela: {len(audio_files)} file")
+        with ThreadPoolExecutor(max_workers=workers or MAX_WORKERS) as ex:
+            fut_map = {ex.submit(analyze_file, str(f), stream, grid=grids.get(str(f))): f
+                       for f in audio_files}
+            for fut in as_completed(fut_map):
+                f = fut_map[fut]
+                try:
+                    finish(f, *fut.result())
+                except Exception as e:
+                    log.error(f"Errore analisi {f.name}: {e}")
 
     if valid_bpms:
         gbpm = float(np.median(valid_bpms))
         log.info(f"BPM globale (mediana): {gbpm:.1f}")
     return [str(f) for f in results]
 
-def analyze_file_to_json(path: str) -> Path | None:
+# ---------------------------------------
+# BACKEND MULTIPROCESSO (SHARED MEMORY)
+# ---------------------------------------
+def _process_worker_init(compute=None, trace=False, analysis_sr=None):
+    # Un thread BLAS per worker: il parallelismo è già dato dai processi
+    for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(var, "1")
+    warnings.filterwarnings('ignore')
+    # Stessi backend e sample rate di analisi del padre (già risolti: niente benchmark per worker)
+    if compute:
+        compute_backends.configure(compute)
+    configure_analysis_sr(analysis_sr)
+    if trace:
+        tracing.start_recording()
+
+def _analyze_shm_worker(path: str, shm_name: str, n_samples: int, sr: int, grid=None):
+    """
+    Eseguito nel worker: vista zero-copy sull'audio del padre + analisi.
+    Il worker condivide il resource_tracker del padre (spawn), quindi
+    l'unlink resta a carico del padre.
+    Ritorna (risultato, span registrati dal worker per il trace del padre).
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    y = np.ndarray((n_samples,), dtype=np.float32, buffer=shm.buf)
+    try:
+        with tracing.span("analyze_file", file=Path(path).name):
+            res = analyze_audio(path, y, sr, grid=grid)
+        return res, tracing.drain()
+    finally:
+        del y
+        shm.close()
+
+def _analyze_stream_worker(path: str, grid=None):
+    """Eseguito nel worker: analisi in streaming dal path (file lunghi)."""
+    with tracing.span("analyze_file", file=Path(path).name):
+        res = analyze_audio(path, None, None, True, True, grid=grid)
+    return res, tracing.drain()
+
+def _release_shm(shm):
+    if shm is None:
+        return
+    try:
+        shm.close()
+        shm.unlink()
+    except (FileNotFoundError, BufferError):
+        pass
+
+def _terminate_pool(ex: ProcessPoolExecutor):
+    ex.shutdown(wait=False, cancel_futures=True)
+    terminate = getattr(ex, "terminate_workers", None)  # Python >= 3.14
+    if terminate:
+        terminate()
+        return
+    for p in list((getattr(ex, "_processes", None) or {}).values()):
+        if p.is_alive():
+            p.terminate()
+
+def analyze_files_process(audio_files: list, workers: int, timeout: float | None,
+                          stream: bool = False, grids: dict | None = None):
+    """
+    Generatore (file, risultato|Exception) sui file dati, analizzati in un
+    ProcessPoolExecutor. Il padre decodifica ogni file una volta, copia i
+    campioni in un blocco multiprocessing.shared_memory e passa al worker
+    solo il nome del blocco (niente pickling degli array).
+    - Cache hit: risolti nel padre, nessun worker coinvolto.
+    - Timeout per file: il pool viene terminato e ricreato, il file va in errore,
+      gli altri file in volo vengono rimessi in coda.
+    - Crash di un worker (segfault/OOM): i file in volo vengono ripetuti
+      uno alla volta, così solo quello che crasha di nuovo va in errore.
+    - File lunghi (o stream=True): il worker riceve solo il path e analizza
+      in streaming, il padre non decodifica.
+    - grids: {path: griglia del brano} (song_grid), passata al worker.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    grids = grids or {}
+    pending = []
+    for f in audio_files:
+        # Risolti nel padre se tutti gli stadi che richiedono l'audio sono in cache
+        res = analyze_audio(str(f), decode=False, grid=grids.get(str(f)))
+        if res is not None:
+            yield f, res
+        else:
+            pending.append(f)
+
+    suspects = []          # file in volo durante un crash del pool
+    isolate = False        # True: un file alla volta (rilancio sospetti)
+
+    while pending or suspects:
+        if not pending:
+            pending, suspects, isolate = suspects, [], True
+        limit = 1 if isolate else workers
+        ex = ProcessPoolExecutor(max_workers=limit, mp_context=ctx,
+                                 initializer=_process_worker_init,
+                                 initargs=(compute_backends.active_spec(), tracing.recording(),
+                                           analysis_pipeline.ANALYSIS_SR))
+        inflight = {}      # future -> (file, shm, deadline)
+        restart = False
+        try:
+            while (pending or inflight) and not restart:
+                pool_broken = False
+                while pending and len(inflight) < limit:
+                    f = pending.pop(0)
+                    y, shm = None, None
+                    try:
+                        if should_stream(str(f), stream):
+                            # File lungo: il worker legge a blocchi, niente audio nel padre
+                            fut = ex.submit(_analyze_stream_worker, str(f), grids.get(str(f)))
+                        else:
+                            with tracing.span("decode", file=f.name):
+                                y, sr = load_audio(str(f))
+                            if y is None or y.size == 0:
+                                yield f, analyze_audio(str(f), y, sr, grid=grids.get(str(f)))
+                                continue
+                            with tracing.span("shm_copy", file=f.name):
+                                shm = shared_memory.SharedMemory(create=True, size=y.nbytes)
+                                np.ndarray(y.shape, dtype=np.float32, buffer=shm.buf)[:] = y
+                            fut = ex.submit(_analyze_shm_worker, str(f), shm.name, y.size, sr,
+                                            grids.get(str(f)))
+                    except BrokenProcessPool:
+                        # Un worker è morto dopo l'ultimo wait(): il file non è colpevole
+                        _release_shm(shm)
+                        pending.insert(0, f)
+                        pool_broken = True
+                        break
+                    del y
+                    deadline = time.monotonic() + timeout if timeout else None
+                    inflight[fut] = (f, shm, deadline)
+                if not inflight:
+                    restart = pool_broken
+                    continue
+
+                deadlines = [d for _, _, d in inflight.values() if d is not None]
+                wait_s = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+                done, _ = wait(inflight, timeout=wait_s, return_when=FIRST_COMPLETED)
+
+                crashed = False
+                for fut in done:
+                    f, shm, _ = inflight.pop(fut)
+                    _release_shm(shm)
+                    try:
+                        res, trace = fut.result()
+                        tracing.merge(trace)
+                    except BrokenProcessPool:
+                        crashed = True
+                        suspects.append(f)
+                        continue
+                    except Exception as e:
+                        res = e
+                    yield f, res
+
+                now = time.monotonic()
+                expired = [fut for fut, (_, _, d) in inflight.items() if d is not None and d <= now]
+                for fut in expired:
+                    f, shm, _ = inflight.pop(fut)
+                    _release_shm(shm)
+                    log.error(f"Timeout analisi {f.name} (>{timeout:.0f}s)")
+                    yield f, TimeoutError(f"timeout analisi dopo {timeout:.0f}s")
+
+                if crashed or expired:
+                    # Il pool va terminato: chi era ancora in volo viene ripetuto
+                    for f, shm, _ in inflight.values():
+                        _release_shm(shm)
+                        (suspects if crashed else pending).insert(0, f)
+                    inflight.clear()
+                    restart = True
+        finally:
+            for f, shm, _ in inflight.values():
+                _release_shm(shm)
+            _terminate_pool(ex)
+
+        if isolate and suspects:
+            # Crash anche da solo: errore definitivo
+            f = suspects.pop(0)
+            log.error(f"Worker crashato analizzando {f.name}")
+            yield f, RuntimeError("worker di analisi terminato in modo anomalo")
+
+def analyze_file_to_json(path: str, stream: bool = False) -> Path | None:
     fp = safe_path(Path(path))
     if not fp.is_file():
         log.error(f"File non valido: {fp}")
         return None
-    is_valid, bpm, grouped = analyze_file(str(fp))
+    is_valid, bpm, grouped = analyze_file(str(fp), stream)
     data = prepare_json_analysis(fp.name, bpm, grouped)
     return save_analysis_json(str(fp), bpm, data, fp.parent)
 
+def analyze_separated(track, beat_grid: str = "stem") -> list:
+    """
+    Analizza le stems di una SeparatedTrack direttamente dalla memoria
+    (niente rilettura dei WAV). Ogni stem aspetta solo la scrittura del
+    proprio WAV, che serve per la chiave di cache e per il JSON.
+    beat_grid="drums"/"sum": griglia del brano (song_grid) calcolata prima,
+    dalla memoria; aspetta il WAV di drums o, per "sum", tutti i WAV.
+    """
+    results = []
+    valid_bpms = []
+    grid = None
+    if beat_grid != "stem":
+        needed = [n for n in track.names if beat_grid == "sum" or n == "drums"]
+        audio = {str(track.wait_written(n)): (track.mono(n), track.sr) for n in needed}
+        grid = song_grid([track.out_dir / f"{n}.wav" for n in track.names], beat_grid, audio)
+        if grid is not None:
+            log.info(f"Griglia del brano ({beat_grid}): BPM={grid['bpm']:.1f}")
+
+    def one(name):
+        f = track.wait_written(name)
+        y = track.mono(name)
+        is_valid, bpm, grouped = analyze_audio(str(f), y, track.sr, grid=grid)
+        data = prepare_json_analysis(f.name, bpm, grouped)
+        save_analysis_json(str(f), bpm, data, track.out_dir, y, track.sr, grid)
+        return f, is_valid, bpm
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        fut_map = {ex.submit(one, name): name for name in track.names}
+        for fut in as_completed(fut_map):
+            try:
+                f, is_valid, bpm = fut.result()
+            except Exception as e:
+                log.error(f"Errore analisi {fut_map[fut]}: {e}")
+                continue
+            if is_valid and bpm > 0:
+                valid_bpms.append(bpm)
+            log.info(f"[Analizzato] {f.name} BPM={bpm:.1f}")
+            results.append(str(f))
+
+    if valid_bpms:
+        log.info(f"BPM globale (mediana): {float(np.median(valid_bpms)):.1f}")
+    return results
+
+def separate_and_analyze(input_file: str, separator=None, force=False, device=None,
+                         analyze_opts: dict | None = None, analyze=True,
+                         checkpoint=None) -> Path:
+    """
+    Separazione + analisi di una traccia. Con separator (in-process) le stems
+    passano all'analisi in memoria; altrimenti CLI demucs + analisi da disco.
+    checkpoint(): chiamata tra separazione e analisi (--watch: attende che il
+    server OSC non abbia richieste in primo piano).
+    Ritorna la cartella stems.
+    """
+    track = None
+    if separator is not None:
+        track = separate_inprocess(input_file, separator, force=force)
+    else:
+        separate_4stems(input_file, force=force, device=device)
+    stems_dir = stems_dir_for_input(input_file)
+    if not analyze:
+        if track is not None:
+            track.wait_all()
+        return stems_dir
+    if checkpoint is not None:
+        checkpoint()
+    analyze_opts = analyze_opts or {}
+    if track is not None:
+        analyze_separated(track, analyze_opts.get("beat_grid", "stem"))
+    else:
+        analyze_folder(str(stems_dir), **analyze_opts)
+    save_mix_peaks(input_file, stems_dir, force=force,
+                   beat_grid=analyze_opts.get("beat_grid", "stem"))
+    return stems_dir
+
+def track_status(input_file: str, analyze: bool = True) -> str:
+    """
+    "ready": stems presenti e più recenti della sorgente (con analyze anche
+    ogni JSON più recente della sua stem); "missing": qualcosa da generare
+    o da rianalizzare (JSON mancanti o rimasti da una separazione
+    precedente); "stale": sorgente modificata dopo la separazione (da
+    rigenerare con force).
+    """
+    out_dir = stems_dir_for_input(input_file)
+    wavs = {s: out_dir / f"{s}.wav" for s in STEM_NAMES}
+    if not all(w.is_file() for w in wavs.values()):
+        return "missing"
+    wav_mtime = {s: w.stat().st_mtime_ns for s, w in wavs.items()}
+    if Path(input_file).stat().st_mtime_ns > min(wav_mtime.values()):
+        return "stale"
+    if analyze:
+        for s in STEM_NAMES:
+            js = out_dir / f"{s}_analysis.json"
+            if not js.is_file() or js.stat().st_mtime_ns < wav_mtime[s]:
+                return "missing"
+    return "ready"
+
+# ---------------------------------------
+# BATCH (PIPELINE SEPARAZIONE -> ANALISI)
+# ---------------------------------------
+def collect_batch_inputs(source: str) -> list:
+    """
+    Ritorna la lista di file audio da una cartella (non ricorsiva, salta stems/)
+    o da una playlist (.m3u/.m3u8/.txt, un path per riga, relativi alla playlist).
+    """
+    src = safe_path(Path(source))
+    if src.is_dir():
+        return [str(f) for f in sorted(src.iterdir())
+                if f.is_file() and f.suffix.lower() in VALID_EXTENSIONS]
+    if src.is_file() and src.suffix.lower() in PLAYLIST_EXTENSIONS:
+        tracks = []
+        for line in src.read_text(errors="ignore").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            p = Path(line).expanduser()
+            if not p.is_absolute():
+                p = src.parent / p
+            if p.suffix.lower() in VALID_EXTENSIONS and p.is_file():
+                tracks.append(str(safe_path(p)))
+            else:
+                log.warning(f"Playlist: voce ignorata {line}")
+        return tracks
+    if src.is_file() and src.suffix.lower() in VALID_EXTENSIONS:
+        return [str(src)]
+    log.error(f"Sorgente batch non valida: {src}")
+    return []
+
+class _StageClock:
+    """Accumula il tempo 'busy' di uno stadio della pipeline."""
+    def __init__(self, name: str):
+        self.name = name
+        self.busy = 0.0
+        self.done = 0
+        self.failed = 0
+
+    def utilization(self, wall: float) -> float:
+        return self.busy / wall if wall > 0 else 0.0
+
+def batch_process(inputs: list, force=False, device=None, queue_size=BATCH_QUEUE_SIZE,
+                  analyze_opts: dict | None = None, separator=None) -> dict:
+    """
+    Pipeline a 2 stadi: un thread separa (Demucs) e mette la cartella stems
+    in una coda limitata; un secondo thread la analizza. Così la canzone N+1
+    viene separata mentre la N è in analisi. La coda limitata evita di
+    accumulare stems non analizzate se la separazione è più veloce.
+    analyze_opts: kwargs passati ad analyze_folder (backend, workers, timeout,
+    stream, beat_grid).
+    separator: DemucsSeparator residente; le stems passano all'analisi in
+    memoria (la coda limitata vale anche come limite di memoria).
+    Ritorna un dict con statistiche (tracce, throughput, utilizzo stadi).
+    """
+    analyze_opts = analyze_opts or {}
+    sep_clock = _StageClock("separazione")
+    ana_clock = _StageClock("analisi")
+    handoff = queue.Queue(maxsize=max(1, queue_size))
+    done_marker = object()
+
+    def separation_stage():
+        try:
+            for i, track in enumerate(inputs, 1):
+                name = Path(track).name
+                log.info(f"[Batch {i}/{len(inputs)}] Separazione: {name}")
+                t0 = time.perf_counter()
+                sep = None
+                try:
+                    if separator is not None:
+                        sep = separate_inprocess(track, separator, force=force)
+                    else:
+                        separate_4stems(track, force=force, device=device)
+                    sep_clock.done += 1
+                    ok = True
+                except Exception as e:
+                    sep_clock.failed += 1
+                    ok = False
+                    log.error(f"[Batch] Separazione fallita {name}: {e}")
+                finally:
+                    sep_clock.busy += time.perf_counter() - t0
+                if ok:
+                    # put() blocca se l'analisi è indietro (backpressure)
+                    handoff.put((track, sep))
+        finally:
+            handoff.put(done_marker)
+
+    def analysis_stage():
+        while True:
+            item = handoff.get()
+            if item is done_marker:
+                break
+            track, sep = item
+            name = Path(track).name
+            t0 = time.perf_counter()
+            try:
+                if sep is not None:
+                    analyze_separated(sep, analyze_opts.get("beat_grid", "stem"))
+                else:
+                    analyze_folder(str(stems_dir_for_input(track)), **analyze_opts)
+                save_mix_peaks(track, stems_dir_for_input(track), force=force,
+                               beat_grid=analyze_opts.get("beat_grid", "stem"))
+                ana_clock.done += 1
+                log.info(f"[Batch] Analisi completata: {name}")
+            except Exception as e:
+                ana_clock.failed += 1
+                log.error(f"[Batch] Analisi fallita {name}: {e}")
+            finally:
+                ana_clock.busy += time.perf_counter() - t0
+
+    log.info(f"Batch: {len(inputs)} tracce, coda={max(1, queue_size)}")
+    wall0 = time.perf_counter()
+    threads = [
+        threading.Thread(target=separation_stage, name="batch-sep", daemon=True),
+        threading.Thread(target=analysis_stage, name="batch-ana", daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - wall0
+
+    tracks_per_hour = ana_clock.done / wall * 3600.0 if wall > 0 else 0.0
+    stats = dict(
+        tracks=len(inputs),
+        completed=ana_clock.done,
+        failed=sep_clock.failed + ana_clock.failed,
+        wall_s=wall,
+        tracks_per_hour=tracks_per_hour,
+        utilization={c.name: c.utilization(wall) for c in (sep_clock, ana_clock)},
+    )
+
+    log.info("="*70)
+    log.info(f"BATCH COMPLETATO: {ana_clock.done}/{len(inputs)} tracce in {wall:.1f}s "
+             f"({stats['failed']} errori)")
+    log.info(f"Throughput: {tracks_per_hour:.1f} tracce/ora")
+    for c in (sep_clock, ana_clock):
+        log.info(f"Utilizzo {c.name}: {100*c.utilization(wall):.0f}% "
+                 f"(busy {c.busy:.1f}s, ok={c.done}, errori={c.failed})")
+    log.info("="*70)
+    return stats
+
 # ---------------------------------------
 # CACHE UTILS
 # ---------------------------------------
-def clear_cache():
-    p = Path(CACHE_DIR)
-    if p.exists():
-        shutil.rmtree(p)
-        log.info("Cache pulita")
-    else:
-        log.info("Cache già vuota")
+def print_cache_stats():
+    st = cache_stats()
+    mb = lambda b: b / (1024 * 1024)
+    log.info("="*70)
+    log.info(f"CACHE: {st['cache_dir']}")
+    log.info(f"  Entry: {st['entries']} ({mb(st['entry_bytes']):.1f} MB indicizzati, "
+             f"{st['legacy_entries']} legacy da migrare)")
+    log.info(f"  Disco: {mb(st['disk_bytes']):.1f} MB / limite {mb(st['max_bytes']):.0f} MB")
+    log.info(f"  Hit rate: {100 * st['hit_rate']:.1f}% ({st['hits']} hit, {st['misses']} miss)")
+    log.info(f"  Eviction LRU: {st['evictions']} | sorgenti indicizzate: {st['indexed_sources']} "
+             f"| hash: {st['hash']}")
+    log.info("="*70)
+    return st
+
+# ---------------------------------------
+# TRACE
+# ---------------------------------------
+def write_trace(path: str):
+    """Trace Chrome degli span registrati (--trace) + riepilogo per stadio."""
+    out = tracing.export_chrome_trace(path)
+    log.info("="*70)
+    log.info(f"TRACE: {out} (chrome://tracing o ui.perfetto.dev)")
+    for line in tracing.format_stats():
+        log.info(f"  {line}")
+    log.info("="*70)
 
 # ---------------------------------------
 # MAIN
@@ -584,8 +947,36 @@ def main():
   Solo analisi singolo stem:
     python ambisonics_automation.py --analyze-only --file /path/stems/song/drums.wav
 
+  Analisi multi-core (processi + shared memory, timeout per file):
+    python ambisonics_automation.py --analyze-only --folder /path/stems/song/ --backend process
+
+  Registrazioni lunghe (streaming a memoria limitata, automatico oltre 20 min):
+    python ambisonics_automation.py --analyze-only --file /path/set_2h.wav --stream
+
+  Batch libreria (cartella o playlist .m3u/.txt):
+    python ambisonics_automation.py --batch /path/music/ --queue-size 2
+
+  Servizio di separazione persistente (modello caricato una volta, job via OSC):
+    python ambisonics_automation.py --service
+    (invio: /separate "/path/song.mp3" [1=force] su 127.0.0.1:57124)
+
   Pulisci cache:
     python ambisonics_automation.py --clear-cache
+
+  Statistiche cache (hit rate, spazio disco):
+    python ambisonics_automation.py --cache-stats
+
+  Analisi a 22.05 kHz (più veloce, tempi nel tempo della sorgente):
+    python ambisonics_automation.py --analyze-only --folder /path/stems/song/ --analysis-sr 22050
+
+  Griglia dei beat unica per le stem del brano (beat tracking una volta, su drums):
+    python ambisonics_automation.py --analyze-only --folder /path/stems/song/ --beat-grid drums
+
+  Cartelle sorvegliate (stems pronte in background per ogni nuova traccia):
+    python ambisonics_automation.py --watch ~/Music/DJ ~/Downloads
+
+  Tempi per stadio (trace Chrome/Perfetto):
+    python ambisonics_automation.py song.mp3 --trace trace.json
 """
     )
     ap.add_argument("input", nargs="?", help="File audio di input (workflow completo se presente)")
@@ -596,21 +987,127 @@ def main():
     ap.add_argument("--device", choices=["mps", "cuda", "cpu"], help="Forza device Demucs")
     ap.add_argument("--force", action="store_true", help="Rigenera stems anche se esistono")
     ap.add_argument("--clear-cache", action="store_true", help="Pulisce la cache analisi")
+    ap.add_argument("--cache-stats", action="store_true", help="Hit rate e spazio disco della cache")
+    ap.add_argument("--cache-max-mb", type=float, default=CACHE_MAX_BYTES / (1024 * 1024),
+                    help=f"Limite cache in MB, eviction LRU (default {CACHE_MAX_BYTES // (1024 * 1024)})")
+    ap.add_argument("--backend", choices=["thread", "process"], default="thread",
+                    help="Motore analisi: thread (default) o process (shared memory, multi-core)")
+    ap.add_argument("--workers", type=int, help="Worker analisi (default: core disponibili con --backend process)")
+    ap.add_argument("--timeout", type=float, default=ANALYSIS_TIMEOUT,
+                    help=f"Timeout per file in secondi con --backend process (default {ANALYSIS_TIMEOUT:.0f})")
+    ap.add_argument("--separator", choices=["auto", "cli", "inprocess"], default="auto",
+                    help="Demucs: modello residente in-process (auto se torch/demucs importabili) o CLI")
+    ap.add_argument("--service", action="store_true",
+                    help=f"Servizio di separazione persistente su OSC (/separate path [force], porta {SERVICE_PORT})")
+    ap.add_argument("--service-port", type=int, default=SERVICE_PORT, help="Porta OSC del servizio")
+    ap.add_argument("--compute", default=compute_backends.DEFAULT_BACKEND,
+                    help="Backend filter/stft/centroid: numpy (default), torch-cpu, torch-cuda, "
+                         "torch-mps, auto (benchmark) o per stadio (filter=numpy,stft=torch-mps)")
+    ap.add_argument("--analysis-sr", type=int, default=None,
+                    help=f"Sample rate di analisi, es. {' o '.join(map(str, ANALYSIS_SR_CHOICES))} "
+                         "(ricampionamento polifase; default: nativo)")
+    ap.add_argument("--beat-grid", choices=BEAT_GRID_MODES, default="stem",
+                    help="Griglia dei beat: una per stem (default), quella di drums per tutte "
+                         "le stem del brano, o beat tracking sulla somma delle stem")
+    ap.add_argument("--stream", action="store_true",
+                    help="Analisi a blocchi a memoria limitata (automatica per file > 20 min)")
+    ap.add_argument("--batch", metavar="PATH", help="Cartella o playlist: separa + analizza in pipeline")
+    ap.add_argument("--queue-size", type=int, default=BATCH_QUEUE_SIZE,
+                    help=f"Tracce separate in attesa di analisi (batch, default {BATCH_QUEUE_SIZE})")
+    ap.add_argument("--watch", nargs="+", metavar="FOLDER",
+                    help="Sorveglia le cartelle musicali: separa + analizza in background "
+                         "(priorità minima) ogni traccia nuova o modificata")
+    ap.add_argument("--watch-poll", type=float, metavar="S",
+                    help="Con --watch: scansione ogni S secondi invece di inotify")
+    ap.add_argument("--trace", metavar="FILE",
+                    help="Scrive i tempi per stadio (separazione, decode, beat, onset, ...) "
+                         "come trace Chrome JSON all'uscita")
 
     args = ap.parse_args()
+    if args.watch:
+        # Prima di thread e processi figli, che ereditano la priorità
+        log.info("Priorità bassa: " + (", ".join(lower_priority()) or "non modificabile"))
+    if args.trace:
+        tracing.start_recording()
+        atexit.register(write_trace, args.trace)
+    analyze_opts = dict(backend=args.backend, workers=args.workers, timeout=args.timeout or None,
+                        stream=args.stream, beat_grid=args.beat_grid)
+
+    # scipy / librosa / torch si caricano solo nei comandi che li usano
+    log.info(f"Avvio in {time.perf_counter() - _T_START:.2f}s")
+    enable_numba_cache()
 
     # Cache
+    configure_cache(max_bytes=int(args.cache_max_mb * 1024 * 1024))
+    if configure_analysis_sr(args.analysis_sr):
+        log.info(f"Analisi a {args.analysis_sr} Hz (ricampionamento polifase)")
+    if args.compute != compute_backends.DEFAULT_BACKEND:
+        chosen = compute_backends.configure(args.compute, log=log.info)
+        log.info("Compute: " + ", ".join(f"{k}={v}" for k, v in chosen.items()))
     if args.clear_cache:
         clear_cache()
         return 0
+    if args.cache_stats:
+        sweep_orphans()
+        evict()
+        print_cache_stats()
+        return 0
+
+    # Servizio di separazione (modello residente, job via OSC)
+    if args.service:
+        separator = make_separator("inprocess", args.device)
+        separator.warm_up()
+        log.info(f"Modello caricato in {separator.load_s:.1f}s")
+        if not args.no_analyze:
+            log.info(f"Warm-up analisi in {warm_up():.1f}s")
+        service = SeparationService(
+            lambda path, force: separate_and_analyze(path, separator, force=force,
+                                                     device=args.device,
+                                                     analyze_opts=analyze_opts,
+                                                     analyze=not args.no_analyze),
+            port=args.service_port, log=log.info)
+        service.serve_forever()
+        return 0
+
+    # Cartelle sorvegliate (daemon)
+    if args.watch:
+        separator = make_separator(args.separator, args.device)
+        if separator is not None:
+            separator.warm_up()
+        analyze = not args.no_analyze
+
+        def process(path, checkpoint):
+            force = track_status(path, analyze) == "stale"
+            separate_and_analyze(path, separator, force=force, device=args.device,
+                                 analyze_opts=analyze_opts, analyze=analyze, checkpoint=checkpoint)
+
+        daemon = HotFolderDaemon(args.watch, VALID_EXTENSIONS,
+                                 lambda path: track_status(path, analyze) != "ready",
+                                 process, poll_s=args.watch_poll, log=log.info)
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    # Modalità batch (pipeline)
+    if args.batch:
+        inputs = collect_batch_inputs(args.batch)
+        if not inputs:
+            log.error("Nessuna traccia da processare in batch.")
+            return 1
+        stats = batch_process(inputs, force=args.force, device=args.device,
+                              queue_size=args.queue_size, analyze_opts=analyze_opts,
+                              separator=make_separator(args.separator, args.device))
+        return 0 if stats['failed'] == 0 else 1
 
     # Modalità analisi-only
     if args.analyze_only:
         if args.folder:
-            analyze_folder(args.folder)
+            analyze_folder(args.folder, **analyze_opts)
             return 0
         if args.file:
-            analyze_file_to_json(args.file)
+            analyze_file_to_json(args.file, stream=args.stream)
             return 0
         log.error("Con --analyze-only specifica --folder oppure --file")
         return 1
@@ -626,11 +1123,20 @@ def main():
         log.info("STEP 1/2: Separazione stems")
         log.info("="*70)
 
-        stems_paths = separate_4stems(args.input, force=args.force, device=args.device)
+        separator = make_separator(args.separator, args.device)
+        track = None
+        if separator is not None:
+            track = separate_inprocess(args.input, separator, force=args.force)
         stems_dir = stems_dir_for_input(args.input)
+        if separator is None:
+            stems_paths = separate_4stems(args.input, force=args.force, device=args.device)
+        else:
+            stems_paths = {s: str(stems_dir / f"{s}.wav") for s in STEM_NAMES}
         log.info(f"Stems directory: {stems_dir}")
 
         if args.no_analyze:
+            if track is not None:
+                track.wait_all()
             log.info("Separazione completata (analisi disabilitata).")
             return 0
 
@@ -639,7 +1145,11 @@ def main():
         log.info("STEP 2/2: Analisi stems -> JSON")
         log.info("="*70)
 
-        analyze_folder(str(stems_dir))
+        if track is not None:
+            analyze_separated(track, args.beat_grid)
+        else:
+            analyze_folder(str(stems_dir), **analyze_opts)
+        save_mix_peaks(args.input, stems_dir, force=args.force, beat_grid=args.beat_grid)
 
         log.info("="*70)
         log.info("WORKFLOW COMPLETO")
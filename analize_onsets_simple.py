@@ -1,24 +1,60 @@
 #!/usr/bin/env python3
 """
-Analizzatore onset per DJ Ambisonics - Optimized for Apple Silicon (MPS)
+Analizzatore onset per DJ Ambisonics: server OSC.
+
+L'analisi è quella di analysis_pipeline (la stessa della CLI
+ambisonics_automation.py, con la stessa cache .onset_cache/): una stem già
+preparata offline risponde subito, con risultati identici al JSON della CLI.
+
+All'avvio gli import pesanti (scipy, sottomoduli librosa, torch) restano
+pigri; il warm-up (analysis_pipeline.warm_up, --no-warmup per saltarlo)
+gira nel worker dell'analisi mentre il server già ascolta, quindi la prima
+richiesta trova JIT compilati e moduli caricati. Il report dei tempi di
+avvio viene stampato a warm-up finito.
+
+Ogni stadio (attesa in coda, decode, beat, onset, features, invio OSC, ...)
+è uno span di tracing: /analysis/metrics risponde con profondità della
+coda, job in corso e latenze p50/p95 per stadio.
+
+Analisi progressiva (progressive_analysis): con un cue nella richiesta (o
+--progressive per le richieste dei deck) ogni file non ancora in cache
+riceve prima la regione attorno al cue, poi il resto del brano a regioni
+successive, finché l'analisi completa (in coda come sempre) non è pronta.
+Le regioni girano in un thread a parte, fuori dalla coda: la risposta non
+aspetta le analisi complete in corso. Ogni regione invia le serie unite
+finora (stesso trasporto) e /analysis/region; l'analisi completa le
+sostituisce e chiude il file con /analysis/file_end. /analyze_region
+analizza le zone mancanti dopo un seek (e accoda l'analisi completa se il
+file non ne ha una).
+
+--beat-grid drums|sum: le stem di un brano (vocals, drums, bass, other
+nella stessa cartella) usano una griglia dei beat unica (song_grid),
+calcolata alla prima stem richiesta e poi letta dalla cache.
 """
 
+import time
+_T_START = time.perf_counter()
+
 from pythonosc.dispatcher import Dispatcher
 from pythonosc import osc_server, udp_client
-import librosa
+import argparse
+import asyncio
 import os
-import numpy as np
-from scipy.signal import butter, sosfilt
-import time
-import torch
-import torchaudio
-import torchaudio.functional as F
-import torchaudio.transforms as T
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-# Configurazione Hardware
-# Verifica disponibilità MPS (Metal Performance Shaders) per M1/M2/M3/M4
-DEVICE = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
-print(f"🚀 Hardware Acceleration: {DEVICE}")
+from analysis_engine import enable_numba_cache
+from analysis_pipeline import (VALID_EXTENSIONS, analyze_file, analysis_cached, prepare_batch,
+                               prepare_json_analysis, warm_up, configure_analysis_sr, song_grid,
+                               song_stems, BEAT_GRID_MODES)
+from osc_transport import OnsetTransport
+from control_curves import save_curves
+from analysis_jobs import (JobQueue, check_cancel, PRIORITY_DECK, PRIORITY_FILE, PRIORITY_SCAN)
+from progressive_analysis import PartialAnalysis, REGION_SECONDS, analyze_region, first_region
+from streaming_analysis import audio_info
+from live_onsets import LiveOnsetStream, open_source
+import compute_backends
+import tracing
 
 # Configurazione OSC
 SC_HOST = "127.0.0.1"
@@ -26,369 +62,240 @@ SC_PORT = 57120
 LISTEN_HOST = "127.0.0.1"
 LISTEN_PORT = 57123
 
-# Configurazione analisi audio
-VALID_EXTENSIONS = {".wav", ".wave", ".aif", ".aiff", ".mp3", ".flac", ".ogg", ".m4a"}
-HOP_LENGTH = 512
-CHUNK_SIZE = 128
+# Trasporto dei risultati: "blob" | "bundle" (con ack da SC) o "chunks" (legacy);
+# "tcp" per ricevitori OSC su TCP (framing SLIP)
+TRANSPORT_MODE = "blob"
+TRANSPORT_PROTO = "udp"
 
-client = udp_client.SimpleUDPClient(SC_HOST, SC_PORT)
+# Backend degli stadi filter/stft/centroid (compute_backends): "auto" misura
+# i backend disponibili all'avvio e sceglie il più veloce per stadio
+COMPUTE_BACKEND = "auto"
 
-def load_audio_torch(file_path):
-    """Carica audio direttamente in tensori PyTorch su GPU (MPS)."""
-    try:
-        # Torchaudio carica (channels, frames)
-        waveform, sr = torchaudio.load(file_path)
-        
-        # Mix to mono se stereo: media dei canali
-        if waveform.shape[0] > 1:
-            waveform = torch.mean(waveform, dim=0, keepdim=True)
-            
-        # Sposta su MPS (GPU)
-        waveform = waveform.to(DEVICE)
-        return waveform, sr
-    except Exception as e:
-        print(f"Errore caricamento Torch: {e}")
-        return None, None
+# Stadi spettrali di più file di una cartella in un solo batch: memoria
+# massima per batch in MB (0 = un file alla volta)
+BATCH_MEMORY_MB = 1024
+
+# Warm-up della pipeline su un segnale sintetico all'avvio
+WARMUP = True
 
-def get_filter_coeffs_torch(sr, low_hz, high_hz=None, btype='low'):
+# Sample rate di analisi (es. 22050): None = nativo del file
+ANALYSIS_SR = None
+
+# Analisi progressiva per le richieste dei deck (priorità <= PRIORITY_DECK)
+# anche senza cue esplicito (cue 0)
+PROGRESSIVE = False
+
+# Griglia dei beat: "stem" (una per stem), "drums" o "sum" (una per brano)
+BEAT_GRID = "stem"
+
+client = udp_client.SimpleUDPClient(SC_HOST, SC_PORT)
+transport = OnsetTransport(SC_HOST, SC_PORT, reply_port=LISTEN_PORT, mode=TRANSPORT_MODE,
+                           proto=TRANSPORT_PROTO)
+
+def analyze_single_file(file_path, cancel=None):
     """
-    Calcola coefficienti SOS su CPU (scipy) e li converte in tensori GPU.
-    Torchaudio.functional.sosfilt richiede coefficienti precisi.
+    Analizza (o legge dalla cache) e invia a SuperCollider. cancel:
+    threading.Event controllato tra gli stadi (JobCancelled se il job è
+    stato annullato).
     """
-    nyquist = sr / 2
-    if btype == 'band':
-        low = max(low_hz / nyquist, 0.001)
-        high = min(high_hz / nyquist, 0.999)
-        sos = butter(4, [low, high], btype='band', output='sos')
-    else:
-        cutoff = min(low_hz / nyquist, 0.999)
-        sos = butter(4, cutoff, btype=btype, output='sos')
-    
-    # Converti in tensore MPS float32
-    return torch.from_numpy(sos).float().to(DEVICE)
-
-def calculate_bpm_hybrid(file_path, waveform_gpu, sr):
-    """Calcola BPM usando Librosa (CPU) ma partendo dai dati già caricati."""
-    try:
-        if waveform_gpu is None or waveform_gpu.shape[1] == 0:
-             return 0.0, "File vuoto", None
-        
-        # Per beat_track di Librosa serve Numpy su CPU
-        y_cpu = waveform_gpu.cpu().numpy().flatten()
+    filename = os.path.basename(file_path)
+    checkpoint = lambda: check_cancel(cancel)
+    with tracing.span("analyze_single_file", file=filename):
+        grid = file_grid(file_path, checkpoint)
+        ok, bpm, grouped = analyze_file(file_path, checkpoint=checkpoint, grid=grid)
+        check_cancel(cancel)
+        finish_partial(file_path)
         
-        # Normalizza
-        if np.abs(y_cpu).max() > 0:
-            y_cpu = librosa.util.normalize(y_cpu)
-            
-        tempo, beat_frames = librosa.beat.beat_track(
-            y=y_cpu, 
-            sr=sr, 
-            hop_length=HOP_LENGTH, 
-            trim=False
-        )
+        send_to_supercollider("/analysis/file_bpm", filename, bpm, f"BPM: {bpm:.1f}")
+        if not ok:
+            return False, bpm, grouped
         
-        # --- FIX: Gestione compatibilità array/scalare per Librosa ---
-        if np.ndim(tempo) > 0:
-            tempo = tempo.item()  # Estrae il valore scalare dall'array
-            
-        bpm = float(tempo) if np.isfinite(tempo) and tempo > 0 else 0.0
-        return bpm, y_cpu, beat_frames
-            
-    except Exception as e:
-        print(f"Errore BPM: {e}")
-        return 0.0, None, None
+        send_envelope_data(filename, bpm, grouped, file_path)
+    return True, bpm, grouped
 
-def calculate_spectral_centroid_torch(waveform_filtered, sr, n_fft=2048, hop_length=512):
+def file_grid(file_path, checkpoint=None, compute=True):
     """
-    Calcola il centroide spettrale interamente su GPU.
-    Molto più veloce di librosa.feature.spectral_centroid in loop.
+    Griglia del brano per una stem (BEAT_GRID != "stem"), dalle stem sorelle.
+    compute=False: solo dalla cache (None se non è ancora stata calcolata).
     """
-    # STFT su GPU
-    window = torch.hann_window(n_fft).to(DEVICE)
-    stft = torch.stft(waveform_filtered.squeeze(), n_fft=n_fft, hop_length=hop_length, 
-                      window=window, return_complex=True)
-    magnitude = torch.abs(stft) # (freq_bins, time_frames)
-    
-    # Frequenze per ogni bin
-    freqs = torch.linspace(0, sr/2, steps=n_fft//2 + 1, device=DEVICE).unsqueeze(1) # (freq_bins, 1)
-    
-    # Calcolo centroide vettorializzato: sum(freq * mag) / sum(mag)
-    mag_sum = torch.sum(magnitude, dim=0)
-    # Evita divisione per zero
-    mag_sum[mag_sum == 0] = 1e-8
-    
-    centroid = torch.sum(freqs * magnitude, dim=0) / mag_sum
-    return centroid # (time_frames,)
+    if BEAT_GRID == "stem" or not song_stems([file_path]):
+        return None
+    folder = os.path.dirname(file_path)
+    siblings = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+                if os.path.splitext(f)[1].lower() in VALID_EXTENSIONS]
+    return song_grid(siblings, BEAT_GRID, checkpoint=checkpoint, compute=compute)
 
-def calculate_envelope_features_gpu(waveform, sr, onset_frames):
+def is_cached(file_path):
+    """Analisi completa in cache, con la stessa griglia di analyze_single_file."""
+    grid = file_grid(file_path, compute=False)
+    if grid is None and BEAT_GRID != "stem" and song_stems([file_path]):
+        return False          # griglia del brano non ancora calcolata
+    return analysis_cached(file_path, grid)
+
+def send_envelope_data(filename, bpm, grouped, file_path=None):
     """
-    Approccio Ibrido Ottimizzato:
-    - Filtri (Butterworth): CPU (Scipy) -> Più stabile e compatibile.
-    - Analisi Spettrale (STFT): GPU (MPS) -> Accelerazione massiccia.
+    Invia le serie di prepare_json_analysis (le stesse del JSON della CLI).
+    Con file_path scrive prima le curve di automazione (control_curves),
+    così SC le trova già su disco quando finalizza la stem.
     """
-    if len(onset_frames) == 0:
-        return []
-    
-    # --- FASE 1: FILTRAGGIO (CPU - Scipy) ---
-    # Spostiamo l'audio su CPU per il filtraggio rapido
-    # sosfilt di scipy è in C, quindi velocissimo anche su CPU M4
-    y_cpu = waveform.cpu().numpy().flatten()
-    
-    # 1. Filtro Passa-Banda (50Hz - 8kHz)
-    nyquist = sr / 2
-    low = max(50.0 / nyquist, 0.001)
-    high = min(8000.0 / nyquist, 0.999)
-    sos_band = butter(4, [low, high], btype='band', output='sos')
-    y_filtered_cpu = sosfilt(sos_band, y_cpu)
-    
-    # 2. Envelope: Rettifica + Low Pass (15Hz)
-    y_rect = np.abs(y_filtered_cpu)
-    cutoff_env = min(15.0 / nyquist, 0.999)
-    sos_low = butter(4, cutoff_env, btype='low', output='sos')
-    envelope_cpu = sosfilt(sos_low, y_rect)
-    
-    # Normalizza envelope
-    env_max = np.max(envelope_cpu)
-    if env_max > 0:
-        envelope_cpu = envelope_cpu / env_max
-
-    # --- FASE 2: ANALISI SPETTRALE (GPU - PyTorch MPS) ---
-    # Riportiamo solo l'audio filtrato su GPU per fare la STFT pesante
-    y_filtered_gpu = torch.from_numpy(y_filtered_cpu).float().to(DEVICE)
-    
-    # Calcolo curva spettrale vettorializzato su GPU
-    # (Questa è la parte che guadagna di più dall'accelerazione)
-    spectral_curve = calculate_spectral_centroid_torch(y_filtered_gpu, sr, n_fft=2048, hop_length=512)
-    
-    # Riportiamo la curva spettrale su CPU per il campionamento
-    spectral_curve_cpu = spectral_curve.cpu().numpy()
+    with tracing.span("prepare_json", file=filename):
+        data = prepare_json_analysis(filename, bpm, grouped)
+    if file_path is not None:
+        try:
+            with tracing.span("save_curves", file=filename):
+                save_curves(file_path, data)
+        except Exception as e:
+            print(f"⚠️ Curve non salvate per {filename}: {e}")
+    if data['num_onsets'] == 0:
+        send_to_supercollider("/analysis/onset_data", filename, 0, 0)
+        return
     
-    features = []
-    total_samples = len(envelope_cpu)
-    max_analysis_samples = int(0.5 * sr)
+    # Tutte le serie in un blob con ack (o a chunk in modalità legacy)
+    with tracing.span("osc_send", cat="osc", file=filename, onsets=data['num_onsets']):
+        transport.send(filename, [data['onset_times'], data['beat_positions'],
+                                  data['onset_strength'], data['onset_spread'],
+                                  data['onset_contrast']])
     
-    # --- FASE 3: ESTRAZIONE FEATURES (Logica procedurale veloce) ---
-    for i, onset_sample in enumerate(onset_frames):
-        # Definisci finestra temporale
-        if i < len(onset_frames) - 1:
-            next_onset = onset_frames[i + 1]
-            window_end = min(onset_sample + max_analysis_samples, next_onset)
-        else:
-            window_end = min(onset_sample + max_analysis_samples, total_samples)
-            
-        if window_end <= onset_sample:
-            features.append({'attack_time': 0.0, 'release_time': 0.0, 'velocity_value': 0.0, 'spectral_mean_freq': 0.0})
-            continue
+    print(f"✓ {data['num_onsets']} onset inviati")
 
-        # Slicing su array NumPy (molto veloce)
-        env_window = envelope_cpu[onset_sample:window_end]
-        
-        # Recupero media spettrale dalla curva pre-calcolata
-        start_frame = int(onset_sample / 512)
-        end_frame = int(window_end / 512)
-        
-        # Bounds check
-        start_frame = min(start_frame, len(spectral_curve_cpu)-1)
-        end_frame = min(max(end_frame, start_frame + 1), len(spectral_curve_cpu))
-        
-        spec_slice = spectral_curve_cpu[start_frame:end_frame]
-        spectral_mean_freq = float(np.mean(spec_slice)) if len(spec_slice) > 0 else 0.0
-        
-        if len(env_window) < 2:
-            features.append({'attack_time': 0.0, 'release_time': 0.0, 'velocity_value': 0.0, 'spectral_mean_freq': spectral_mean_freq})
-            continue
+def send_to_supercollider(addr, *args):
+    try:
+        client.send_message(addr, list(args))
+    except Exception as e:
+        print(f"❌ OSC Error: {e}")
 
-        # Logica Attack/Release
-        peak_idx = np.argmax(env_window)
-        attack_time = peak_idx / sr
-        
-        peak_value = env_window[peak_idx]
-        threshold = peak_value * 0.5
-        
-        under_thresh = np.where(env_window[peak_idx:] < threshold)[0]
-        
-        if len(under_thresh) > 0:
-            release_samples = under_thresh[0]
-        else:
-            release_samples = len(env_window) - peak_idx
-            
-        release_time = release_samples / sr
-        
-        # Calcolo Velocity
-        attack_norm = np.clip(attack_time / 0.1, 0.0, 1.0)
-        release_norm = np.clip(release_time / 0.5, 0.0, 1.0)
-        velocity_value = 1.0 - (0.3 * attack_norm + 0.7 * release_norm)
-        
-        features.append({
-            'attack_time': attack_time,
-            'release_time': release_time,
-            'velocity_value': velocity_value,
-            'spectral_mean_freq': spectral_mean_freq
-        })
-        
-    return features
+# --- Analisi progressiva: regioni fuori dalla coda, un thread dedicato ---
+regions = ThreadPoolExecutor(max_workers=1, thread_name_prefix="region")
+partials = {}                 # realpath -> PartialAnalysis (file senza analisi completa)
+partials_lock = threading.Lock()
 
-def group_by_beat_position(onset_times, beat_frames, sr, features):
-    """Raggruppa gli onset per posizione in beat (Logica CPU pura, invariata)."""
-    if len(onset_times) == 0:
-        return []
-    
-    if beat_frames is None or len(beat_frames) == 0:
-        grouped_data = []
-        spectral_freqs = [f['spectral_mean_freq'] for f in features]
-        for i, onset_time in enumerate(onset_times):
-            start_idx = max(0, i - 20 + 1)
-            freq_window = spectral_freqs[start_idx:i+1]
-            spectral_mean_freq_smoothed = np.mean(freq_window)
-            grouped_data.append({
-                'onset_time': onset_time, 'beat_index': 0, 'beat_position': onset_time, 'beat_fraction': 0.0,
-                'velocity_value_grouped': features[i]['velocity_value'], 'spectral_mean_freq_smoothed': spectral_mean_freq_smoothed,
-                **features[i]
-            })
-        return grouped_data
-    
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=HOP_LENGTH)
-    beat_start = beat_times[0] if len(beat_times) > 0 else 0.0
-    beat_period = 60.0 / len(beat_times) * (beat_times[-1] - beat_start) if len(beat_times) > 1 else 1.0
-    
-    grouped_data = []
-    for i, onset_time in enumerate(onset_times):
-        beat_position = (onset_time - beat_start) / beat_period if beat_period > 0 else 0.0
-        beat_index = int(round(beat_position))
-        beat_fraction = beat_position - beat_index
-        grouped_data.append({
-            'onset_time': onset_time, 'beat_index': beat_index, 'beat_position': beat_position, 'beat_fraction': beat_fraction,
-            **features[i]
-        })
-    
-    # Raggruppa e media
-    beat_groups = {}
-    for data in grouped_data:
-        beat_groups.setdefault(data['beat_index'], []).append(data)
-    
-    result = []
-    for beat_idx, group in beat_groups.items():
-        avg_velocity = np.mean([d['velocity_value'] for d in group])
-        for data in group:
-            data['velocity_value_grouped'] = avg_velocity
-            result.append(data)
-            
-    result.sort(key=lambda x: x['onset_time'])
-    
-    # Smoothing spettrale
-    for i, data in enumerate(result):
-        start_idx = max(0, i - 20 + 1)
-        freq_window = [result[j]['spectral_mean_freq'] for j in range(start_idx, i + 1)]
-        data['spectral_mean_freq_smoothed'] = np.mean(freq_window)
-    
-    return result
+def _partial(file_path, create=True):
+    key = os.path.realpath(file_path)
+    with partials_lock:
+        p = partials.get(key)
+        if p is None and create:
+            p = partials[key] = PartialAnalysis(file_path)
+        return p
+
+def finish_partial(file_path):
+    """Analisi completa pronta: le regioni di file_path non vengono più inviate."""
+    with partials_lock:
+        p = partials.pop(os.path.realpath(file_path), None)
+    if p is not None:
+        with p.lock:          # aspetta l'eventuale invio di una regione in corso
+            p.final = True
 
-def analyze_single_file(file_path):
-    """Orchestratore analisi ottimizzata."""
+def drop_partials(target):
+    """
+    Annullamento di un file o di una cartella: scarta le regioni dei file
+    che nessun'altra richiesta (altro deck) tiene ancora in coda.
+    """
+    key = os.path.realpath(target)
+    with partials_lock:
+        keys = [k for k in partials
+                if (k == key or k.startswith(key + os.sep)) and not jobs.active(k)]
+    for k in keys:
+        with partials_lock:
+            p = partials.pop(k, None)
+        if p is not None:
+            p.final = True
+
+def run_regions(file_path, t0, t1):
+    """
+    Eseguita nel thread delle regioni: analizza e invia le parti mancanti di
+    [t0, t1). False se non c'è più niente da fare per il file (analisi
+    completa pronta o regione fallita).
+    """
+    p = _partial(file_path, create=False)
+    if p is None or p.final:
+        return False
+    if is_cached(file_path):
+        finish_partial(file_path)   # l'analisi completa risponde subito dalla coda
+        return False
     filename = os.path.basename(file_path)
-    
-    # 1. Caricamento su GPU (Veloce)
-    waveform_gpu, sr = load_audio_torch(file_path)
-    if waveform_gpu is None:
-        return False, 0.0, []
+    for a, b in p.missing(t0, t1):
+        try:
+            bpm, cols = analyze_region(file_path, a, b)
+        except Exception as e:
+            print(f"⚠️ Regione {a:.1f}-{b:.1f}s di {filename} fallita: {e}")
+            return False
+        with p.lock:
+            if p.final:
+                return False
+            first = not p.spans
+            p.add(a, b, bpm, cols)
+            if first:
+                send_to_supercollider("/analysis/file_bpm", filename, p.bpm, f"BPM: {p.bpm:.1f}")
+            if p.columns['onset_time'].size:
+                send_envelope_data(filename, p.bpm, p.columns, file_path)
+            send_to_supercollider("/analysis/region", filename, float(a), float(b),
+                                  int(p.columns['onset_time'].size))
+        print(f"◐ {filename}: regione {a:.1f}-{b:.1f}s")
+    return True
 
-    # 2. Calcolo BPM (Richiede parziale ritorno a CPU per algoritmi complessi di librosa)
-    bpm, y_cpu, beat_frames = calculate_bpm_hybrid(file_path, waveform_gpu, sr)
-    
-    send_to_supercollider("/analysis/file_bpm", filename, bpm, f"BPM: {bpm:.1f}")
-    
-    if y_cpu is None:
-        del waveform_gpu # Libera VRAM
-        torch.mps.empty_cache()
-        return False, bpm, []
-    
-    # 3. Onset Detect (CPU - Librosa è più accurato di semplici implementazioni torch)
-    onset_frames = librosa.onset.onset_detect(
-        y=y_cpu, sr=sr, hop_length=HOP_LENGTH, units='samples', backtrack=True
-    )
-    
-    if len(onset_frames) == 0:
-        del waveform_gpu
-        return True, bpm, []
-    
-    onset_times = onset_frames / sr
-    
-    # 4. Calcolo Features Envelope e Spettrali (GPU MASSIVE SPEEDUP)
-    # Passiamo il tensore GPU originale, non la copia numpy
-    features = calculate_envelope_features_gpu(waveform_gpu, sr, onset_frames)
-    
-    # Pulizia memoria GPU immediata
-    del waveform_gpu
-    torch.mps.empty_cache()
-    
-    # 5. Raggruppamento (CPU leggera)
-    grouped_data = group_by_beat_position(onset_times, beat_frames, sr, features)
-    
-    # 6. Invio OSC
-    send_envelope_data(filename, grouped_data)
-    
-    return True, bpm, grouped_data
+def fill_regions(file_path, duration):
+    """
+    Riempimento in background: una regione alla volta (next_region), poi si
+    rimette in fondo al thread delle regioni, così prime regioni di altri
+    file e seek non aspettano l'intero brano. Si ferma quando il file è
+    coperto o l'analisi completa è pronta.
+    """
+    p = _partial(file_path, create=False)
+    if p is None or p.final:
+        return
+    region = p.next_region(duration)
+    if region is not None and run_regions(file_path, *region):
+        regions.submit(fill_regions, file_path, duration)
 
-def send_envelope_data(filename, grouped_data):
-    """Invia i dati (invariato, solo ottimizzazioni python standard)."""
-    if not grouped_data:
-        send_to_supercollider("/analysis/onset_data", filename, 0, 0)
+def request_regions(paths, t0, t1, fill=False):
+    """Regioni [t0, t1) dei file; fill=True: poi il resto di ogni file in background."""
+    for path in paths:
+        _partial(path)
+        regions.submit(run_regions, path, t0, t1)
+    if not fill:
         return
-    
-    onset_times = [d['onset_time'] for d in grouped_data]
-    beat_positions = [d['beat_position'] for d in grouped_data]
-    velocity_vals = [d['velocity_value_grouped'] for d in grouped_data]
-    spectral_freqs = [d['spectral_mean_freq_smoothed'] for d in grouped_data]
-    
-    # Smoothing velocity (Python list comp veloce)
-    w_size = 10
-    vel_smooth = [np.mean(velocity_vals[max(0, i-w_size+1):i+1]) for i in range(len(velocity_vals))]
-    vel_exp = [v ** 10.0 for v in vel_smooth] # Exponent
-    
-    # Onset Spread
-    if len(grouped_data) > 0:
-        rels = np.array([d.get('release_time', 0.0) for d in grouped_data])
-        rmin, rmax = rels.min(), rels.max()
-        spread = ((rels - rmin) / (rmax - rmin)).tolist() if rmax > rmin else [0.5]*len(rels)
-    else:
-        spread = []
-        
-    # Gap boost
-    for i in range(len(onset_times) - 1):
-        if (onset_times[i+1] - onset_times[i] > 2.0) or (abs(beat_positions[i+1] - beat_positions[i]) > 8.0):
-            vel_exp[i] = min(vel_exp[i] + 0.2, 1.0)
-            
-    # Contrast Normalization
-    if spectral_freqs:
-        smin, smax = min(spectral_freqs), max(spectral_freqs)
-        contrast = [(f - smin)/(smax - smin) for f in spectral_freqs] if smax > smin else [0.5]*len(spectral_freqs)
-    else:
-        contrast = []
-
-    # Helper per chunk
-    def send_chunk(path, arr):
-        n_chunks = (len(arr) + CHUNK_SIZE - 1) // CHUNK_SIZE
-        for i in range(n_chunks):
-            chunk = arr[i*CHUNK_SIZE : (i+1)*CHUNK_SIZE]
-            send_to_supercollider(path, filename, i, len(chunk), *chunk)
-            time.sleep(0.0005) # Delay ridotto dato che M4 elabora più in fretta
-            
-    send_chunk("/analysis/onset_times_chunk", onset_times)
-    send_chunk("/analysis/onset_pos_chunk", beat_positions)
-    send_chunk("/analysis/onset_strength_chunk", vel_exp)
-    send_chunk("/analysis/onset_spread_chunk", spread)
-    send_chunk("/analysis/onset_contrast_chunk", contrast)
-    
-    print(f"✓ {len(grouped_data)} onset inviati")
+    for path in paths:
+        p = _partial(path)
+        info = audio_info(path)
+        if p.filling or info is None:
+            continue
+        p.filling = True
+        regions.submit(fill_regions, path, info[1] / info[0])
 
-def send_to_supercollider(addr, *args):
+# --- Handlers OSC ---
+# Le richieste vanno nella coda unica (analysis_jobs): un'analisi alla volta
+# sull'acceleratore, deck prima delle scansioni, duplicati uniti.
+jobs = None
+
+def run_analysis_job(fpath, cancel):
+    """Eseguita nel thread dell'executor."""
     try:
-        client.send_message(addr, list(args))
-    except Exception as e:
-        print(f"❌ OSC Error: {e}")
+        ok, bpm, _ = analyze_single_file(fpath, cancel)
+    finally:
+        finish_partial(fpath)     # anche se fallita o annullata: niente regioni orfane
+    return ok, bpm
+
+def prepare_analysis_batch(paths, cancel, budget_mb=BATCH_MEMORY_MB):
+    """Eseguita nel thread dell'executor prima del primo file di un batch."""
+    return prepare_batch(paths, budget_mb, checkpoint=lambda: check_cancel(cancel))
+
+def _priority(args, default):
+    try:
+        return int(args[1]) if len(args) > 1 else default
+    except (TypeError, ValueError):
+        return default
+
+def _cue(args, priority):
+    """Cue (s) della richiesta progressiva, o None: analisi solo completa."""
+    try:
+        if len(args) > 2:
+            return float(args[2])
+    except (TypeError, ValueError):
+        return None
+    return 0.0 if PROGRESSIVE and priority <= PRIORITY_DECK else None
 
-# --- Handlers OSC (Struttura invariata) ---
 def handle_analyze_folder(addr, *args):
+    """/analyze_folder <cartella> [priorità] [cue]"""
     if not args: return
     folder = args[0]
     if not os.path.isdir(folder): return
@@ -397,49 +304,172 @@ def handle_analyze_folder(addr, *args):
              if os.path.splitext(f)[1].lower() in VALID_EXTENSIONS]
     
     if not files: return
-    
-    send_to_supercollider("/analysis/start", len(files), folder)
-    valid_bpms = []
-    
-    print(f"🔥 Starting Batch Analysis on MPS Device: {DEVICE}")
-    
-    for i, fpath in enumerate(files):
-        fname = os.path.basename(fpath)
-        send_to_supercollider("/analysis/file_start", fname, i+1, len(files))
-        
-        # Qui si potrebbe parallelizzare ulteriormente, ma con GPU è meglio sequenziale 
-        # per non saturare la VRAM se i file sono lunghi.
-        ok, bpm, _ = analyze_single_file(fpath)
-        
-        if ok and bpm > 0: valid_bpms.append(bpm)
-        send_to_supercollider("/analysis/file_end", fname)
-        
-    gbpm = np.median(valid_bpms) if valid_bpms else 0.0
-    print(f"✓ Global BPM: {gbpm:.1f}")
-    send_to_supercollider("/analysis/global_bpm", gbpm, len(valid_bpms))
-    send_to_supercollider("/analysis/end", len(files), len(valid_bpms))
+    priority = _priority(args, PRIORITY_SCAN)
+    cue = _cue(args, priority)
+    if cue is not None:
+        request_regions(files, *first_region(cue), fill=True)
+    jobs.submit(folder, files, priority, folder=True)
 
 def handle_analyze_file(addr, *args):
+    """/analyze_file <file> [priorità] [cue]"""
     if not args: return
-    fpath = args[0]
-    fname = os.path.basename(fpath)
-    send_to_supercollider("/analysis/file_start", fname, 1, 1)
-    ok, _, _ = analyze_single_file(fpath)
-    send_to_supercollider("/analysis/file_end", fname)
-    send_to_supercollider("/analysis/end", 1, 1 if ok else 0)
+    priority = _priority(args, PRIORITY_FILE)
+    cue = _cue(args, priority)
+    if cue is not None:
+        request_regions([args[0]], *first_region(cue), fill=True)
+    jobs.submit(args[0], [args[0]], priority, folder=False)
+
+def handle_analyze_region(addr, *args):
+    """/analyze_region <file> <t0> [t1]: zona non ancora analizzata (seek)"""
+    if len(args) < 2 or not os.path.isfile(str(args[0])): return
+    try:
+        t0 = max(0.0, float(args[1]))
+        t1 = float(args[2]) if len(args) > 2 else t0 + REGION_SECONDS
+    except (TypeError, ValueError):
+        return
+    if t1 <= t0:
+        return
+    path = str(args[0])
+    if jobs.active(path):
+        request_regions([path], t0, t1)
+        return
+    # Nessuna analisi completa in arrivo: la accoda, altrimenti le regioni
+    # del file resterebbero in partials senza mai essere chiuse
+    request_regions([path], t0, t1, fill=True)
+    jobs.submit(path, [path], PRIORITY_DECK, folder=False)
+
+def handle_cancel(addr, *args):
+    """/analysis/cancel <cartella|file>"""
+    if not args: return
+    jobs.cancel(str(args[0]))
+    drop_partials(str(args[0]))
+
+def handle_metrics(client_address, addr, *args):
+    """
+    /analysis/metrics [porta]: risponde con
+    /analysis/metrics coda in_corso n_stadi (stadio count p50_ms p95_ms)...
+    a SC, o al mittente sulla porta indicata.
+    """
+    st = jobs.stats()
+    stages = tracing.stage_stats()
+    msg = [st["queued"], st["running"], len(stages)]
+    for name, s in sorted(stages.items()):
+        msg += [name, s["count"], round(s["p50_ms"], 3), round(s["p95_ms"], 3)]
+    try:
+        port = int(args[0]) if args else None
+    except (TypeError, ValueError):
+        port = None
+    if port is None:
+        send_to_supercollider("/analysis/metrics", *msg)
+        return
+    try:
+        udp_client.SimpleUDPClient(client_address[0], port).send_message("/analysis/metrics", msg)
+    except Exception as e:
+        print(f"❌ OSC Error: {e}")
+
+# --- Ingressi live (live_onsets): fuori dalla coda, un thread per sorgente ---
+live_streams = {}
+
+def handle_live_start(addr, *args):
+    """/analysis/live_start <device|file> [nome]"""
+    spec = str(args[0]) if args else "default"
+    name = str(args[1]) if len(args) > 1 else "live"
+    handle_live_stop(addr, name)
+    try:
+        source = open_source(spec)
+    except Exception as e:
+        print(f"❌ Live '{name}': {e}")
+        send_to_supercollider("/analysis/live_error", name, str(e))
+        return
+    live_streams[name] = LiveOnsetStream(source, name=name, send=send_to_supercollider).start()
+
+def handle_live_stop(addr, *args):
+    """/analysis/live_stop [nome]: ferma e invia il report di latenza"""
+    name = str(args[0]) if args else "live"
+    stream = live_streams.pop(name, None)
+    if stream is None: return
+    rep = stream.stop()
+    if rep["n_onsets"]:
+        send_to_supercollider("/analysis/live_latency", name, rep["n_onsets"], rep["mean_ms"],
+                              rep["p95_ms"], rep["max_ms"], rep["over_budget"])
+
+async def serve(compute=COMPUTE_BACKEND, batch_mb=BATCH_MEMORY_MB, warmup=WARMUP,
+                analysis_sr=ANALYSIS_SR, progressive=PROGRESSIVE, beat_grid=BEAT_GRID):
+    global jobs, PROGRESSIVE, BEAT_GRID
+    PROGRESSIVE = progressive
+    BEAT_GRID = beat_grid
+    timings = {"import": time.perf_counter() - _T_START}
+    enable_numba_cache()
+    if configure_analysis_sr(analysis_sr):
+        print(f"🎚 Analisi a {analysis_sr} Hz (ricampionamento polifase)")
+    t0 = time.perf_counter()
+    chosen = compute_backends.configure(compute, log=print)
+    timings["compute"] = time.perf_counter() - t0
+    print("🧮 Compute: " + ", ".join(f"{k}={v}" for k, v in chosen.items()))
+    prepare = None
+    if batch_mb > 0:
+        prepare = lambda paths, cancel: prepare_analysis_batch(paths, cancel, batch_mb)
+        print(f"🧱 Batch spettrale: {batch_mb:.0f} MB")
+    jobs = JobQueue(run_analysis_job, send_to_supercollider, prepare=prepare)
+    jobs.start()
+    # Nello stesso executor dei job: le prime richieste aspettano il warm-up
+    loop = asyncio.get_running_loop()
+    warming = loop.run_in_executor(jobs.executor, warm_up) if warmup else None
 
-def main():
     dispatcher = Dispatcher()
     dispatcher.map("/analyze_folder", handle_analyze_folder)
     dispatcher.map("/analyze_file", handle_analyze_file)
-    
-    server = osc_server.ThreadingOSCUDPServer((LISTEN_HOST, LISTEN_PORT), dispatcher)
-    print(f"🎵 M4 Optimized Server: {LISTEN_HOST}:{LISTEN_PORT} -> SC: {SC_PORT}")
-    print(f"⚡ Using PyTorch Device: {DEVICE}")
+    dispatcher.map("/analyze_region", handle_analyze_region)
+    dispatcher.map("/analysis/cancel", handle_cancel)
+    dispatcher.map("/analysis/metrics", handle_metrics, needs_reply_address=True)
+    dispatcher.map("/analysis/live_start", handle_live_start)
+    dispatcher.map("/analysis/live_stop", handle_live_stop)
+    transport.bind(dispatcher)
+    
+    server = osc_server.AsyncIOOSCUDPServer((LISTEN_HOST, LISTEN_PORT), dispatcher,
+                                            loop)
+    endpoint, _ = await server.create_serve_endpoint()
+    print(f"🎵 Analysis Server: {LISTEN_HOST}:{LISTEN_PORT} -> SC: {SC_PORT}")
+    print(f"📦 Transport: {TRANSPORT_MODE}/{TRANSPORT_PROTO}")
+    if BEAT_GRID != "stem":
+        print(f"🥁 Griglia dei beat per brano: {BEAT_GRID}")
+    if PROGRESSIVE:
+        print(f"◐ Analisi progressiva per i deck: prima {REGION_SECONDS:.0f}s attorno al cue")
+    if warming is not None:
+        try:
+            timings["warm-up"] = await warming
+        except Exception as e:
+            print(f"⚠️ Warm-up fallito: {e}")
+    timings["totale"] = time.perf_counter() - _T_START
+    print("⏱ Avvio: " + ", ".join(f"{k} {v:.2f}s" for k, v in timings.items()))
+    try:
+        await jobs.join()
+    finally:
+        endpoint.close()
+
+def main():
+    ap = argparse.ArgumentParser(description="Server OSC di analisi onset")
+    ap.add_argument("--compute", default=COMPUTE_BACKEND,
+                    help="Backend di calcolo: auto (benchmark all'avvio), numpy, torch-cpu, "
+                         "torch-cuda, torch-mps o per stadio (filter=numpy,stft=torch-mps)")
+    ap.add_argument("--batch-mb", type=float, default=BATCH_MEMORY_MB,
+                    help="Memoria massima (MB) per batch di stadi spettrali su più file "
+                         "(0 = un file alla volta)")
+    ap.add_argument("--no-warmup", action="store_true",
+                    help="Salta il warm-up della pipeline all'avvio (prima analisi più lenta)")
+    ap.add_argument("--analysis-sr", type=int, default=ANALYSIS_SR,
+                    help="Sample rate di analisi, es. 22050 o 16000 (default: nativo)")
+    ap.add_argument("--progressive", action="store_true", default=PROGRESSIVE,
+                    help="Richieste dei deck: prima la regione attorno al cue, poi il resto")
+    ap.add_argument("--beat-grid", choices=BEAT_GRID_MODES, default=BEAT_GRID,
+                    help="Griglia dei beat: una per stem (default), quella di drums o della "
+                         "somma delle stem per tutte le stem del brano")
+    args = ap.parse_args()
     try:
-        server.serve_forever()
+        asyncio.run(serve(args.compute, args.batch_mb, not args.no_warmup, args.analysis_sr,
+                          args.progressive, args.beat_grid))
     except KeyboardInterrupt:
         pass
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
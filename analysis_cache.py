@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+analysis_cache.py
+
+Cache dei risultati di analisi (.onset_cache/) con indice SQLite.
+
+- Fingerprint veloce: l'indice mappa (path, size, mtime, inode) -> hash del
+  contenuto. Finché il file non cambia non viene riletto; se cambia (o è
+  nuovo) il contenuto viene hashato una sola volta con xxh3 (se il modulo
+  xxhash è installato) o BLAKE2b, leggendo via mmap.
+- Entry per stadio: un file per (nome stem, hash contenuto, stadio, hash dei
+  parametri dello stadio e delle chiavi a monte) in CACHE_DIR, registrato
+  nella tabella entries con dimensione e ultimo accesso. Cambiare i
+  parametri di uno stadio ricalcola solo quello e i successivi; le entry
+  con parametri vecchi escono per LRU. Formato colonnare
+  binario (.mkc): un array float32/int32 per campo + header con bpm, sr e
+  parametri; la lettura mappa il file in memoria senza parsing. Le entry
+  JSON (<key>.json) vengono convertite al primo accesso.
+- Limite di spazio (CACHE_MAX_BYTES) con eviction LRU dopo ogni scrittura.
+- Sweep degli orfani: righe senza file, file non indicizzati, path sorgente
+  spariti. Le entry per file dei formati precedenti (<nome>_<hash> e legacy
+  <nome>_<md5>.json) vengono migrate alla prima lettura del file.
+- Statistiche persistenti di hit/miss, una per analisi di file (vedi
+  cache_stats / --cache-stats).
+
+Usabile da thread e processi diversi: una connessione SQLite per thread,
+journal WAL e busy timeout.
+"""
+
+import os
+import re
+import mmap
+import json
+import time
+import atexit
+import struct
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from analysis_engine import ONSET_COLUMNS, onset_columns
+
+try:
+    import xxhash
+except ImportError:  # opzionale
+    xxhash = None
+
+log = logging.getLogger("ambisonics.cache")
+
+# Accanto agli script: CLI e server OSC condividono la cache da qualunque cwd
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".onset_cache")
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+INDEX_NAME = "index.sqlite"
+EVICT_TARGET = 0.9            # dopo l'eviction si scende al 90% del limite
+SWEEP_INTERVAL_S = 3600.0     # sweep automatico al più una volta l'ora
+TOUCH_FLUSH_N = 256           # accessi accumulati prima di aggiornare l'indice
+TOUCH_FLUSH_S = 5.0
+
+COLUMNAR_EXT = ".mkc"
+COLUMNAR_MAGIC = b"MKOC"
+COLUMNAR_VERSION = 1
+COLUMN_ALIGN = 64
+
+_LEGACY_RE = re.compile(r"^(?P<safe>.+)_(?P<md5>[0-9a-f]{32})\.json$")
+
+_local = threading.local()
+_swept = set()
+_dir_keys = {}
+
+def configure_cache(cache_dir: str | None = None, max_bytes: int | None = None):
+    """Cambia cartella e/o limite della cache (prima dell'uso)."""
+    global CACHE_DIR, CACHE_MAX_BYTES
+    if cache_dir is not None:
+        CACHE_DIR = cache_dir
+    if max_bytes is not None:
+        CACHE_MAX_BYTES = int(max_bytes)
+
+# ---------------------------------------
+# INDICE SQLITE
+# ---------------------------------------
+def _cache_dir() -> Path:
+    p = Path(CACHE_DIR)
+    p.mkdir(parents=True, exist_ok=True)
+    return p
+
+def _dir_key() -> str:
+    """Path assoluto della cartella cache (chiave di connessioni e contatori)."""
+    k = (CACHE_DIR, os.getcwd())
+    key = _dir_keys.get(k)
+    if key is None:
+        key = _dir_keys[k] = os.path.realpath(CACHE_DIR)
+    return key
+
+def _db() -> sqlite3.Connection:
+    key = _dir_key()
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(key)
+    if conn is None:
+        conn = sqlite3.connect(str(_cache_dir() / INDEX_NAME), timeout=30.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                inode INTEGER, content_hash TEXT
+            );
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, filename TEXT, bytes INTEGER,
+                created REAL, last_access REAL, hits INTEGER DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access);
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER);
+        """)
+        conns[key] = conn
+        if key not in _swept:
+            _swept.add(key)
+            _maybe_sweep(conn)
+    return conn
+
+def _close_all():
+    for conn in (getattr(_local, "conns", None) or {}).values():
+        conn.close()
+    _local.conns = {}
+
+def _bump(conn, name: str, n: int = 1):
+    conn.execute(
+        "INSERT INTO counters(name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value", (name, n))
+
+# ---------------------------------------
+# FINGERPRINT
+# ---------------------------------------
+def content_hash(path: str) -> str:
+    """Hash del contenuto (xxh3-128 o BLAKE2b-128) con lettura via mmap."""
+    h = xxhash.xxh3_128() if xxhash else hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return ("x3" if xxhash else "b2") + h.hexdigest()
+
+def fingerprint(path: str) -> str:
+    """
+    Hash del contenuto tramite indice: se (size, mtime, inode) non sono
+    cambiati dall'ultima volta il file non viene riletto.
+    """
+    p = os.path.realpath(path)
+    st = os.stat(p)
+    conn = _db()
+    row = conn.execute(
+        "SELECT size, mtime_ns, inode, content_hash FROM files WHERE path = ?", (p,)
+    ).fetchone()
+    if row and tuple(row[:3]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+        return row[3]
+    digest = content_hash(p)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO files(path, size, mtime_ns, inode, content_hash) "
+            "VALUES (?, ?, ?, ?, ?)", (p, st.st_size, st.st_mtime_ns, st.st_ino, digest))
+    return digest
+
+def _safe_name(path: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in Path(path).name)
+
+def entry_key(path: str) -> str:
+    return f"{_safe_name(path)}_{fingerprint(path)}"
+
+def stage_key(base: str, stage: str, params: dict, inputs=()) -> str:
+    """
+    Chiave di uno stadio: base (entry_key del file sorgente) + nome stadio +
+    hash dei parametri dello stadio e delle chiavi degli stadi a monte.
+    """
+    blob = json.dumps([params, list(inputs)], sort_keys=True, default=str).encode()
+    return f"{base}_{stage}_{hashlib.blake2b(blob, digest_size=8).hexdigest()}"
+
+# ---------------------------------------
+# FORMATO COLONNARE (.mkc)
+# ---------------------------------------
+# Layout:  MAGIC | <II (versione, lunghezza header) | header JSON | dati
+# L'header contiene gli scalari (is_valid, bpm, sr, params...) e per ogni
+# colonna {dtype, offset, count}; gli offset sono relativi all'inizio dei
+# dati e allineati a COLUMN_ALIGN byte. Le colonne si leggono come viste
+# read-only sul file mappato in memoria (nessuna copia, nessun parsing).
+def _align(n: int) -> int:
+    return -n % COLUMN_ALIGN
+
+def _to_columnar(data: dict) -> dict:
+    """Converte una entry JSON (grouped_data lista di dict) nel formato colonnare."""
+    if "columns" in data:
+        return data
+    out = {k: v for k, v in data.items() if k != "grouped_data"}
+    out.setdefault("sr", 0)
+    out["columns"] = onset_columns(data.get("grouped_data"))
+    return out
+
+def write_columnar(fp: Path, data: dict):
+    scalars = {k: v for k, v in data.items() if k != "columns"}
+    arrays, layout, offset = [], {}, 0
+    for name, col in data["columns"].items():
+        dtype = np.dtype(ONSET_COLUMNS.get(name, np.asarray(col).dtype)).newbyteorder("<")
+        arr = np.ascontiguousarray(col, dtype=dtype).ravel()
+        offset += _align(offset)
+        layout[name] = dict(dtype=dtype.str, offset=offset, count=int(arr.size))
+        arrays.append((offset, arr))
+        offset += arr.nbytes
+    header = json.dumps(dict(scalars, columns=layout),
+                        default=lambda o: o.item()).encode()
+    header += b" " * _align(len(COLUMNAR_MAGIC) + 8 + len(header))
+    with open(fp, "wb") as f:
+        f.write(COLUMNAR_MAGIC + struct.pack("<II", COLUMNAR_VERSION, len(header)) + header)
+        pos = 0
+        for off, arr in arrays:
+            f.write(b"\0" * (off - pos))
+            f.write(arr.tobytes())
+            pos = off + arr.nbytes
+
+def read_columnar(fp: Path):
+    """Ritorna il dict della entry con colonne mmap read-only, o None se non valida."""
+    with open(fp, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        prefix = len(COLUMNAR_MAGIC) + 8
+        if len(mm) < prefix or mm[:4] != COLUMNAR_MAGIC:
+            mm.close()
+            return None
+        version, hlen = struct.unpack_from("<II", mm, 4)
+        if version != COLUMNAR_VERSION:
+            mm.close()
+            return None
+        data = json.loads(mm[prefix:prefix + hlen])
+        base = prefix + hlen
+        data["columns"] = {
+            name: np.frombuffer(mm, dtype=c["dtype"], count=c["count"], offset=base + c["offset"])
+            for name, c in data["columns"].items()
+        }
+    except Exception:
+        # Nessuna vista creata (frombuffer fallito prima del dict): la mappa si può chiudere
+        try:
+            mm.close()
+        except BufferError:
+            pass
+        raise
+    return data
+
+# ---------------------------------------
+# LETTURA / SCRITTURA
+# ---------------------------------------
+# Hit/miss e ultimo accesso vengono accumulati in memoria e scritti
+# nell'indice a gruppi (TOUCH_FLUSH_N accessi o TOUCH_FLUSH_S secondi, e
+# all'uscita): un hit non paga una transazione SQLite. Ogni lettura riuscita
+# aggiorna l'ultimo accesso (LRU); hit/miss di --cache-stats contano invece
+# una volta per analisi di file (count_lookup), non ogni stadio o verifica.
+_pending_lock = threading.Lock()
+_pending = {}   # cache dir -> dict(touch={key: [last_access, hits]}, hits=n, misses=n)
+_last_flush = time.monotonic()
+
+def _record_access(key: str | None = None, lookup: bool | None = None):
+    """key: entry letta (ultimo accesso); lookup: esito di una ricerca da contare."""
+    global _last_flush
+    with _pending_lock:
+        p = _pending.setdefault(_dir_key(),
+                                dict(touch={}, hits=0, misses=0))
+        if lookup is not None:
+            p["hits" if lookup else "misses"] += 1
+        if key is not None:
+            t = p["touch"].setdefault(key, [0.0, 0])
+            t[0] = time.time()
+            t[1] += 1
+        due = (p["hits"] + p["misses"] + len(p["touch"]) >= TOUCH_FLUSH_N
+               or time.monotonic() - _last_flush > TOUCH_FLUSH_S)
+    if due:
+        flush_access()
+
+def count_lookup(hit: bool):
+    """Conta un hit o un miss per --cache-stats (una volta per analisi di file)."""
+    _record_access(lookup=hit)
+
+def flush_access():
+    """Scrive nell'indice gli accessi accumulati per la cartella cache corrente."""
+    global _last_flush
+    with _pending_lock:
+        p = _pending.pop(_dir_key(), None)
+        _last_flush = time.monotonic()
+    if not p:
+        return
+    try:
+        conn = _db()
+        with conn:
+            _bump(conn, "hits", p["hits"])
+            _bump(conn, "misses", p["misses"])
+            conn.executemany(
+                "UPDATE entries SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?",
+                [(ts, n, key) for key, (ts, n) in p["touch"].items()])
+    except Exception as e:
+        log.warning(f"Cache index update error: {e}")
+
+atexit.register(flush_access)
+
+def _legacy_lookup(path: str):
+    """
+    Entry legacy <nome>_<md5>.json con lo stesso nome stem: solo in quel
+    caso si paga una lettura MD5 del file. Ritorna (data, file) o None.
+    """
+    d = _cache_dir()
+    safe = _safe_name(path)
+    candidates = [c for c in d.glob(f"{safe}_*.json")
+                  if (m := _LEGACY_RE.match(c.name)) and m.group("safe") == safe]
+    if not candidates:
+        return None
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(4 << 20), b""):
+            h.update(chunk)
+    legacy = d / f"{safe}_{h.hexdigest()}.json"
+    if not legacy.exists():
+        return None
+    try:
+        return _to_columnar(json.loads(legacy.read_text())), legacy
+    except Exception:
+        return None
+
+def _adopt_previous(path: str, key: str):
+    """
+    Entry per file senza stadi (chiave <nome>_<hash>, .json o .mkc) o legacy
+    MD5: il risultato finale viene adottato come entry dello stadio `key`
+    e la vecchia entry eliminata.
+    """
+    conn = _db()
+    old = entry_key(path)
+    row = conn.execute("SELECT filename FROM entries WHERE key = ?", (old,)).fetchone()
+    data, src = None, None
+    if row:
+        fp = Path(CACHE_DIR, row[0])
+        try:
+            if row[0].endswith(COLUMNAR_EXT):
+                data = read_columnar(fp)
+                data["columns"] = {k: np.array(v) for k, v in data["columns"].items()}
+            else:
+                data = _to_columnar(json.loads(fp.read_text()))
+            src = fp
+        except Exception:
+            data = None
+        with conn:
+            conn.execute("DELETE FROM entries WHERE key = ?", (old,))
+    if data is None:
+        found = _legacy_lookup(path)
+        if found is None:
+            return None
+        data, src = found
+    save_stage(key, data)
+    src.unlink(missing_ok=True)
+    log.info(f"Cache migrata allo stadio {key}: {src.name}")
+    return data
+
+def load_stage(path: str, key: str, adopt_previous: bool = False):
+    """
+    Ritorna il dict salvato per la chiave di stadio (vedi stage_key) o None.
+    'columns' contiene array read-only mappati sul file di cache.
+    adopt_previous=True: su miss migra le entry per file dei formati
+    precedenti (solo per lo stadio finale, l'unico che salvavano).
+    Non conta hit/miss: lo fa chi esegue l'analisi (count_lookup).
+    """
+    conn = _db()
+    row = conn.execute("SELECT filename FROM entries WHERE key = ?", (key,)).fetchone()
+    data = None
+    if row:
+        try:
+            data = read_columnar(Path(CACHE_DIR, row[0]))
+        except Exception:
+            data = None
+    if data is None and adopt_previous:
+        data = _adopt_previous(path, key)
+    if data is not None:
+        _record_access(key)
+    return data
+
+def save_stage(key: str, data: dict):
+    try:
+        conn = _db()
+        fn = f"{key}{COLUMNAR_EXT}"
+        tmp = _cache_dir() / f".{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        write_columnar(tmp, _to_columnar(data))
+        os.replace(tmp, _cache_dir() / fn)
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries(key, filename, bytes, created, last_access, hits) "
+                "VALUES (?, ?, ?, ?, ?, 0)", (key, fn, (_cache_dir() / fn).stat().st_size, now, now))
+        evict()
+    except Exception as e:
+        log.warning(f"Cache write error: {e}")
+
+# ---------------------------------------
+# EVICTION / SWEEP
+# ---------------------------------------
+def _total_bytes(conn) -> int:
+    return conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+
+def evict(max_bytes: int | None = None) -> int:
+    """Elimina le entry meno usate di recente finché la cache sta nel limite."""
+    limit = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    flush_access()
+    conn = _db()
+    total = _total_bytes(conn)
+    if limit <= 0 or total <= limit:
+        return 0
+    target = int(limit * EVICT_TARGET)
+    removed = 0
+    rows = conn.execute("SELECT key, filename, bytes FROM entries ORDER BY last_access").fetchall()
+    with conn:
+        for key, fn, nbytes in rows:
+            if total <= target:
+                break
+            (_cache_dir() / fn).unlink(missing_ok=True)
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= nbytes or 0
+            removed += 1
+        _bump(conn, "evictions", removed)
+    log.info(f"Cache: {removed} entry rimosse (LRU), ora {total / (1024 * 1024):.1f} MB")
+    return removed
+
+def _is_own_file(name: str, path: Path) -> bool:
+    if name.startswith(INDEX_NAME):
+        return True
+    # Scritture in corso (altri processi): il .tmp, o il file già rinominato
+    # da save_stage ma non ancora indicizzato. Solo se recenti.
+    try:
+        return time.time() - path.stat().st_mtime < SWEEP_INTERVAL_S
+    except FileNotFoundError:
+        return True
+
+def sweep_orphans() -> dict:
+    """
+    Rimuove:
+      - righe entries il cui file non esiste più;
+      - file non indicizzati più vecchi di SWEEP_INTERVAL_S (escluse entry
+        legacy, migrate alla lettura): i più recenti possono essere di una
+        save_stage che non ha ancora scritto la riga, anche se entries è
+        letta prima di elencare la cartella;
+      - righe files di sorgenti che non esistono più.
+    """
+    conn = _db()
+    d = _cache_dir()
+    known = {}
+    for key, fn in conn.execute("SELECT key, filename FROM entries"):
+        known[fn] = key
+    on_disk = {p.name for p in d.iterdir() if p.is_file()}
+    dead_rows = [known[fn] for fn in known if fn not in on_disk]
+    stray = [n for n in on_disk
+             if n not in known and not _is_own_file(n, d / n) and not _LEGACY_RE.match(n)]
+    gone = [p for (p,) in conn.execute("SELECT path FROM files") if not os.path.exists(p)]
+    with conn:
+        conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in dead_rows])
+        conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in gone])
+        conn.execute("INSERT OR REPLACE INTO counters(name, value) VALUES ('last_sweep', ?)",
+                     (int(time.time()),))
+    for n in stray:
+        (d / n).unlink(missing_ok=True)
+    res = dict(dead_rows=len(dead_rows), stray_files=len(stray), gone_sources=len(gone))
+    if any(res.values()):
+        log.info(f"Cache sweep: {res}")
+    return res
+
+def _maybe_sweep(conn):
+    row = conn.execute("SELECT value FROM counters WHERE name = 'last_sweep'").fetchone()
+    if row is None or time.time() - row[0] > SWEEP_INTERVAL_S:
+        try:
+            sweep_orphans()
+        except Exception as e:
+            log.warning(f"Cache sweep error: {e}")
+
+# ---------------------------------------
+# STATISTICHE / PULIZIA
+# ---------------------------------------
+def cache_stats() -> dict:
+    flush_access()
+    conn = _db()
+    d = _cache_dir()
+    counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+    hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+    n_entries, entry_bytes = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM entries").fetchone()
+    disk = sum(p.stat().st_size for p in d.iterdir() if p.is_file())
+    legacy = sum(1 for p in d.iterdir() if _LEGACY_RE.match(p.name))
+    return dict(
+        cache_dir=str(d.resolve()),
+        entries=n_entries,
+        entry_bytes=entry_bytes,
+        disk_bytes=disk,
+        max_bytes=CACHE_MAX_BYTES,
+        indexed_sources=conn.execute("SELECT COUNT(*) FROM files").fetchone()[0],
+        legacy_entries=legacy,
+        hits=hits,
+        misses=misses,
+        hit_rate=hits / (hits + misses) if hits + misses else 0.0,
+        evictions=counters.get("evictions", 0),
+        hash="xxh3" if xxhash else "blake2b",
+    )
+
+def clear_cache():
+    import shutil
+    with _pending_lock:
+        _pending.pop(_dir_key(), None)
+    _close_all()
+    _swept.discard(_dir_key())
+    p = Path(CACHE_DIR)
+    if p.exists():
+        shutil.rmtree(p)
+        log.info("Cache pulita")
+    else:
+        log.info("Cache già vuota")
@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+analysis_engine.py
+
+Motore di analisi condiviso da:
+  - ambisonics_automation.py (CLI / batch)
+  - analize_onsets_simple.py (server OSC)
+
+stage_params descrive i parametri di ogni stadio (chiavi della cache per
+stadio, vedi analysis_cache.stage_key).
+
+resample_audio porta la stem a un sample rate di analisi più basso (es.
+22050 o 16000 Hz: il contenuto utile finisce a 8 kHz) con un filtro
+polifase a fase lineare e ritardo compensato: il campione k vale k / sr
+secondi anche dopo il ricampionamento, quindi tempi degli onset,
+attack/release (s) e centroide (Hz) restano in unità della sorgente.
+analysis_frames scala hop e finestra STFT con il sample rate di analisi,
+così frame e griglia del tempo durano quanto a REFERENCE_SR.
+
+StemContext raccoglie i calcoli spettrali di una stem e li esegue una volta
+sola, al primo utilizzo:
+  - mel-spettrogramma in dB: base comune dell'onset envelope usato sia dal
+    beat tracking (aggregazione mediana, come librosa.beat.beat_track) sia
+    dall'onset detection (media, come librosa.onset.onset_detect);
+  - segnale filtrato passa-banda 50 Hz–8 kHz, envelope (rettifica + LP 15 Hz),
+    magnitudo STFT del filtrato e curva del centroide spettrale per frame,
+    ognuno sul backend configurato per lo stadio (compute_backends: numpy
+    di default, torch con dati residenti sul device).
+
+batch_spectral esegue gli stadi filter/stft/centroid di più stem in un
+solo array (B, N), a gruppi entro un budget di memoria, e riempie le
+proprietà dei rispettivi StemContext.
+
+segment_envelope_features calcola attack/release/velocity/centroide medio
+di tutti gli onset in blocco (riduzioni per segmento), senza loop Python
+per onset. La tabella degli onset resta in colonne (ONSET_COLUMNS) dalla
+cache fino all'export; rolling_mean è la media retroattiva dell'export.
+
+I risultati sono identici alle chiamate librosa con y=..., ma il mel
+spettrogramma viene calcolato una volta invece di due.
+
+scipy.signal (~1 s di import) e i sottomoduli di librosa si caricano al
+primo uso: importare il motore (es. per --clear-cache) non li paga.
+"""
+
+import os
+import sys
+from functools import cached_property, lru_cache
+from pathlib import Path
+
+import numpy as np
+import librosa
+
+from compute_backends import backend_for, to_host
+
+HOP_LENGTH = 512
+N_FFT = 2048
+REFERENCE_SR = 44100          # sr per cui sono pensati HOP_LENGTH / N_FFT (analysis_frames)
+MAX_WIN_S = 0.5               # finestra massima di analisi dopo ogni onset
+SEGMENT_BLOCK = 1 << 20       # campioni di envelope elaborati per blocco
+TEMPO_CHUNK = 4096            # frame per blocco di tempogram (stima del tempo)
+BATCH_BYTES_PER_SAMPLE = 120  # picco di memoria di filter+stft+centroid per campione (batch)
+NUMBA_CACHE_DIR = Path.home() / ".cache" / "milkydj" / "numba"
+
+# Filtri (segnale per envelope/centroide)
+BAND_LOW_HZ = 50.0
+BAND_HIGH_HZ = 8000.0
+ENVELOPE_LP_HZ = 15.0
+FILTER_ORDER = 4
+
+# Velocity = 1 - (ATTACK_WEIGHT*attack_norm + RELEASE_WEIGHT*release_norm)
+ATTACK_NORM_S = 0.1           # attack >= 100 ms -> attack_norm = 1
+RELEASE_NORM_S = 0.5          # release >= 500 ms -> release_norm = 1
+ATTACK_WEIGHT = 0.3
+RELEASE_WEIGHT = 0.7
+RELEASE_LEVEL = 0.5           # fine release: primo campione sotto RELEASE_LEVEL * picco
+
+# Colonne della tabella onset (grouped_data) e dtype usati nella cache binaria
+ONSET_COLUMNS = {
+    "onset_time": np.float32,
+    "beat_index": np.int32,
+    "beat_position": np.float32,
+    "beat_fraction": np.float32,
+    "attack_time": np.float32,
+    "release_time": np.float32,
+    "velocity_value": np.float32,
+    "spectral_mean_freq": np.float32,
+}
+
+def stage_params(hop_length=HOP_LENGTH, n_fft=N_FFT, analysis_sr=None) -> dict:
+    """
+    Parametri che determinano il risultato di ogni stadio (decode, beats,
+    onsets, features): entrano nelle chiavi della cache per stadio, quindi
+    cambiarne uno invalida solo quello stadio e quelli a valle.
+    "v" va incrementato quando cambia l'algoritmo di uno stadio.
+    analysis_sr: sample rate di analisi se il file viene ricampionato
+    (None = nativo, chiavi invariate).
+    """
+    decode = dict(sr="native", mono=True, normalize="peak")
+    if analysis_sr:
+        decode = dict(decode, sr=int(analysis_sr), resample="polyphase")
+    spec = dict(decode=decode, hop_length=hop_length, n_fft=n_fft,
+                librosa=librosa.__version__)
+    return dict(
+        decode=decode,
+        beats=dict(spec, onset_aggregate="median", trim=False, v=1),
+        onsets=dict(spec, onset_aggregate="mean", backtrack=True, v=1),
+        features=dict(
+            spec,
+            band_hz=[BAND_LOW_HZ, BAND_HIGH_HZ], envelope_lp_hz=ENVELOPE_LP_HZ,
+            filter_order=FILTER_ORDER, max_win_s=MAX_WIN_S,
+            attack_norm_s=ATTACK_NORM_S, release_norm_s=RELEASE_NORM_S,
+            attack_weight=ATTACK_WEIGHT, release_weight=RELEASE_WEIGHT,
+            release_level=RELEASE_LEVEL, v=1,
+        ),
+    )
+
+def enable_numba_cache(cache_dir=NUMBA_CACHE_DIR) -> bool:
+    """
+    Cache su disco delle funzioni numba di librosa (jit cache=True) in una
+    cartella scrivibile, anche con site-packages in sola lettura. Da
+    chiamare all'avvio, prima che librosa importi numba; NUMBA_CACHE_DIR
+    già impostata nell'ambiente ha la precedenza. False se troppo tardi.
+    """
+    if "numba" in sys.modules:
+        return False
+    os.environ.setdefault("NUMBA_CACHE_DIR", str(cache_dir))
+    return True
+
+def onset_columns(grouped) -> dict:
+    """
+    Normalizza grouped_data in colonne (nome -> array 1-D).
+    Accetta sia il formato colonnare sia la vecchia lista di dict
+    (entry JSON della cache, client esterni).
+    """
+    if isinstance(grouped, dict):
+        return grouped
+    grouped = grouped or []
+    return {name: np.array([g[name] for g in grouped], dtype=dtype)
+            for name, dtype in ONSET_COLUMNS.items()}
+
+def rolling_mean(x, window: int):
+    """
+    Media retroattiva su window valori (i primi window-1 mediano su quelli
+    disponibili) da una somma cumulativa: O(n) per qualunque finestra.
+    Accumula in float64 e ritorna il dtype di x.
+    """
+    x = np.asarray(x)
+    if x.size == 0:
+        return x.copy()
+    c = np.concatenate(([0.0], np.cumsum(x, dtype=np.float64)))
+    i = np.arange(1, x.size + 1)
+    s = np.maximum(i - window, 0)
+    return ((c[i] - c[s]) / (i - s)).astype(x.dtype)
+
+# ---------------------------------------
+# RICAMPIONAMENTO
+# ---------------------------------------
+def resample_audio(y, sr, target_sr=None):
+    """
+    Ricampiona y (mono) a target_sr con scipy.signal.resample_poly (rapporto
+    up/down ridotto, FIR Kaiser a fase lineare, ritardo compensato). Solo
+    verso il basso: con target_sr None o >= sr ritorna y invariato.
+    Ritorna (y float32, sr).
+    """
+    if not target_sr or target_sr >= sr:
+        return y, sr
+    from math import gcd
+    from scipy.signal import resample_poly
+    g = gcd(int(sr), int(target_sr))
+    y = resample_poly(y, int(target_sr) // g, int(sr) // g)
+    return np.ascontiguousarray(y, dtype=np.float32), int(target_sr)
+
+def analysis_frames(analysis_sr=None) -> dict:
+    """
+    hop_length / n_fft per l'analisi a analysis_sr: stessa durata in secondi
+    di HOP_LENGTH / N_FFT a REFERENCE_SR (22050 Hz -> 256 / 1024), quindi
+    stessa risoluzione di onset e tempo. None: HOP_LENGTH / N_FFT.
+    """
+    if not analysis_sr:
+        return dict(hop_length=HOP_LENGTH, n_fft=N_FFT)
+    scale = analysis_sr / REFERENCE_SR
+    return dict(hop_length=max(1, round(HOP_LENGTH * scale)),
+                n_fft=2 * max(1, round(N_FFT * scale / 2)))
+
+# ---------------------------------------
+# FILTRI
+# ---------------------------------------
+@lru_cache(maxsize=8)
+def band_filter(sr, low_hz=BAND_LOW_HZ, high_hz=BAND_HIGH_HZ, order=FILTER_ORDER):
+    from scipy.signal import butter
+    ny = sr / 2
+    low = min(low_hz / ny, 0.99)
+    high = min(high_hz / ny, 0.99)
+    return butter(order, [low, high], btype="band", output="sos")
+
+@lru_cache(maxsize=8)
+def lowpass_filter(sr, cutoff_hz=ENVELOPE_LP_HZ, order=FILTER_ORDER):
+    from scipy.signal import butter
+    ny = sr / 2
+    cutoff = min(cutoff_hz / ny, 0.99)
+    return butter(order, cutoff, btype="low", output="sos")
+
+# ---------------------------------------
+# BEAT / ONSET DA CURVE PER FRAME
+# ---------------------------------------
+def estimate_tempo(onset_env, sr, hop_length=HOP_LENGTH, start_bpm=120.0, std_bpm=1.0,
+                   ac_size=8.0, max_tempo=320.0, chunk=TEMPO_CHUNK):
+    """
+    Tempo globale come librosa.feature.tempo (media del tempogram), con il
+    tempogram calcolato a blocchi di `chunk` frame: memoria O(win * chunk)
+    invece di O(win * frame totali) (~170 MB per minuto di audio a 44.1 kHz).
+    """
+    win = librosa.time_to_frames(ac_size, sr=sr, hop_length=hop_length).item()
+    n = onset_env.shape[-1]
+    # Stesso padding di tempogram(center=True); ogni blocco usa center=False
+    padded = np.pad(onset_env, win // 2, mode="linear_ramp", end_values=[0, 0])
+    acc = np.zeros(win)
+    for a in range(0, n, chunk):
+        b = min(n, a + chunk)
+        tg = librosa.feature.tempogram(onset_envelope=padded[a:b + win - 1], sr=sr,
+                                       hop_length=hop_length, win_length=win, center=False)
+        acc += tg.sum(axis=-1)
+    tg = acc / max(n, 1)
+
+    bpms = librosa.tempo_frequencies(win, hop_length=hop_length, sr=sr)
+    with np.errstate(divide="ignore"):
+        logprior = -0.5 * ((np.log2(bpms) - np.log2(start_bpm)) / std_bpm) ** 2
+    logprior[:int(np.argmax(bpms < max_tempo))] = -np.inf
+    return float(bpms[np.argmax(np.log1p(1e6 * tg) + logprior)])
+
+def beat_track_env(beat_env, sr, hop_length=HOP_LENGTH):
+    """Beat tracking sulla onset envelope (mediana). Ritorna (bpm, beat_frames)."""
+    tempo = estimate_tempo(beat_env, sr, hop_length) if beat_env.any() else None
+    tempo, beat_frames = librosa.beat.beat_track(
+        onset_envelope=beat_env, sr=sr, hop_length=hop_length, bpm=tempo, trim=False
+    )
+    if np.ndim(tempo) > 0:
+        tempo = tempo.item()  # librosa >= 0.10 ritorna un array
+    bpm = float(tempo) if np.isfinite(tempo) and tempo > 0 else 0.0
+    return bpm, beat_frames
+
+def detect_onsets(onset_env, sr, hop_length=HOP_LENGTH):
+    """Onset (in campioni, con backtrack) dalla onset envelope (media)."""
+    return librosa.onset.onset_detect(
+        onset_envelope=onset_env, sr=sr, hop_length=hop_length,
+        units="samples", backtrack=True
+    )
+
+# ---------------------------------------
+# CONTESTO PER STEM
+# ---------------------------------------
+class StemContext:
+    """
+    Stato di analisi di una stem (y mono già normalizzata, sr nativo).
+    Ogni proprietà è calcolata pigramente e poi riusata da tutti gli stadi.
+    """
+
+    def __init__(self, y, sr, hop_length=HOP_LENGTH, n_fft=N_FFT):
+        self.y = y
+        self.sr = sr
+        self.hop_length = hop_length
+        self.n_fft = n_fft
+
+    @classmethod
+    def from_audio(cls, y, sr, **kw):
+        """Normalizza (peak) e costruisce il contesto."""
+        if y.size and np.abs(y).max() > 0:
+            y = librosa.util.normalize(y)
+        return cls(y, sr, **kw)
+
+    # --- Onset envelope (mel) ---
+    @cached_property
+    def mel_db(self):
+        S = np.abs(librosa.feature.melspectrogram(
+            y=self.y, sr=self.sr, n_fft=self.n_fft, hop_length=self.hop_length
+        ))
+        return librosa.power_to_db(S)
+
+    @cached_property
+    def onset_env(self):
+        """Onset strength (media sui mel), come onset_detect(y=...)."""
+        return librosa.onset.onset_strength(
+            S=self.mel_db, sr=self.sr, n_fft=self.n_fft, hop_length=self.hop_length
+        )
+
+    @cached_property
+    def beat_env(self):
+        """Onset strength (mediana sui mel), come beat_track(y=...)."""
+        return librosa.onset.onset_strength(
+            S=self.mel_db, sr=self.sr, n_fft=self.n_fft, hop_length=self.hop_length,
+            aggregate=np.median
+        )
+
+    def beat_track(self):
+        """Ritorna (bpm, beat_frames)."""
+        return beat_track_env(self.beat_env, self.sr, self.hop_length)
+
+    def onset_samples(self):
+        return detect_onsets(self.onset_env, self.sr, self.hop_length)
+
+    # --- Envelope / spettro del segnale filtrato ---
+    # Risultati intermedi nel formato del backend dello stadio (array numpy o
+    # tensori sul device): all'host tornano solo envelope e centroide.
+    @cached_property
+    def filtered(self):
+        """(segnale filtrato, envelope normalizzato) dallo stadio filter."""
+        return backend_for("filter").filter(self.y, band_filter(self.sr), lowpass_filter(self.sr))
+
+    @property
+    def y_filtered(self):
+        return self.filtered[0]
+
+    @cached_property
+    def envelope(self):
+        return to_host(self.filtered[1])
+
+    @cached_property
+    def spectrum(self):
+        """Magnitudo STFT del segnale filtrato (freq_bins, frames)."""
+        be = backend_for("stft")
+        return be.stft(be.asarray(self.y_filtered), self.n_fft, self.hop_length)
+
+    @cached_property
+    def fft_freqs(self):
+        return librosa.fft_frequencies(sr=self.sr, n_fft=self.n_fft)
+
+    @cached_property
+    def centroid_curve(self):
+        """
+        Centroide spettrale per frame del segnale filtrato.
+        Ritorna (centroid, valid): valid=False sui frame a energia nulla.
+        """
+        be = backend_for("centroid")
+        centroid, valid = be.centroid(be.asarray(self.spectrum), self.fft_freqs)
+        return to_host(centroid), to_host(valid)
+
+# ---------------------------------------
+# STADI SPETTRALI IN BATCH (PIÙ STEM)
+# ---------------------------------------
+def plan_batches(lengths, srs, budget_bytes, bytes_per_sample=BATCH_BYTES_PER_SAMPLE):
+    """
+    Raggruppa le stem (indici) per batch_spectral: stesso sr, ordinate per
+    lunghezza (poco padding), al più budget_bytes stimati sul batch con
+    padding alla stem più lunga. Una stem che da sola supera il budget
+    forma un batch da sola.
+    """
+    batches = []
+    for sr in sorted(set(srs)):
+        idx = sorted((i for i, s in enumerate(srs) if s == sr), key=lambda i: lengths[i])
+        cur = []
+        for i in idx:
+            # Ordinate per lunghezza: l'ultima aggiunta è la più lunga
+            if cur and (len(cur) + 1) * lengths[i] * bytes_per_sample > budget_bytes:
+                batches.append(cur)
+                cur = []
+            cur.append(i)
+        if cur:
+            batches.append(cur)
+    return batches
+
+def batch_spectral(contexts, budget_bytes):
+    """
+    Calcola envelope e curva del centroide di più StemContext impilando le
+    stem in un array (B, N) con padding a zeri: una chiamata per stadio
+    (filter, stft, centroid) invece di una per stem. I risultati, separati
+    per stem, riempiono le cached_property envelope e centroid_curve, con
+    gli stessi valori del calcolo singolo. Ritorna il numero di batch.
+    """
+    contexts = [c for c in contexts if c.y.size]
+    batches = plan_batches([c.y.size for c in contexts], [c.sr for c in contexts], budget_bytes)
+    for batch in batches:
+        group = [contexts[i] for i in batch]
+        sr, hop, n_fft = group[0].sr, group[0].hop_length, group[0].n_fft
+        lengths = [c.y.size for c in group]
+        Y = np.zeros((len(group), max(lengths)), dtype=np.result_type(*(c.y for c in group)))
+        for row, c in enumerate(group):
+            Y[row, :c.y.size] = c.y
+
+        yf, env = backend_for("filter").filter(Y, band_filter(sr), lowpass_filter(sr), lengths)
+        del Y
+        be = backend_for("stft")
+        S = be.stft(be.asarray(yf), n_fft, hop)
+        del yf
+        frames = [1 + n // hop for n in lengths]
+        be = backend_for("centroid")
+        centroid, valid = be.centroid(be.asarray(S), group[0].fft_freqs, frames)
+        del S
+        env, centroid, valid = to_host(env), to_host(centroid), to_host(valid)
+
+        for row, c in enumerate(group):
+            n = lengths[row]
+            # Copie: le viste terrebbero in vita l'intero batch
+            c.__dict__["envelope"] = env[row, :n].copy()
+            c.__dict__["centroid_curve"] = (centroid[row, :frames[row]].copy(),
+                                            valid[row, :frames[row]].copy())
+    return len(batches)
+
+# ---------------------------------------
+# FEATURES PER ONSET (VETTORIZZATE)
+# ---------------------------------------
+def _segment_blocks(starts, ends, budget):
+    """Divide segmenti ordinati in blocchi che coprono al più ~budget campioni."""
+    a, m = 0, starts.size
+    while a < m:
+        b = int(np.searchsorted(ends, starts[a] + budget, side="right"))
+        b = max(b, a + 1)
+        yield a, b
+        a = b
+
+def segment_envelope_features(env, onset_samples, sr, centroid, centroid_valid=None,
+                              hop_length=HOP_LENGTH, min_len=1, max_win_s=MAX_WIN_S, offset=0,
+                              block=SEGMENT_BLOCK, release_level=RELEASE_LEVEL,
+                              attack_norm_s=ATTACK_NORM_S, release_norm_s=RELEASE_NORM_S,
+                              attack_weight=ATTACK_WEIGHT, release_weight=RELEASE_WEIGHT):
+    """
+    Features di tutti gli onset con riduzioni per segmento.
+    Finestra dell'onset i: [onset_i, min(onset_i + max_win, onset_{i+1}, len(env))).
+      - attack: posizione del picco dell'envelope nella finestra (s)
+      - release: dal picco al primo campione sotto release_level * picco (s),
+        o fine finestra
+      - velocity: 1 - (attack_weight*attack/attack_norm_s
+                       + release_weight*release/release_norm_s), termini in [0, 1]
+      - spectral_mean_freq: media della curva centroid sui frame della finestra
+        (solo frame validi se centroid_valid è dato)
+    Finestre vuote: tutto a 0. Finestre più corte di min_len: centroide
+    calcolato, attack/release/velocity a 0.
+    Le finestre non si sovrappongono: il picco si ottiene con maximum.reduceat,
+    argmax e primo campione sotto soglia con searchsorted sulle posizioni
+    che soddisfano la condizione, a blocchi di `block` campioni.
+    offset: posizione assoluta (campioni) di env[0] quando env è un blocco
+    di un flusso; onset relativi al blocco, curva centroid per frame assoluti.
+    Ritorna dict di array float64 (una voce per onset).
+    """
+    onsets = np.asarray(onset_samples, dtype=np.int64).ravel()
+    k = onsets.size
+    attack = np.zeros(k)
+    release = np.zeros(k)
+    velocity = np.zeros(k)
+    cmean = np.zeros(k)
+    out = dict(attack_time=attack, release_time=release,
+               velocity_value=velocity, spectral_mean_freq=cmean)
+    if k == 0:
+        return out
+
+    n = env.shape[0]
+    max_win = int(max_win_s * sr)
+    nxt = np.append(onsets[1:], n)
+    ends = np.minimum(np.minimum(onsets + max_win, nxt), n)
+    lengths = ends - onsets
+    nonempty = lengths > 0
+
+    # --- Centroide medio: somme per segmento sulla curva per frame ---
+    n_frames = centroid.shape[0]
+    if n_frames > 0:
+        f0 = np.minimum((onsets + offset) // hop_length, n_frames - 1)
+        f1 = np.minimum(np.maximum((ends + offset) // hop_length, f0 + 1), n_frames)
+        if centroid_valid is None:
+            vals = np.asarray(centroid, dtype=np.float64)
+            cnts = (f1 - f0).astype(np.float64)
+        else:
+            vals = np.where(centroid_valid, centroid, 0.0)
+            cnts = np.add.reduceat(np.append(centroid_valid.astype(np.float64), 0.0),
+                                   np.column_stack([f0, f1]).ravel())[::2]
+        # Elemento extra in coda: f1 può valere n_frames (indice di reduceat)
+        sums = np.add.reduceat(np.append(vals, 0.0), np.column_stack([f0, f1]).ravel())[::2]
+        np.divide(sums, cnts, out=cmean, where=(cnts > 0) & nonempty)
+
+    # --- Picco / attack / release per segmento ---
+    segs = np.flatnonzero(nonempty & (lengths >= min_len))
+    if segs.size == 0:
+        return out
+    seg_starts = onsets[segs]
+    seg_ends = ends[segs]
+
+    for a, b in _segment_blocks(seg_starts, seg_ends, block):
+        base, top = int(seg_starts[a]), int(seg_ends[b - 1])
+        local = env[base:top]
+        s = seg_starts[a:b] - base
+        e = seg_ends[a:b] - base
+        m = b - a
+
+        # Pezzi alternati buco/segmento: [0,s0) [s0,e0) [e0,s1) [s1,e1) ...
+        bounds = np.column_stack([s, e]).ravel()
+        pieces = np.diff(np.concatenate(([0], bounds)))
+        piece_vals = np.empty(pieces.size)
+
+        # Massimo per segmento (bounds[-1] == len(local): l'ultimo va fino in fondo)
+        pmax = np.maximum.reduceat(local, bounds[:-1])[::2]
+
+        # Primo indice del massimo (come argmax): prima uguaglianza dopo l'inizio
+        piece_vals[0::2] = np.inf
+        piece_vals[1::2] = pmax
+        hit = np.flatnonzero(local == np.repeat(piece_vals, pieces))
+        peak = hit[np.searchsorted(hit, s)]
+
+        # Release: primo campione sotto soglia a partire dal picco
+        piece_vals[0::2] = -np.inf
+        piece_vals[1::2] = release_level * pmax
+        below = np.flatnonzero(local < np.repeat(piece_vals, pieces))
+        q = np.searchsorted(below, peak)
+        first = below[np.minimum(q, below.size - 1)] if below.size else e
+        rel = np.where((q < below.size) & (first < e), first - peak, e - peak)
+
+        idx = segs[a:b]
+        attack[idx] = (peak - s) / sr
+        release[idx] = rel / sr
+
+    a_norm = np.clip(attack[segs] / attack_norm_s, 0, 1)
+    r_norm = np.clip(release[segs] / release_norm_s, 0, 1)
+    velocity[segs] = 1.0 - (attack_weight * a_norm + release_weight * r_norm)
+    return out
+
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+analysis_jobs.py
+
+Coda unica dei job di analisi per il server OSC (analize_onsets_simple.py).
+
+- Ogni richiesta (/analyze_folder, /analyze_file) diventa un Batch di file;
+  ogni file è un AnalysisJob in una asyncio.PriorityQueue. Priorità più
+  bassa = prima: la traccia caricata su un deck (PRIORITY_DECK) passa
+  davanti alle scansioni di cartelle in background (PRIORITY_SCAN).
+- Richieste duplicate per lo stesso file (in coda o in corso) vengono unite
+  in un solo job; se la nuova richiesta ha priorità più alta il job sale in
+  coda.
+- cancel(target) annulla una richiesta (il batch più vecchio con quel
+  nome, file o cartella): i job che nessun altro batch richiede vengono
+  scartati se in coda, quello in corso si ferma al prossimo check_cancel.
+- prepare(paths, cancel), se data, riceve il file in partenza e quelli
+  ancora in coda dello stesso batch: il server ne calcola insieme gli
+  stadi spettrali (analysis_pipeline.prepare_batch) e i job successivi
+  trovano il lavoro già fatto.
+- L'analisi gira in un ThreadPoolExecutor (un worker: un solo acceleratore),
+  il loop OSC resta libero per nuovi messaggi, ack e cancellazioni.
+- Attesa in coda (queue_wait) e durata complessiva (job_total) di ogni job
+  sono stadi di tracing; stats() riporta job in coda e in corso
+  (/analysis/metrics del server).
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tracing
+
+PRIORITY_DECK = 0         # traccia caricata su un deck
+PRIORITY_FILE = 5         # /analyze_file senza priorità esplicita
+PRIORITY_SCAN = 10        # /analyze_folder senza priorità esplicita
+
+class JobCancelled(Exception):
+    """Sollevata da check_cancel quando il job è stato annullato."""
+
+def check_cancel(cancel):
+    """Punto di interruzione tra le fasi dell'analisi."""
+    if cancel is not None and cancel.is_set():
+        raise JobCancelled()
+
+def _key(path: str) -> str:
+    return os.path.realpath(path)
+
+# ---------------------------------------
+# JOB E BATCH
+# ---------------------------------------
+class Batch:
+    """Una richiesta OSC: cartella (folder=True) o singolo file."""
+
+    def __init__(self, name: str, paths: list, folder: bool):
+        self.name = name
+        self.paths = paths
+        self.folder = folder
+        self.pending = set(_key(p) for p in paths)
+        self.bpms = []
+        self.n_ok = 0
+        self.cancelled = False
+
+    def position(self, key: str):
+        keys = [_key(p) for p in self.paths]
+        return (keys.index(key) + 1 if key in keys else 1), len(self.paths)
+
+class AnalysisJob:
+    """Analisi di un file, condivisa da tutti i batch che la richiedono."""
+
+    def __init__(self, path: str, priority: int):
+        self.path = path
+        self.key = _key(path)
+        self.name = os.path.basename(path)
+        self.priority = priority
+        self.batches = []
+        self.cancel = threading.Event()
+        self.state = "queued"        # queued | running | done
+        self.t_submit = time.perf_counter_ns()
+
+# ---------------------------------------
+# CODA
+# ---------------------------------------
+class JobQueue:
+    """
+    run(path, cancel) -> (ok, bpm) esegue l'analisi nel thread dell'executor;
+    send(address, *args) invia i messaggi di stato a SuperCollider;
+    prepare(paths, cancel) -> file preparati (opzionale, stesso thread).
+    """
+
+    def __init__(self, run, send, workers: int = 1, log=print, prepare=None):
+        self.run = run
+        self.send = send
+        self.prepare = prepare
+        self._prepared = set()       # chiavi dei file dell'ultimo prepare
+        self.workers = workers
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis")
+        self.jobs = {}               # chiave file -> job in coda o in corso
+        self.batches = []
+        self.queue = None
+        self._order = itertools.count()
+        self._tasks = []
+
+    def start(self):
+        """Crea la coda e i worker nel loop corrente."""
+        self.queue = asyncio.PriorityQueue()
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def join(self):
+        await asyncio.gather(*self._tasks)
+
+    def _push(self, job):
+        self.queue.put_nowait((job.priority, next(self._order), job))
+
+    def stats(self) -> dict:
+        """Job in coda e in corso, batch aperti."""
+        states = [job.state for job in self.jobs.values()]
+        return dict(queued=states.count("queued"), running=states.count("running"),
+                    batches=len(self.batches))
+
+    def active(self, path: str) -> bool:
+        """True se path ha un job in coda o in corso non annullato."""
+        job = self.jobs.get(_key(path))
+        return job is not None and not job.cancel.is_set()
+
+    # --- richieste ---
+    def submit(self, name: str, paths: list, priority: int, folder: bool) -> Batch:
+        batch = Batch(name, paths, folder)
+        self.batches.append(batch)
+        self.send("/analysis/start", len(paths), name)
+        for p in paths:
+            key = _key(p)
+            job = self.jobs.get(key)
+            if job is None or job.cancel.is_set():
+                # Un job annullato ma ancora in corso non risponde a una nuova richiesta
+                job = self.jobs[key] = AnalysisJob(p, priority)
+                self._push(job)
+            elif job.state == "queued" and priority < job.priority:
+                # Duplicato più urgente: la vecchia voce in coda viene ignorata
+                job.priority = priority
+                self._push(job)
+            if batch not in job.batches:
+                job.batches.append(batch)
+        self.log(f"📥 {name}: {len(paths)} file in coda (priorità {priority}, "
+                 f"{len(self.jobs)} job attivi)")
+        return batch
+
+    def cancel(self, target: str) -> int:
+        """
+        Annulla una richiesta per target (cartella o file): stacca il batch
+        più vecchio con quel nome, così un secondo deck sulla stessa traccia
+        conserva il suo. Un job si ferma solo quando nessun batch lo
+        richiede più. Ritorna il numero di job fermati.
+        """
+        key = _key(target)
+        n = 0
+        batch = next((b for b in self.batches if _key(b.name) == key), None)
+        if batch is not None:
+            batch.cancelled = True
+            self.batches.remove(batch)
+            for job in list(self.jobs.values()):
+                if batch in job.batches:
+                    job.batches.remove(batch)
+                    if not job.batches:
+                        n += self._cancel_job(job)
+            self.send("/analysis/cancelled", batch.name)
+        else:
+            # File di una cartella: fermato solo se nessun batch aperto lo richiede
+            job = self.jobs.get(key)
+            if job is not None and not job.cancel.is_set() and not job.batches:
+                if job.state == "queued":
+                    self.send("/analysis/cancelled", job.name)
+                n += self._cancel_job(job)
+        if n:
+            self.log(f"⏹ Annullati {n} job per {target}")
+        return n
+
+    def _cancel_job(self, job) -> int:
+        job.cancel.set()
+        if job.state == "queued":
+            # Mai partito: chiude subito il file per i batch rimasti
+            self._forget(job)
+            job.state = "done"
+            self._finish(job, False, 0.0)
+        return 1
+
+    # --- esecuzione ---
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, _, job = await self.queue.get()
+            if job.state != "queued" or priority != job.priority:
+                continue        # voce superata (duplicato promosso o annullato)
+            job.state = "running"
+            tracing.record("queue_wait", job.t_submit, cat="jobs", file=job.name)
+            if job.batches:
+                self.send("/analysis/file_start", job.name, *job.batches[0].position(job.key))
+            ok, bpm, cancelled = False, 0.0, False
+            try:
+                if self.prepare is not None and job.key not in self._prepared:
+                    paths = await loop.run_in_executor(self.executor, self.prepare,
+                                                       self._batch_paths(job), job.cancel)
+                    self._prepared = set(_key(p) for p in paths)
+                self._prepared.discard(job.key)
+                ok, bpm = await loop.run_in_executor(self.executor, self.run, job.path, job.cancel)
+            except JobCancelled:
+                cancelled = True
+            except Exception as e:
+                self.log(f"❌ Analisi fallita: {job.path}: {e}")
+            self._forget(job)
+            job.state = "done"
+            tracing.record("job_total", job.t_submit, cat="jobs", file=job.name, ok=ok)
+            if cancelled:
+                self.send("/analysis/cancelled", job.name)
+            else:
+                self.send("/analysis/file_end", job.name)
+            self._finish(job, ok, bpm)
+
+    def _forget(self, job):
+        """Toglie job da self.jobs, se la chiave non è già passata a un job più recente."""
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+
+    def _batch_paths(self, job) -> list:
+        """Il file del job seguito dai file ancora in coda del suo primo batch."""
+        paths = [job.path]
+        if job.batches:
+            for p in job.batches[0].paths:
+                other = self.jobs.get(_key(p))
+                if other is not None and other.state == "queued" and not other.cancel.is_set():
+                    paths.append(other.path)
+        return paths
+
+    def _finish(self, job, ok: bool, bpm: float):
+        for batch in job.batches:
+            batch.pending.discard(job.key)
+            if ok:
+                batch.n_ok += 1
+                if bpm > 0:
+                    batch.bpms.append(bpm)
+            if not batch.pending and not batch.cancelled:
+                self._end_batch(batch)
+
+    def _end_batch(self, batch):
+        if batch in self.batches:
+            self.batches.remove(batch)
+        if batch.folder:
+            gbpm = float(np.median(batch.bpms)) if batch.bpms else 0.0
+            self.log(f"✓ Global BPM: {gbpm:.1f}")
+            self.send("/analysis/global_bpm", gbpm, len(batch.bpms))
+            self.send("/analysis/end", len(batch.paths), len(batch.bpms))
+        else:
+            self.send("/analysis/end", len(batch.paths), batch.n_ok)
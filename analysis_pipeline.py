@@ -0,0 +1,537 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+analysis_pipeline.py
+
+Analisi di una stem, unica per CLI (ambisonics_automation.py) e server OSC
+(analize_onsets_simple.py).
+
+- analyze_file / analyze_audio: stadi beats -> onsets -> features ->
+  analysis con cache per stadio (analysis_cache, stessa .onset_cache/ per
+  entrambi i punti di ingresso). Una traccia preparata offline dalla CLI
+  risponde subito alle richieste della GUI, con gli stessi risultati.
+- prepare_batch: decodifica più file e ne calcola insieme gli stadi
+  spettrali (analysis_engine.batch_spectral) entro un budget di memoria;
+  analyze_audio riusa poi i contesti preparati.
+- Beat mapping: periodo = mediana delle differenze tra i beat.
+- warm_up: analisi completa di un segnale sintetico all'avvio (server),
+  così la prima richiesta non paga import e compilazione JIT.
+- prepare_json_analysis: serie esportate (JSON della CLI) e inviate a
+  SuperCollider dal server: tempi, posizioni, strength, contrast, spread.
+  Sono array calcolati in blocco sulle colonne; diventano liste solo nel
+  JSON (json_default).
+- configure_analysis_sr: analisi a un sample rate più basso del nativo
+  (es. 22050 / 16000 Hz, ricampionamento polifase dopo la decodifica,
+  hop e finestra scalati: analysis_engine.analysis_frames); gli stadi
+  salvano sr e hop di analisi, i valori esportati (s, Hz) sono nel tempo
+  della sorgente. I file in streaming restano a sr nativo.
+- song_grid: griglia dei beat unica per le stem di un brano (beat tracking
+  una volta, sulla stem drums o sulla somma delle stem); analyze_audio con
+  grid salta il proprio stadio beats e fa il beat mapping su quella
+  griglia, così le quattro stem hanno posizioni coerenti tra loro.
+- Ogni stadio è uno span di tracing (decode, beat_track, onset_detect,
+  envelope_features, beat_mapping, ...): trace Chrome della CLI e
+  /analysis/metrics del server.
+"""
+
+import logging
+import time
+from pathlib import Path
+
+import numpy as np
+import librosa
+
+from analysis_engine import (BATCH_BYTES_PER_SAMPLE, HOP_LENGTH, StemContext, analysis_frames,
+                             batch_spectral, segment_envelope_features, onset_columns,
+                             resample_audio, rolling_mean, stage_params)
+from streaming_analysis import analyze_stream, audio_info, should_stream
+from analysis_cache import load_stage, save_stage, entry_key, stage_key, count_lookup
+from tracing import span
+
+log = logging.getLogger("ambisonics.analysis")
+
+VALID_EXTENSIONS = {".wav", ".wave", ".aif", ".aiff", ".mp3", ".flac", ".ogg", ".m4a"}
+
+# Stadio "analysis" (beat mapping degli onset): periodo = mediana dei beat
+ANALYSIS_PARAMS = dict(beat_period="median_diff", v=1)
+
+# Export JSON (prepare_json_analysis): non in cache, ricalcolato dalle colonne
+SMOOTH_WINDOW = 10            # media retroattiva della velocity (onset)
+STRENGTH_GAMMA = 10.0         # onset_strength = velocity_smooth ^ gamma
+GAP_SECONDS = 2.0             # boost dopo pause lunghe...
+GAP_BEATS = 8.0               # ...o salti di posizione nella griglia
+GAP_BOOST = 0.2
+
+# Stadi spettrali in batch (prepare_batch): memoria massima per batch
+BATCH_MEMORY_MB = 1024
+
+# Warm-up (warm_up): durata e sr del segnale sintetico
+WARMUP_SECONDS = 5.0
+WARMUP_SR = 44100
+
+# Sample rate di analisi (configure_analysis_sr): None = nativo del file
+ANALYSIS_SR = None
+ANALYSIS_SR_CHOICES = (22050, 16000)    # valori consigliati (banda utile fino a 8 kHz)
+
+# Griglia dei beat (song_grid): "stem" = ogni stem la propria (default),
+# "drums" = quella della stem drums, "sum" = beat tracking sulla somma
+BEAT_GRID_MODES = ("stem", "drums", "sum")
+SONG_STEMS = ("vocals", "drums", "bass", "other")
+
+# ---------------------------------------
+# STADI CON CACHE
+# ---------------------------------------
+def configure_analysis_sr(sr=None):
+    """Imposta il sample rate di analisi (None o 0 = nativo). Ritorna il valore attivo."""
+    global ANALYSIS_SR
+    ANALYSIS_SR = int(sr) if sr else None
+    return ANALYSIS_SR
+
+def analysis_rate(path: str, streamed: bool | None = None):
+    """
+    sr a cui viene analizzato il file, se ricampionato; None = nativo
+    (nessun sr configurato, file già a sr <= ANALYSIS_SR o in streaming).
+    streamed=None: deciso da should_stream (durata).
+    """
+    if not ANALYSIS_SR:
+        return None
+    if streamed is None:
+        streamed = should_stream(path)
+    if streamed:
+        return None
+    info = audio_info(path)
+    if info is not None and info[0] <= ANALYSIS_SR:
+        return None
+    return ANALYSIS_SR
+
+def load_audio(path: str, sr=None, offset: float = 0.0, duration: float | None = None):
+    """
+    Decodifica mono a sr nativo o, con sr, ricampionata (resample_audio,
+    solo verso il basso). offset/duration (s): solo una porzione del file
+    (regioni, progressive_analysis). Ritorna (y float32, sr) o (None, None).
+    """
+    try:
+        y, native = librosa.load(path, sr=None, mono=True, offset=offset, duration=duration)
+        return resample_audio(np.ascontiguousarray(y, dtype=np.float32), native, sr)
+    except Exception:
+        return None, None
+
+def stage_keys(path: str, streamed: bool | None = None, grid_key: str | None = None) -> dict:
+    """
+    Chiavi cache degli stadi beats -> onsets -> features -> analysis per il file:
+    ognuna dipende dai parametri dello stadio e dalle chiavi a monte (compreso
+    il sample rate di analisi, vedi analysis_rate). grid_key: chiave della
+    griglia del brano (song_grid) al posto dello stadio beats della stem.
+    """
+    rate = analysis_rate(path, streamed)
+    frames = analysis_frames(rate)
+    params = stage_params(**frames, analysis_sr=rate)
+    base = entry_key(path)
+    k = {}
+    k['beats'] = stage_key(base, 'beats', params['beats'])
+    k['onsets'] = stage_key(base, 'onsets', params['onsets'])
+    k['features'] = stage_key(base, 'features', params['features'], [k['onsets']])
+    k['analysis'] = stage_key(base, 'analysis',
+                              dict(ANALYSIS_PARAMS, hop_length=frames['hop_length']),
+                              [grid_key or k['beats'], k['onsets'], k['features']])
+    return k
+
+def analysis_cached(path: str, grid=None) -> bool:
+    """True se l'analisi completa del file è già in cache (risposta immediata)."""
+    keys = stage_keys(path, grid_key=grid['key'] if grid else None)
+    return load_stage(path, keys['analysis']) is not None
+
+def cached_beats(path: str, grid=None):
+    """
+    (bpm, tempi dei beat in secondi) dallo stadio beats in cache, o None.
+    grid: griglia del brano (song_grid), usata al posto dello stadio della stem.
+    """
+    beats = grid or load_stage(path, stage_keys(path)['beats'])
+    if not beats:
+        return None
+    times = librosa.frames_to_time(beats['columns']['beat_frames'], sr=beats['sr'],
+                                   hop_length=beats.get('hop_length', HOP_LENGTH))
+    return beats['bpm'], times
+
+def envelope_features(ctx: StemContext, onset_samples):
+    """
+    Attack/release/velocity/centroide per ogni onset (dict nome -> array).
+    Calcolo vettorizzato su tutti gli onset: curva del centroide per frame
+    calcolata una volta + riduzioni per segmento (analysis_engine).
+    """
+    centroid, valid = ctx.centroid_curve
+    return segment_envelope_features(ctx.envelope, onset_samples, ctx.sr, centroid,
+                                     centroid_valid=valid, hop_length=ctx.hop_length)
+
+def analyze_file(path: str, stream: bool = False, checkpoint=None, grid=None):
+    """
+    Analizza un singolo file (usa cache se disponibile).
+    stream=True forza l'analisi a blocchi (automatica sopra STREAM_MIN_S).
+    checkpoint(): chiamata tra gli stadi, può sollevare per interrompere
+    (annullamento dei job nel server OSC).
+    grid: griglia del brano (song_grid) al posto del beat tracking della stem.
+    Ritorna: (is_valid, bpm, grouped_data)
+    grouped_data: colonne (dict nome -> array, vedi ONSET_COLUMNS) con
+    onset_time, velocity_value ecc.; da cache sono viste read-only mmap.
+    """
+    ext = Path(path).suffix.lower()
+    if ext not in VALID_EXTENSIONS or not Path(path).is_file():
+        return False, 0.0, onset_columns([])
+
+    with span("analyze_file", file=Path(path).name):
+        return analyze_audio(path, stream=stream, checkpoint=checkpoint, grid=grid)
+
+# ---------------------------------------
+# BATCH MULTI-FILE
+# ---------------------------------------
+# Contesti preparati da prepare_batch, in attesa di analyze_audio (path ->
+# StemContext). Un solo batch alla volta: il successivo scarta i rimasti.
+_prepared = {}
+
+def _needs_spectral(path: str) -> bool:
+    """True se analyze_audio dovrà decodificare e calcolare lo stadio features."""
+    if Path(path).suffix.lower() not in VALID_EXTENSIONS or not Path(path).is_file():
+        return False
+    keys = stage_keys(path)
+    if load_stage(path, keys['analysis']) or load_stage(path, keys['features']):
+        return False
+    return not should_stream(path)
+
+def prepare_batch(paths, budget_mb: float = BATCH_MEMORY_MB, checkpoint=None) -> list:
+    """
+    Prepara l'analisi di più file: decodifica quelli senza stadio features
+    in cache e ne calcola filter/stft/centroid in batch (batch_spectral),
+    prendendo i file in ordine finché la memoria stimata resta entro
+    budget_mb (almeno il primo). Le successive analyze_audio su questi
+    file riusano i contesti. Ritorna i file preparati.
+    """
+    checkpoint = checkpoint or (lambda: None)
+    _prepared.clear()
+    budget = budget_mb * 1024 * 1024
+    chosen, used = [], 0
+    for path in paths:
+        if not _needs_spectral(path):
+            continue
+        info = audio_info(path)
+        cost = (info[1] if info else 0) * BATCH_BYTES_PER_SAMPLE
+        if chosen and (info is None or used + cost > budget):
+            break
+        chosen.append(path)
+        used += cost
+
+    contexts = {}
+    for path in chosen:
+        rate = analysis_rate(path, False)
+        with span("decode", file=Path(path).name):
+            y, sr = load_audio(path, rate)
+            if y is not None and y.size:
+                contexts[path] = StemContext.from_audio(y, sr, **analysis_frames(rate))
+        checkpoint()
+    if len(contexts) > 1:
+        with span("batch_spectral", files=len(contexts)):
+            n = batch_spectral(list(contexts.values()), budget)
+        log.info(f"Stadi spettrali di {len(contexts)} file in {n} batch")
+    _prepared.update(contexts)
+    return list(contexts)
+
+def _stream_stages(path: str):
+    """Stadi beats/onsets/features in streaming (memoria indipendente dalla durata)."""
+    r = analyze_stream(path, hop_length=HOP_LENGTH)
+    sr = r['sr']
+    beats = dict(bpm=r['bpm'], sr=sr, hop_length=HOP_LENGTH,
+                 columns=dict(beat_frames=np.asarray(r['beat_frames'], dtype=np.int32)))
+    onsets = dict(sr=sr, columns=dict(onset_samples=r['onset_samples']))
+    feats = dict(sr=sr, columns=r['features'])
+    return beats, onsets, feats
+
+def analyze_audio(path: str, y=None, sr=None, decode: bool = True, stream: bool = False,
+                  checkpoint=None, grid=None):
+    """
+    Analisi a stadi con cache per stadio (vedi stage_keys): ogni stadio
+    mancante viene calcolato e salvato, quelli presenti riusati. L'audio
+    viene decodificato (o preso da y/sr, es. shared memory) solo se serve
+    almeno uno stadio tra beats, onsets e features.
+    decode=False: ritorna None invece di decodificare (lookup senza audio).
+    File lunghi (> STREAM_MIN_S) o stream=True: se l'audio non è già in
+    memoria gli stadi sono calcolati in streaming (streaming_analysis).
+    Con ANALYSIS_SR l'audio (decodificato o y) viene ricampionato prima
+    degli stadi, tranne in streaming.
+    grid: griglia del brano (song_grid): sostituisce lo stadio beats.
+    Ritorna (is_valid, bpm, grouped_data).
+    """
+    checkpoint = checkpoint or (lambda: None)
+    name = Path(path).name
+    streamed = y is None and should_stream(path, stream)
+    rate = analysis_rate(path, streamed)
+    with span("cache_lookup", file=name):
+        keys = stage_keys(path, streamed, grid_key=grid['key'] if grid else None)
+        cached = load_stage(path, keys['analysis'], adopt_previous=not grid)
+        if cached:
+            count_lookup(True)
+            return cached['is_valid'], cached['bpm'], cached['columns']
+
+        beats = grid or load_stage(path, keys['beats'])
+        onsets = load_stage(path, keys['onsets'])
+        feats = load_stage(path, keys['features'])
+
+    ctx = _prepared.pop(path, None) if y is None else None
+    needs_audio = ctx is None and (beats is None or onsets is None or feats is None)
+    if needs_audio and not decode:
+        return None             # verifica senza decodifica: il miss lo conta chi analizza
+    count_lookup(False)
+    if needs_audio:
+        if streamed:
+            log.info(f"Analisi in streaming: {name}")
+            with span("stream", file=name):
+                s_beats, s_onsets, s_feats = _stream_stages(path)
+            for stage, cached_data, new in (('beats', beats, s_beats),
+                                            ('onsets', onsets, s_onsets),
+                                            ('features', feats, s_feats)):
+                if cached_data is None:
+                    save_stage(keys[stage], new)
+            beats, onsets, feats = beats or s_beats, onsets or s_onsets, feats or s_feats
+        else:
+            with span("decode", file=name):
+                if y is None:
+                    y, sr = load_audio(path, rate)
+                elif y.size:
+                    y, sr = resample_audio(y, sr, rate)
+                if y is not None and y.size:
+                    ctx = StemContext.from_audio(y, sr, **analysis_frames(rate))
+            if ctx is None:
+                empty = onset_columns([])
+                save_stage(keys['analysis'], dict(is_valid=False, bpm=0.0, sr=sr or 0, columns=empty))
+                return False, 0.0, empty
+        checkpoint()
+
+    if beats is None:
+        try:
+            with span("beat_track", file=name):
+                bpm, beat_frames = ctx.beat_track()
+        except Exception:
+            empty = onset_columns([])
+            save_stage(keys['analysis'], dict(is_valid=False, bpm=0.0, sr=ctx.sr, columns=empty))
+            return False, 0.0, empty
+        beats = dict(bpm=bpm, sr=ctx.sr, hop_length=ctx.hop_length,
+                     columns=dict(beat_frames=np.asarray(beat_frames, dtype=np.int32)))
+        save_stage(keys['beats'], beats)
+        checkpoint()
+
+    if onsets is None:
+        with span("onset_detect", file=name):
+            onsets = dict(sr=ctx.sr, columns=dict(
+                onset_samples=np.asarray(ctx.onset_samples(), dtype=np.int64)))
+        save_stage(keys['onsets'], onsets)
+        checkpoint()
+
+    onset_samples = onsets['columns']['onset_samples']
+    if feats is None:
+        with span("envelope_features", file=name):
+            feats = dict(sr=ctx.sr, columns=envelope_features(ctx, onset_samples))
+        save_stage(keys['features'], feats)
+        checkpoint()
+
+    bpm, sr = beats['bpm'], onsets['sr']
+    hop = beats.get('hop_length', HOP_LENGTH)
+    with span("beat_mapping", file=name):
+        grouped = beat_mapping(beats['columns']['beat_frames'], onset_samples, sr, feats['columns'],
+                               hop_length=hop, beat_sr=beats['sr'])
+    data = dict(is_valid=True, bpm=bpm, sr=sr,
+                params=dict(ANALYSIS_PARAMS, hop_length=hop), columns=grouped)
+    save_stage(keys['analysis'], data)
+    return True, bpm, grouped
+
+def beat_mapping(beat_frames, onset_samples, sr, feature_columns, hop_length=HOP_LENGTH,
+                 offset: float | None = None, beat_sr=None) -> dict:
+    """
+    Beat mapping semplificato: posizione di ogni onset nella griglia dei
+    beat (periodo = mediana delle differenze). Ritorna le colonne grouped.
+    offset: secondi del campione 0 nella sorgente, per una porzione del
+    file (progressive_analysis): tempi nella sorgente e posizioni contate
+    come se il primo beat del file cadesse entro il primo periodo.
+    beat_sr: sr dei beat_frames se diverso da quello degli onset (griglia
+    del brano calcolata su un'altra stem, song_grid).
+    """
+    onset_times = onset_samples / sr + (offset or 0.0)
+    if beat_frames.size > 0:
+        beat_times = librosa.frames_to_time(beat_frames, sr=beat_sr or sr, hop_length=hop_length)
+        beat_times = beat_times + (offset or 0.0)
+        period = np.median(np.diff(beat_times)) if beat_times.size > 1 else 1.0
+        start = beat_times[0]
+        positions = (onset_times - start) / period
+        if offset is not None:
+            positions += np.floor(start / period)
+        beat_indices = np.round(positions).astype(int)
+        beat_fracs = positions - beat_indices
+    else:
+        positions = onset_times.copy()
+        beat_indices = np.zeros_like(positions, dtype=int)
+        beat_fracs = np.zeros_like(positions)
+
+    return dict(
+        onset_time=onset_times,
+        beat_index=beat_indices,
+        beat_position=positions,
+        beat_fraction=beat_fracs,
+        **feature_columns
+    )
+
+# ---------------------------------------
+# GRIGLIA DEL BRANO
+# ---------------------------------------
+def song_stems(paths) -> dict:
+    """{nome stem: path} dei file di paths che sono stem di un brano (SONG_STEMS)."""
+    return {Path(p).stem.lower(): str(p) for p in paths if Path(p).stem.lower() in SONG_STEMS}
+
+def song_grid(paths, mode: str = "drums", audio=None, checkpoint=None, compute: bool = True):
+    """
+    Griglia dei beat condivisa dalle stem di un brano (paths: le sue stem,
+    es. i file di stems/<brano>/). Ritorna il dict dello stadio beats (bpm,
+    sr, hop_length, columns.beat_frames) più 'key', da passare come grid ad
+    analyze_audio / analyze_file; None con mode "stem" o senza le stem
+    necessarie (ogni stem usa allora la propria griglia).
+    - "drums": lo stadio beats della stem drums, dalla cache o dalla sua
+      analisi completa (che serve comunque); senza beat validi ricade su "sum".
+    - "sum": beat tracking sulla somma mono delle stem (una decodifica per
+      stem, se non sono in audio), in cache con una chiave che dipende da
+      tutte le stem. Stem da analizzare in streaming: ricade su "drums".
+    audio: {path: (y, sr)} già in memoria (stems appena separate).
+    compute=False: solo la griglia già in cache, None se va calcolata.
+    """
+    stems = song_stems(paths)
+    audio = audio or {}
+    if mode == "sum" and not audio and any(should_stream(p) for p in stems.values()):
+        mode = "drums"
+    if mode == "drums" and "drums" in stems:
+        path = stems["drums"]
+        y, sr = audio.get(path, (None, None))
+        key = stage_keys(path, False if y is not None else None)['beats']
+        beats = load_stage(path, key)
+        if beats is None and compute:
+            if y is not None:
+                analyze_audio(path, y, sr, checkpoint=checkpoint)
+            else:
+                analyze_file(path, checkpoint=checkpoint)
+            beats = load_stage(path, key)
+        if beats is not None and len(beats['columns']['beat_frames']):
+            return dict(beats, key=key)
+        mode = "sum"
+    if mode != "sum" or len(stems) < 2:
+        return None
+
+    paths = sorted(stems.values())
+    rate = analysis_rate(paths[0], False)
+    frames = analysis_frames(rate)
+    params = dict(stage_params(**frames, analysis_sr=rate)['beats'], grid="sum")
+    key = stage_key(entry_key(paths[0]), 'song_beats', params, [entry_key(p) for p in paths])
+    beats = load_stage(paths[0], key)
+    if beats is not None:
+        return dict(beats, key=key)
+    if not compute:
+        return None
+
+    with span("song_grid", files=len(paths)):
+        ys, sr = [], None
+        for p in paths:
+            y, s = audio.get(p, (None, None))
+            y, s = resample_audio(y, s, rate) if y is not None else load_audio(p, rate)
+            if y is None or not y.size or (sr is not None and s != sr):
+                continue
+            ys.append(y)
+            sr = s
+        if not ys:
+            return None
+        total = np.zeros(max(y.size for y in ys), dtype=np.float32)
+        for y in ys:
+            total[:y.size] += y
+        del ys
+        ctx = StemContext.from_audio(total, sr, **frames)
+        try:
+            bpm, beat_frames = ctx.beat_track()
+        except Exception:
+            return None
+    beats = dict(bpm=bpm, sr=sr, hop_length=ctx.hop_length,
+                 columns=dict(beat_frames=np.asarray(beat_frames, dtype=np.int32)))
+    save_stage(key, beats)
+    return dict(beats, key=key)
+
+# ---------------------------------------
+# WARM-UP
+# ---------------------------------------
+def synthetic_signal(seconds: float = WARMUP_SECONDS, sr: int = WARMUP_SR, bpm: float = 120.0):
+    """Click di rumore con decadimento a tempo bpm, più rumore di fondo (float32)."""
+    rng = np.random.default_rng(0)
+    n = int(seconds * sr)
+    y = 0.005 * rng.standard_normal(n)
+    burst = int(0.05 * sr)
+    decay = np.exp(-np.arange(burst) / (0.01 * sr)) * rng.standard_normal(burst)
+    for start in np.arange(0, n - burst, int(60.0 / bpm * sr)):
+        y[start:start + burst] += decay
+    return y.astype(np.float32)
+
+def warm_up(seconds: float = WARMUP_SECONDS, sr: int = WARMUP_SR) -> float:
+    """
+    Analisi completa (beats, onsets, features, beat mapping, export) di un
+    segnale sintetico, fuori cache: import dei moduli librosa/scipy,
+    compilazione numba (i guvectorize di librosa si compilano a ogni
+    processo) e allocazioni avvengono qui e non alla prima richiesta.
+    Ritorna i secondi impiegati.
+    """
+    t0 = time.perf_counter()
+    y, rate = resample_audio(synthetic_signal(seconds, sr), sr, ANALYSIS_SR)
+    ctx = StemContext.from_audio(y, rate, **analysis_frames(rate if rate != sr else None))
+    bpm, beat_frames = ctx.beat_track()
+    onset_samples = np.asarray(ctx.onset_samples(), dtype=np.int64)
+    grouped = beat_mapping(np.asarray(beat_frames, dtype=np.int32), onset_samples, rate,
+                           envelope_features(ctx, onset_samples), hop_length=ctx.hop_length)
+    prepare_json_analysis("warm-up", bpm, grouped)
+    return time.perf_counter() - t0
+
+# ---------------------------------------
+# EXPORT
+# ---------------------------------------
+def prepare_json_analysis(filename: str, bpm: float, grouped):
+    """
+    Converte grouped (colonne, o lista di dict legacy) nelle serie esportate:
+      onset_times, beat_positions, onset_strength (velocity^gamma), contrast, spread
+    Le serie sono array float32: invio OSC e curve le usano così come sono,
+    le liste servono solo al JSON (json_default).
+    """
+    cols = onset_columns(grouped)
+    onset_times = np.asarray(cols['onset_time'], dtype=np.float32)
+    beat_positions = np.asarray(cols['beat_position'], dtype=np.float32)
+    velocity = np.asarray(cols['velocity_value'], dtype=np.float32)
+    spectral = np.asarray(cols['spectral_mean_freq'], dtype=np.float32)
+    release = np.asarray(cols['release_time'], dtype=np.float32)
+
+    # Smooth retroattivo
+    v_exp = np.power(rolling_mean(velocity, SMOOTH_WINDOW), STRENGTH_GAMMA)
+
+    if onset_times.size > 1:
+        gaps = np.diff(onset_times)
+        beat_gaps = np.abs(np.diff(beat_positions))
+        mask = (gaps > GAP_SECONDS) | (beat_gaps > GAP_BEATS)
+        v_exp[:-1][mask] = np.minimum(v_exp[:-1][mask] + GAP_BOOST, 1.0)
+
+    return {
+        'filename': filename,
+        'num_onsets': int(onset_times.size),
+        'onset_times': onset_times,
+        'beat_positions': beat_positions,
+        'onset_strength': v_exp,
+        'onset_contrast': _normalized(spectral),     # contrast (centroide)
+        'onset_spread': _normalized(release),        # spread (release time)
+    }
+
+def _normalized(x):
+    """x in [0, 1] su min..max (0.5 se costante)."""
+    if x.size == 0:
+        return x
+    mn, mx = x.min(), x.max()
+    return (x - mn) / (mx - mn) if mx > mn else np.full_like(x, 0.5)
+
+def json_default(obj):
+    """default= di json.dumps: array e scalari numpy dell'export come liste / float."""
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} non serializzabile in JSON")
@@ -0,0 +1,690 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark_analysis.py
+
+Benchmark degli stadi di analisi su stems sintetiche con ground truth
+nota, per accorgersi se un aggiornamento di librosa / scipy / torch (o una
+modifica al codice) rallenta la preparazione delle tracce.
+
+Casi: tipo x durata x sample rate
+  click   click da 20 ms su ogni beat
+  drums   cassa sui beat, rullante su 2 e 4, hi-hat in levare
+BPM e tempi degli onset sono noti: oltre ai tempi si misura l'accuratezza
+(errore BPM, F-measure degli onset entro ONSET_TOL_S). Gli onset della
+pipeline sono con backtrack (minimo di energia precedente): a hop lunghi
+in secondi (sr bassi) possono cadere fuori tolleranza anche se corretti.
+
+Stadi misurati separatamente, nell'ordine della pipeline:
+  decode                 load_audio del WAV generato
+  resample               resample_audio al sample rate di analisi
+                         (--analysis-sr; nullo a sr nativo)
+  mel_spectrogram        StemContext.mel_db (condiviso da beat e onset)
+  beat_track             StemContext.beat_track (stima tempo + beat)
+  onset_detect           StemContext.onset_samples
+  envelope_features      filter/stft/centroid + features per onset
+  beat_mapping           analysis_pipeline.beat_mapping
+  prepare_json_analysis  serie esportate
+  save_analysis_json     JSON + peaks + curve (ambisonics_automation)
+  send_envelope_data     invio OSC del server (blob con ack) verso un
+                         ricevitore locale che risponde come SC
+
+Ogni caso gira in un processo nuovo (warm-up escluso dai tempi): il picco
+di RSS (ru_maxrss) è quello del caso, letto anche dopo ogni stadio.
+
+Risultati in JSON (ambiente, versioni delle librerie, per ogni caso e
+stadio min/mediana delle ripetizioni e RSS); --compare confronta con un
+run precedente e segnala gli stadi più lenti oltre --threshold e i cali
+di accuratezza (exit 1).
+
+    python benchmark_analysis.py                       # suite completa
+    python benchmark_analysis.py --quick -o base.json
+    python benchmark_analysis.py --quick --compare base.json
+
+--parity SR misura ogni caso (o i file di --files, es. stems reali) a sr
+nativo e a SR: speedup degli stadi di analisi e report di parità rispetto
+al nativo (BPM, onset abbinati entro ONSET_TOL_S e loro spostamento,
+differenze di attack/release/centroide sugli onset abbinati).
+
+    python benchmark_analysis.py --parity 22050 --lengths 60
+    python benchmark_analysis.py --parity 16000 --files stems/song/*.wav
+
+--features-parity confronta analysis_engine.segment_envelope_features con
+i loop per onset che sostituisce (reference_features_cli / _server,
+copiati dalle versioni precedenti di CLI e server): regole CLI (min_len=1,
+centroide sui soli frame a energia non nulla), server (min_len=2, curva
+float32), onset duplicati, onset a fine buffer, blocchi piccoli. Exit 1
+se qualche caso supera le tolleranze.
+
+    python benchmark_analysis.py --features-parity
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+
+KINDS = ("click", "drums")
+LENGTHS_S = (10.0, 60.0, 240.0)
+SAMPLE_RATES = (22050, 44100, 48000)
+CASE_BPM = {"click": 120.0, "drums": 128.0}
+REPEATS = 3
+ONSET_TOL_S = 0.05            # tolleranza per l'F-measure degli onset
+BPM_TOL = 0.04                # errore relativo accettato (anche a metà / doppio tempo)
+REGRESSION_THRESHOLD = 0.10   # --compare: rallentamento segnalato (+10%)
+MIN_COMPARE_S = 0.002         # stadi più brevi: rumore di misura, non confrontati
+F_MEASURE_TOL = 0.02          # --compare: calo di F-measure segnalato
+
+BENCH_STAGES = ("decode", "resample", "mel_spectrogram", "beat_track", "onset_detect",
+                "envelope_features", "beat_mapping", "prepare_json_analysis",
+                "save_analysis_json", "send_envelope_data")
+# Stadi che dipendono dal sample rate di analisi (speedup di --parity)
+ANALYSIS_STAGES = BENCH_STAGES[:7]
+
+LIBRARIES = ("numpy", "scipy", "librosa", "numba", "soundfile", "python-osc", "torch",
+             "torchaudio")
+
+# ---------------------------------------
+# SEGNALI SINTETICI
+# ---------------------------------------
+def _decay(n, tau, sr):
+    return np.exp(-np.arange(n) / (tau * sr))
+
+def _add(y, start, x):
+    end = min(y.size, start + x.size)
+    if start < end:
+        y[start:end] += x[:end - start]
+
+def click_track(bpm: float, seconds: float, sr: int, offset: float = 0.5):
+    """Click (1.5 kHz, 20 ms) su ogni beat. Ritorna (y, onset_times)."""
+    n = int(seconds * sr)
+    times = np.arange(offset, seconds - 0.1, 60.0 / bpm)
+    k = int(0.02 * sr)
+    click = np.sin(2 * np.pi * 1500.0 * np.arange(k) / sr) * _decay(k, 0.004, sr)
+    y = np.zeros(n)
+    for t in times:
+        _add(y, int(round(t * sr)), click)
+    return y, times
+
+def drum_track(bpm: float, seconds: float, sr: int, offset: float = 0.5, seed: int = 0):
+    """
+    Pattern di batteria: cassa su ogni beat, rullante su 2 e 4, hi-hat in
+    levare (ottavi). Ritorna (y, onset_times) con un onset per colpo.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    beat = 60.0 / bpm
+    beats = np.arange(offset, seconds - 0.3, beat)
+
+    k = int(0.15 * sr)
+    t = np.arange(k) / sr
+    freq = 45.0 + 75.0 * np.exp(-t / 0.03)                  # sweep 120 -> 45 Hz
+    kick = np.sin(2 * np.pi * np.cumsum(freq) / sr) * _decay(k, 0.04, sr)
+    k = int(0.12 * sr)
+    snare = (0.6 * rng.standard_normal(k) + 0.4 * np.sin(2 * np.pi * 200.0 * np.arange(k) / sr)) \
+        * _decay(k, 0.03, sr)
+    k = int(0.05 * sr)
+    hat = 0.3 * np.diff(rng.standard_normal(k + 1)) * _decay(k, 0.008, sr)
+
+    y = 1e-3 * rng.standard_normal(n)
+    onsets = []
+    for i, b in enumerate(beats):
+        _add(y, int(round(b * sr)), kick * rng.uniform(0.8, 1.0))
+        if i % 2 == 1:
+            _add(y, int(round(b * sr)), snare * rng.uniform(0.8, 1.0))
+        onsets.append(b)
+        h = b + beat / 2
+        if h < seconds - 0.3:
+            _add(y, int(round(h * sr)), hat * rng.uniform(0.7, 1.0))
+            onsets.append(h)
+    return y, np.asarray(onsets)
+
+GENERATORS = {"click": click_track, "drums": drum_track}
+
+def make_cases(kinds=KINDS, lengths=LENGTHS_S, srs=SAMPLE_RATES, bpm=None) -> list:
+    return [dict(id=f"{kind}-{seconds:g}s-{sr}", kind=kind, seconds=float(seconds), sr=int(sr),
+                 bpm=float(bpm or CASE_BPM[kind]))
+            for kind in kinds for seconds in lengths for sr in srs]
+
+def write_case(case: dict, workdir: Path) -> tuple:
+    """Genera il WAV del caso in workdir. Ritorna (path, onset_times veri)."""
+    import soundfile as sf
+    y, onsets = GENERATORS[case["kind"]](case["bpm"], case["seconds"], case["sr"])
+    y = 0.9 * y / np.abs(y).max()
+    path = Path(workdir) / case["id"] / f"{case['kind']}.wav"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    sf.write(str(path), y.astype(np.float32), case["sr"], subtype="FLOAT")
+    return path, onsets
+
+# ---------------------------------------
+# ACCURATEZZA
+# ---------------------------------------
+def match_onsets(est, ref, tol: float = ONSET_TOL_S):
+    """Abbinamento uno a uno entro tol secondi (tempi ordinati). Ritorna (indici est, indici ref)."""
+    i = j = 0
+    pairs = []
+    while i < len(est) and j < len(ref):
+        d = est[i] - ref[j]
+        if abs(d) <= tol:
+            pairs.append((i, j))
+            i += 1
+            j += 1
+        elif d < 0:
+            i += 1
+        else:
+            j += 1
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+def onset_scores(est, ref, tol: float = ONSET_TOL_S) -> dict:
+    """Precision / recall / F-measure con abbinamento uno a uno entro tol secondi."""
+    est, ref = np.sort(np.asarray(est, float)), np.sort(np.asarray(ref, float))
+    hits = match_onsets(est, ref, tol)[0].size
+    p = hits / est.size if est.size else 0.0
+    r = hits / ref.size if ref.size else 0.0
+    return dict(precision=p, recall=r, f_measure=2 * p * r / (p + r) if p + r else 0.0)
+
+def bpm_scores(est: float, ref: float, tol: float = BPM_TOL) -> dict:
+    """Errore relativo; octave_ok se corretto a meno di metà / doppio tempo."""
+    err = abs(est - ref) / ref
+    octave = min(abs(est - ref * m) / (ref * m) for m in (0.5, 1.0, 2.0))
+    return dict(bpm_est=est, bpm_error=err, bpm_ok=err <= tol, bpm_octave_ok=octave <= tol)
+
+def parity_scores(ref: dict, est: dict, tol: float = ONSET_TOL_S) -> dict:
+    """
+    Quanto si spostano i risultati di est (sr ridotto) rispetto a ref
+    (nativo): BPM, onset abbinati entro tol (F-measure, spostamento
+    mediano / p95 / massimo) e differenze assolute mediane delle features
+    sugli onset abbinati. ref / est: risultati di run_case.
+    """
+    t_ref, t_est = np.asarray(ref["onset_times"]), np.asarray(est["onset_times"])
+    i, j = match_onsets(t_est, t_ref, tol)
+    shift = np.abs(t_est[i] - t_ref[j]) * 1000
+    p = i.size / t_est.size if t_est.size else 0.0
+    r = j.size / t_ref.size if t_ref.size else 0.0
+    out = dict(bpm_native=ref["bpm_est"], bpm=est["bpm_est"],
+               bpm_delta=est["bpm_est"] - ref["bpm_est"],
+               n_onsets_native=int(t_ref.size), n_onsets=int(t_est.size), matched=int(i.size),
+               f_measure=2 * p * r / (p + r) if p + r else 0.0,
+               shift_median_ms=float(np.median(shift)) if shift.size else None,
+               shift_p95_ms=float(np.percentile(shift, 95)) if shift.size else None,
+               shift_max_ms=float(shift.max()) if shift.size else None)
+    for col, key, scale in (("attack_time", "attack_ms", 1000), ("release_time", "release_ms", 1000),
+                            ("spectral_mean_freq", "centroid_hz", 1)):
+        a, b = np.asarray(est["features"][col]), np.asarray(ref["features"][col])
+        d = np.abs(a[i] - b[j]) * scale
+        out[f"{key}_median_diff"] = float(np.median(d)) if d.size else None
+    return out
+
+# ---------------------------------------
+# MISURE (PROCESSO FIGLIO)
+# ---------------------------------------
+def _rss_mb() -> float | None:
+    """Picco di RSS del processo in MB (None dove resource non esiste)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class _AckReceiver:
+    """SuperCollider finto: risponde /analysis/ack a ogni onset_blob_end."""
+
+    def __init__(self):
+        from pythonosc.dispatcher import Dispatcher
+        from pythonosc import osc_server
+        d = Dispatcher()
+        d.map("/analysis/onset_blob_end", self._on_end, needs_reply_address=True)
+        d.set_default_handler(lambda *args: None)
+        self.server = osc_server.ThreadingOSCUDPServer(("127.0.0.1", 0), d)
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _on_end(self, client_address, address, name, seq, n_parts, n_onsets, n_series, reply_port):
+        from pythonosc import udp_client
+        udp_client.SimpleUDPClient(client_address[0], reply_port).send_message(
+            "/analysis/ack", [name, seq])
+
+def _local_server():
+    """
+    Il modulo del server OSC con client e trasporto verso _AckReceiver, e
+    le risposte (ack) su una porta locale libera.
+    """
+    from pythonosc.dispatcher import Dispatcher
+    from pythonosc import osc_server, udp_client
+    import analize_onsets_simple as server
+    from osc_transport import OnsetTransport
+
+    sc = _AckReceiver()
+    d = Dispatcher()
+    replies = osc_server.ThreadingOSCUDPServer(("127.0.0.1", 0), d)
+    server.client = udp_client.SimpleUDPClient("127.0.0.1", sc.port)
+    server.transport = OnsetTransport("127.0.0.1", sc.port, reply_port=replies.server_address[1],
+                                      mode=server.TRANSPORT_MODE, log=lambda *a: None)
+    server.transport.bind(d)
+    threading.Thread(target=replies.serve_forever, daemon=True).start()
+    return server, (sc.server, replies)
+
+def run_case(case: dict, path: str, repeats: int = REPEATS, compute: str = "numpy",
+             analysis_sr: int | None = None, workdir: str | None = None) -> dict:
+    """
+    Esegue gli stadi `repeats` volte sul WAV del caso (nel processo
+    corrente), con analisi a analysis_sr (None = nativo). Cache e file
+    scritti vanno in workdir (default: cartella del WAV).
+    """
+    import contextlib
+    import io
+    import logging
+    import compute_backends
+    from analysis_cache import configure_cache
+    from analysis_engine import StemContext, analysis_frames, enable_numba_cache, resample_audio
+    from analysis_pipeline import (beat_mapping, configure_analysis_sr, envelope_features,
+                                   load_audio, prepare_json_analysis, warm_up)
+    from ambisonics_automation import save_analysis_json
+    from waveform_peaks import peaks_path
+
+    enable_numba_cache()
+    workdir = Path(workdir or Path(path).parent)
+    # Cache di analisi usa e getta (save_analysis_json cerca i beat in cache)
+    configure_cache(str(workdir / "cache"))
+    logging.getLogger("ambisonics").setLevel(logging.WARNING)
+    compute_backends.configure(compute)
+    configure_analysis_sr(analysis_sr)
+    warm_s = warm_up()
+    server, sockets = _local_server()
+    out_dir = workdir / "out"
+    name = Path(path).name
+
+    times = {s: [] for s in BENCH_STAGES}
+    rss = {}
+
+    def timed(stage, fn, *args, **kw):
+        t0 = time.perf_counter()
+        result = fn(*args, **kw)
+        times[stage].append(time.perf_counter() - t0)
+        rss[stage] = _rss_mb()
+        return result
+
+    try:
+        for _ in range(repeats):
+            y0, sr0 = timed("decode", load_audio, path)
+            y, sr = timed("resample", resample_audio, y0, sr0, analysis_sr)
+            ctx = StemContext.from_audio(y, sr, **analysis_frames(sr if sr != sr0 else None))
+            timed("mel_spectrogram", lambda: ctx.mel_db)
+            bpm, beat_frames = timed("beat_track", ctx.beat_track)
+            onsets = np.asarray(timed("onset_detect", ctx.onset_samples), dtype=np.int64)
+            feats = timed("envelope_features", envelope_features, ctx, onsets)
+            grouped = timed("beat_mapping", beat_mapping,
+                            np.asarray(beat_frames, dtype=np.int32), onsets, sr, feats,
+                            hop_length=ctx.hop_length)
+            data = timed("prepare_json_analysis", prepare_json_analysis, name, bpm, grouped)
+            # I peaks si saltano se già aggiornati: ogni ripetizione li riscrive
+            peaks_path(out_dir, Path(path).stem).unlink(missing_ok=True)
+            timed("save_analysis_json", save_analysis_json, path, bpm, data, out_dir,
+                  y=y0, sr=sr0)
+            with contextlib.redirect_stdout(io.StringIO()):
+                timed("send_envelope_data", server.send_envelope_data, name, bpm, grouped)
+            del ctx
+    finally:
+        for s in sockets:
+            s.shutdown()
+            s.server_close()
+
+    stages = {s: dict(min_s=min(t), median_s=float(np.median(t)), rss_mb=rss.get(s))
+              for s, t in times.items() if t}
+    features = {k: np.asarray(feats[k]).tolist()
+                for k in ("attack_time", "release_time", "spectral_mean_freq")}
+    return dict(stages=stages, bpm_est=float(bpm), onset_times=(onsets / sr).tolist(),
+                features=features, n_onsets=int(onsets.size), warm_up_s=warm_s,
+                rss_peak_mb=_rss_mb(), compute=compute_backends.active_spec(), analysis_sr=sr)
+
+# ---------------------------------------
+# SUITE
+# ---------------------------------------
+def environment() -> dict:
+    versions = {}
+    for lib in LIBRARIES:
+        try:
+            versions[lib] = metadata.version(lib)
+        except metadata.PackageNotFoundError:
+            versions[lib] = None
+    return dict(python=platform.python_version(), platform=platform.platform(),
+                machine=platform.machine(), cpu_count=os.cpu_count(), libraries=versions,
+                time=time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+def _run_isolated(*args) -> dict:
+    """run_case in un processo nuovo (RSS e warm-up del solo caso)."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as ex:
+        return ex.submit(run_case, *args).result()
+
+def run_suite(cases: list, repeats: int = REPEATS, compute: str = "numpy",
+              workdir: str | None = None, log=print, analysis_sr: int | None = None) -> dict:
+    """Genera e misura ogni caso in un processo nuovo. Ritorna il documento JSON."""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="milkydj-bench-", dir=workdir) as tmp:
+        for case in cases:
+            path, truth = write_case(case, Path(tmp))
+            r = _run_isolated(case, str(path), repeats, compute, analysis_sr)
+            est = r.pop("onset_times")
+            r.pop("features")
+            r["accuracy"] = dict(bpm_scores(r["bpm_est"], case["bpm"]), **onset_scores(est, truth))
+            r["n_onsets_true"] = int(truth.size)
+            results.append(dict(case, **r))
+            total = sum(s["min_s"] for s in r["stages"].values())
+            acc = r["accuracy"]
+            log(f"{case['id']:22s} {total * 1000:8.1f} ms  ({case['seconds'] / total:6.0f}x RT)  "
+                f"BPM {acc['bpm_est']:6.1f}/{case['bpm']:g}  onset F {acc['f_measure']:.2f}  "
+                f"RSS {r['rss_peak_mb'] or 0:6.0f} MB")
+    return dict(meta=dict(environment(), repeats=repeats, compute=compute,
+                          analysis_sr=analysis_sr, stages=list(BENCH_STAGES)), cases=results)
+
+def file_case(path: str) -> dict:
+    """Caso per un file audio esistente (ground truth sconosciuta)."""
+    import soundfile as sf
+    info = sf.info(path)
+    return dict(id=f"{Path(path).parent.name}/{Path(path).stem}", kind="file",
+                seconds=info.frames / info.samplerate, sr=int(info.samplerate), bpm=None)
+
+def run_parity(analysis_sr: int, cases: list = (), files: list = (), repeats: int = REPEATS,
+               compute: str = "numpy", workdir: str | None = None, log=print) -> dict:
+    """
+    Ogni caso sintetico (o file) misurato a sr nativo e a analysis_sr, in
+    processi separati: speedup degli ANALYSIS_STAGES e parity_scores.
+    Ritorna il documento JSON.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="milkydj-parity-", dir=workdir) as tmp:
+        items = [(case, *write_case(case, Path(tmp))) for case in cases]
+        items += [(file_case(f), Path(f), None) for f in files]
+        for n, (case, path, truth) in enumerate(items):
+            runs = {}
+            for label, rate in (("native", None), ("rate", analysis_sr)):
+                wd = Path(tmp) / f"run{n}-{label}"
+                wd.mkdir(parents=True)
+                runs[label] = _run_isolated(case, str(path), repeats, compute, rate, str(wd))
+            t = {label: sum(r["stages"][s]["min_s"] for s in ANALYSIS_STAGES if s in r["stages"])
+                 for label, r in runs.items()}
+            row = dict(case, analysis_sr=runs["rate"]["analysis_sr"], native_s=t["native"],
+                       rate_s=t["rate"], speedup=t["native"] / t["rate"] if t["rate"] else None,
+                       parity=parity_scores(runs["native"], runs["rate"]))
+            if truth is not None:
+                row["truth"] = {label: dict(bpm_scores(r["bpm_est"], case["bpm"]),
+                                            **onset_scores(r["onset_times"], truth))
+                                for label, r in runs.items()}
+            rows.append(row)
+            log(format_parity_row(row))
+    return dict(meta=dict(environment(), repeats=repeats, compute=compute,
+                          analysis_sr=analysis_sr, stages=list(ANALYSIS_STAGES)), parity=rows)
+
+def format_parity_row(row: dict) -> str:
+    p = row["parity"]
+    shift = (f"{p['shift_median_ms']:5.1f}/{p['shift_p95_ms']:5.1f} ms"
+             if p["shift_median_ms"] is not None else f"{'-':>14s}")
+    return (f"{row['id']:22s} {row['sr']:>6d}->{row['analysis_sr']:<6d} "
+            f"{row['native_s'] * 1000:8.1f} -> {row['rate_s'] * 1000:8.1f} ms "
+            f"({row['speedup'] or 0:4.2f}x)  BPM {p['bpm_native']:6.1f}->{p['bpm']:6.1f}  "
+            f"onset {p['matched']}/{p['n_onsets_native']} (F {p['f_measure']:.2f}) "
+            f"shift p50/p95 {shift}  centroid {p['centroid_hz_median_diff'] or 0:6.1f} Hz")
+
+def compare(old: dict, new: dict, threshold: float = REGRESSION_THRESHOLD) -> list:
+    """
+    Stadi dei casi comuni più lenti di old oltre threshold (tempo minimo).
+    Ritorna [(caso, stadio, old_s, new_s, rapporto)] ordinati per rapporto.
+    """
+    before = {c["id"]: c for c in old.get("cases", [])}
+    out = []
+    for case in new.get("cases", []):
+        prev = before.get(case["id"])
+        if prev is None:
+            continue
+        for stage, m in case["stages"].items():
+            p = prev["stages"].get(stage)
+            if p is None or max(p["min_s"], m["min_s"]) < MIN_COMPARE_S:
+                continue
+            ratio = m["min_s"] / p["min_s"] if p["min_s"] > 0 else float("inf")
+            if ratio > 1 + threshold:
+                out.append((case["id"], stage, p["min_s"], m["min_s"], ratio))
+    return sorted(out, key=lambda r: -r[4])
+
+def accuracy_changes(old: dict, new: dict, tol: float = F_MEASURE_TOL) -> list:
+    """
+    Casi comuni con accuratezza peggiorata: F-measure degli onset scesa di
+    più di tol o BPM non più corretto. Ritorna [(caso, descrizione)].
+    """
+    before = {c["id"]: c["accuracy"] for c in old.get("cases", []) if "accuracy" in c}
+    out = []
+    for case in new.get("cases", []):
+        prev, acc = before.get(case["id"]), case.get("accuracy")
+        if prev is None or acc is None:
+            continue
+        if acc["f_measure"] < prev["f_measure"] - tol:
+            out.append((case["id"], f"onset F {prev['f_measure']:.2f} -> {acc['f_measure']:.2f}"))
+        if prev["bpm_ok"] and not acc["bpm_ok"]:
+            out.append((case["id"], f"BPM {prev['bpm_est']:.1f} -> {acc['bpm_est']:.1f} "
+                                    f"(atteso {case['bpm']:g})"))
+    return out
+
+def format_stages(doc: dict) -> str:
+    """Tabella caso x stadio (ms, tempo minimo)."""
+    names = doc["meta"]["stages"]
+    short = [s.replace("_analysis", "").replace("_data", "")[:12] for s in names]
+    lines = [f"{'caso':22s} " + " ".join(f"{s:>12s}" for s in short)]
+    for c in doc["cases"]:
+        lines.append(f"{c['id']:22s} " + " ".join(
+            f"{c['stages'][s]['min_s'] * 1000:12.2f}" if s in c["stages"] else f"{'-':>12s}"
+            for s in names))
+    return "\n".join(lines)
+
+# ---------------------------------------
+# PARITÀ FEATURES PER ONSET (LOOP DI RIFERIMENTO)
+# ---------------------------------------
+FEATURES_ATOL = 1e-9          # attack/release/velocity e centroide CLI (float64)
+FEATURES_CENTROID_RTOL = 1e-6 # centroide del server (curva float32)
+
+def reference_features_cli(env, onset_samples, sr, S, freqs, hop_length):
+    """Loop per onset della CLI prima della vettorizzazione (envelope_features)."""
+    max_win = int(0.5 * sr)
+    feats = []
+    for i, onset in enumerate(onset_samples):
+        if i < len(onset_samples) - 1:
+            end = min(onset + max_win, onset_samples[i + 1])
+        else:
+            end = min(onset + max_win, len(env))
+        if end <= onset:
+            feats.append((0.0, 0.0, 0.0, 0.0))
+            continue
+        w = env[onset:end]
+        peak = w.argmax()
+        attack = peak / sr
+        thr = w[peak] * 0.5
+        decay = w[peak:]
+        below = np.where(decay < thr)[0]
+        release = (below[0] / sr) if below.size else (decay.size / sr)
+
+        onset_f = min(onset // hop_length, S.shape[1] - 1)
+        end_f = min(max(end // hop_length, onset_f + 1), S.shape[1])
+        spec_slice = S[:, onset_f:end_f]
+        centroid = 0.0
+        if spec_slice.size:
+            slic_sum = spec_slice.sum(axis=0)
+            mask = slic_sum > 0
+            if mask.any():
+                weighted = (freqs[:, None] * spec_slice[:, mask]).sum(axis=0)
+                centroid = (weighted / slic_sum[mask]).mean()
+        a_norm = np.clip(attack / 0.1, 0, 1)
+        r_norm = np.clip(release / 0.5, 0, 1)
+        feats.append((attack, release, 1.0 - (0.3 * a_norm + 0.7 * r_norm), centroid))
+    return np.asarray(feats, dtype=np.float64).reshape(-1, 4)
+
+def reference_features_server(env, onset_samples, sr, curve, hop_length=512):
+    """Loop per onset del server prima della vettorizzazione (calculate_envelope_features_gpu)."""
+    max_win = int(0.5 * sr)
+    feats = []
+    for i, onset in enumerate(onset_samples):
+        if i < len(onset_samples) - 1:
+            end = min(onset + max_win, onset_samples[i + 1])
+        else:
+            end = min(onset + max_win, len(env))
+        if end <= onset:
+            feats.append((0.0, 0.0, 0.0, 0.0))
+            continue
+        w = env[onset:end]
+        f0 = min(int(onset / hop_length), len(curve) - 1)
+        f1 = min(max(int(end / hop_length), f0 + 1), len(curve))
+        spec_slice = curve[f0:f1]
+        centroid = float(np.mean(spec_slice)) if len(spec_slice) > 0 else 0.0
+        if len(w) < 2:
+            feats.append((0.0, 0.0, 0.0, centroid))
+            continue
+        peak = np.argmax(w)
+        attack = peak / sr
+        under = np.where(w[peak:] < w[peak] * 0.5)[0]
+        release = (under[0] if len(under) > 0 else len(w) - peak) / sr
+        a_norm = np.clip(attack / 0.1, 0.0, 1.0)
+        r_norm = np.clip(release / 0.5, 0.0, 1.0)
+        feats.append((attack, release, 1.0 - (0.3 * a_norm + 0.7 * r_norm), centroid))
+    return np.asarray(feats, dtype=np.float64).reshape(-1, 4)
+
+def _features_matrix(f: dict):
+    return np.column_stack([f["attack_time"], f["release_time"], f["velocity_value"],
+                            f["spectral_mean_freq"]])
+
+def features_parity(seconds: float = 20.0, sr: int = 44100, log=print) -> list:
+    """
+    segment_envelope_features contro i loop di riferimento su una traccia
+    drums sintetica preceduta da silenzio (frame a energia nulla). Ritorna
+    i casi fuori tolleranza [(caso, feature, differenza massima)].
+    """
+    from analysis_engine import StemContext, segment_envelope_features
+
+    y, _ = drum_track(CASE_BPM["drums"], seconds, sr)
+    y = np.concatenate([np.zeros(int(0.3 * sr)), y]).astype(np.float32)
+    ctx = StemContext.from_audio(y, sr)
+    env = np.asarray(ctx.envelope)
+    n = env.shape[0]
+    detected = np.asarray(ctx.onset_samples(), dtype=np.int64)
+    # Duplicati (finestre vuote), uno nel silenzio iniziale, ultimi campioni del buffer
+    edge = np.array([n - 3, n - 2, n - 1], dtype=np.int64)
+    onsets = {
+        "rilevati": detected,
+        "duplicati": np.sort(np.concatenate([detected, detected[::3]])),
+        "silenzio+bordo": np.unique(np.concatenate([[0, int(0.1 * sr)], detected, edge])),
+    }
+    centroid, valid = ctx.centroid_curve
+    curve32 = centroid.astype(np.float32)
+    env32 = env.astype(np.float32)
+    names = ("attack_time", "release_time", "velocity_value", "spectral_mean_freq")
+
+    failures = []
+    for label, ons in onsets.items():
+        ref_cli = reference_features_cli(env, ons, sr, ctx.spectrum, ctx.fft_freqs,
+                                         ctx.hop_length)
+        ref_srv = reference_features_server(env32, ons, sr, curve32, ctx.hop_length)
+        for block in (None, 64, 1):
+            kw = {} if block is None else dict(block=block)
+            cli = _features_matrix(segment_envelope_features(
+                env, ons, sr, centroid, centroid_valid=valid, hop_length=ctx.hop_length, **kw))
+            srv = _features_matrix(segment_envelope_features(
+                env32, ons, sr, curve32, hop_length=ctx.hop_length, min_len=2, **kw))
+            case = f"{label}, block {block or 'default'}"
+            for rule, got, ref in (("cli", cli, ref_cli), ("server", srv, ref_srv)):
+                diff = np.abs(got - ref)
+                tol = np.full(4, FEATURES_ATOL)
+                if rule == "server":
+                    tol[3] = 0.0
+                    diff[:, 3] = np.maximum(diff[:, 3] - FEATURES_CENTROID_RTOL * np.abs(ref[:, 3]),
+                                            0.0)
+                worst = diff.max(axis=0) if diff.size else np.zeros(4)
+                for j, name in enumerate(names):
+                    if worst[j] > tol[j]:
+                        failures.append((f"{rule}: {case}", name, float(worst[j])))
+                log(f"{rule:6s} {case:32s} {ons.size:5d} onset  diff max "
+                    + " ".join(f"{name.split('_')[0]} {w:.1e}" for name, w in zip(names, worst)))
+    return failures
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark degli stadi di analisi su stems sintetiche")
+    ap.add_argument("-o", "--output", help="File JSON dei risultati "
+                                           "(default benchmark_<data>.json)")
+    ap.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS))
+    ap.add_argument("--lengths", nargs="+", type=float, default=list(LENGTHS_S),
+                    help="Durate in secondi")
+    ap.add_argument("--sr", nargs="+", type=int, default=list(SAMPLE_RATES), help="Sample rate")
+    ap.add_argument("--bpm", type=float, help="BPM di tutti i casi (default per tipo)")
+    ap.add_argument("--repeats", type=int, default=REPEATS)
+    ap.add_argument("--quick", action="store_true", help="Solo 10 s a 44.1 kHz, una ripetizione")
+    ap.add_argument("--compute", default="numpy", help="Backend di calcolo (compute_backends)")
+    ap.add_argument("--compare", metavar="JSON", help="Run precedente da confrontare")
+    ap.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                    help="Rallentamento relativo segnalato con --compare (default 0.10)")
+    ap.add_argument("--analysis-sr", type=int, help="Sample rate di analisi (default: nativo)")
+    ap.add_argument("--parity", type=int, metavar="SR",
+                    help="Confronta nativo e SR: speedup e report di parità")
+    ap.add_argument("--files", nargs="+", default=[],
+                    help="Con --parity: file audio reali invece dei casi sintetici")
+    ap.add_argument("--features-parity", action="store_true",
+                    help="Features per onset vettorizzate contro i loop di riferimento")
+    args = ap.parse_args()
+
+    if args.features_parity:
+        failures = features_parity()
+        for case, name, diff in failures:
+            print(f"  FUORI TOLLERANZA {case}: {name} {diff:.3g}")
+        print("Parità features: " + ("ok" if not failures else f"{len(failures)} differenze"))
+        return 1 if failures else 0
+
+    if args.quick:
+        args.lengths, args.sr, args.repeats = [10.0], [44100], 1
+    cases = make_cases(args.kinds, args.lengths, args.sr, args.bpm)
+    if args.parity:
+        cases = [] if args.files else cases
+        print(f"Parità nativo -> {args.parity} Hz: {len(cases) + len(args.files)} casi, "
+              f"{args.repeats} ripetizioni")
+        doc = run_parity(args.parity, cases, args.files, args.repeats, args.compute)
+        out = Path(args.output or f"parity_{args.parity}_{time.strftime('%Y%m%d-%H%M%S')}.json")
+        out.write_text(json.dumps(doc, indent=2))
+        print(f"\nRisultati: {out}")
+        return 0
+    print(f"{len(cases)} casi, {args.repeats} ripetizioni, compute {args.compute}"
+          + (f", analisi a {args.analysis_sr} Hz" if args.analysis_sr else ""))
+    doc = run_suite(cases, args.repeats, args.compute, analysis_sr=args.analysis_sr)
+    print()
+    print(format_stages(doc))
+
+    out = Path(args.output or f"benchmark_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    out.write_text(json.dumps(doc, indent=2))
+    print(f"\nRisultati: {out}")
+
+    if args.compare:
+        base = json.loads(Path(args.compare).read_text())
+        slower = compare(base, doc, args.threshold)
+        worse = accuracy_changes(base, doc)
+        if not slower and not worse:
+            print(f"Nessuno stadio più lento di +{args.threshold:.0%} e nessun calo di "
+                  f"accuratezza rispetto a {args.compare}")
+            return 0
+        if slower:
+            print(f"Più lenti di +{args.threshold:.0%} rispetto a {args.compare}:")
+        for case_id, stage, t_old, t_new, ratio in slower:
+            print(f"  {case_id:22s} {stage:22s} {t_old * 1000:9.2f} -> {t_new * 1000:9.2f} ms "
+                  f"({ratio - 1:+.0%})")
+        if worse:
+            print(f"Accuratezza peggiorata rispetto a {args.compare}:")
+        for case_id, what in worse:
+            print(f"  {case_id:22s} {what}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+compute_backends.py
+
+Backend di calcolo per gli stadi spettrali di StemContext (analysis_engine):
+
+  filter    passa-banda + envelope (rettifica, passa-basso, normalizzazione)
+  stft      magnitudo STFT del segnale filtrato
+  centroid  centroide spettrale per frame (+ frame a energia non nulla)
+
+Tutti gli stadi lavorano sull'ultimo asse: un batch di stem (B, N) passa
+in un'unica chiamata (analysis_engine.batch_spectral). Con lengths (righe
+con padding) il filtro azzera filtrato ed envelope oltre la lunghezza di
+ogni riga, come se la stem finisse lì, e normalizza riga per riga; frames
+dice al centroide quanti frame sono validi per riga.
+
+- "numpy": scipy.signal.sosfilt, librosa.stft, numpy. È il riferimento
+  (risultati identici ai JSON già prodotti) e il default della CLI.
+- "torch-cpu", "torch-cuda", "torch-mps": tensori residenti sul device.
+  Ogni stadio riceve l'input nel formato del proprio backend (asarray
+  converte solo se lo stadio precedente girava altrove), quindi tra stadi
+  dello stesso backend non ci sono passaggi dall'host; all'host tornano
+  solo envelope e curva del centroide. Il filtro IIR usa
+  torchaudio.functional.lfilter: senza torchaudio il backend non offre lo
+  stadio "filter". Risultati uguali al riferimento entro la precisione
+  float (float32 su MPS).
+
+select_backends() misura ogni stadio su ogni backend disponibile (segnale
+sintetico di BENCH_SECONDS) e il costo dei trasferimenti host <-> device,
+poi sceglie per ogni stadio il backend della combinazione più veloce.
+
+configure(spec) imposta gli stadi:
+  "auto"                           benchmark (select_backends)
+  "numpy" | "torch-mps" | ...      tutti gli stadi sullo stesso backend
+  "filter=numpy,stft=torch-cuda"   per stadio (gli altri restano numpy)
+"""
+
+import itertools
+import time
+
+import numpy as np
+
+STAGES = ("filter", "stft", "centroid")
+DEFAULT_BACKEND = "numpy"
+BENCH_SECONDS = 10.0
+BENCH_SR = 44100
+BENCH_REPEATS = 3
+
+# ---------------------------------------
+# BACKEND
+# ---------------------------------------
+class NumpyBackend:
+    """Riferimento su CPU (scipy / librosa)."""
+
+    name = "numpy"
+    stages = STAGES
+
+    def asarray(self, x):
+        return to_host(x)
+
+    def sync(self):
+        pass
+
+    def filter(self, y, band_sos, lp_sos, lengths=None):
+        from scipy.signal import sosfilt
+        yf = sosfilt(band_sos, y, axis=-1)
+        env = sosfilt(lp_sos, np.abs(yf), axis=-1)
+        if lengths is not None:
+            for row, n in enumerate(lengths):
+                yf[row, n:] = 0.0
+                env[row, n:] = 0.0
+        if env.size:
+            vmax = env.max(axis=-1, keepdims=True)
+            env /= np.where(vmax > 0, vmax, 1.0)
+        return yf, env
+
+    def stft(self, yf, n_fft, hop_length):
+        import librosa
+        return np.abs(librosa.stft(yf, n_fft=n_fft, hop_length=hop_length))
+
+    def centroid(self, S, freqs, frames=None):
+        if S.ndim == 3:
+            # Stem per stem, sui soli frame validi e nello stesso layout dello
+            # spettro singolo (Fortran): stesse riduzioni BLAS e arrotondamenti
+            frames = frames if frames is not None else [S.shape[-1]] * S.shape[0]
+            centroid = np.zeros(S.shape[::2])
+            valid = np.zeros(S.shape[::2], dtype=bool)
+            for row, n in enumerate(frames):
+                centroid[row, :n], valid[row, :n] = self.centroid(
+                    np.asfortranarray(S[row, :, :n]), freqs)
+            return centroid, valid
+        mag_sum = S.sum(axis=0)
+        valid = mag_sum > 0
+        weighted = freqs @ S
+        centroid = np.divide(weighted, mag_sum, out=np.zeros_like(weighted), where=valid)
+        return centroid, valid
+
+class TorchBackend:
+    """Stadi su un device torch, senza passaggi intermedi dall'host."""
+
+    def __init__(self, device: str):
+        import torch
+        self.torch = torch
+        self.device = torch.device(device)
+        self.name = f"torch-{device}"
+        # MPS non supporta float64
+        self.dtype = torch.float32 if device == "mps" else torch.float64
+        try:
+            import torchaudio.functional as taf
+            self.taf = taf
+            self.stages = STAGES
+        except ImportError:
+            self.taf = None
+            self.stages = ("stft", "centroid")
+
+    def asarray(self, x):
+        if isinstance(x, self.torch.Tensor):
+            return x.to(self.device, self.dtype)
+        return self.torch.as_tensor(np.asarray(x), dtype=self.dtype, device=self.device)
+
+    def sync(self):
+        if self.device.type == "cuda":
+            self.torch.cuda.synchronize()
+        elif self.device.type == "mps":
+            self.torch.mps.synchronize()
+
+    def _sosfilt(self, x, sos):
+        # Cascata di biquad, come scipy.signal.sosfilt
+        for b0, b1, b2, a0, a1, a2 in np.asarray(sos, dtype=np.float64):
+            x = self.taf.lfilter(x, self.asarray([a0, a1, a2]), self.asarray([b0, b1, b2]),
+                                 clamp=False)
+        return x
+
+    def filter(self, y, band_sos, lp_sos, lengths=None):
+        yf = self._sosfilt(self.asarray(y), band_sos)
+        env = self._sosfilt(yf.abs(), lp_sos)
+        if lengths is not None:
+            mask = self.torch.as_tensor(_valid_mask(env, lengths), device=self.device)
+            yf = yf.where(mask, self.torch.zeros_like(yf))
+            env = env.where(mask, self.torch.zeros_like(env))
+        if env.numel():
+            vmax = env.amax(dim=-1, keepdim=True)
+            env = self.torch.where(vmax > 0, env / vmax.clamp_min(1e-30), env)
+        return yf, env
+
+    def stft(self, yf, n_fft, hop_length):
+        torch = self.torch
+        window = torch.hann_window(n_fft, periodic=True, dtype=self.dtype, device=self.device)
+        # Come librosa.stft: center=True con padding a zeri
+        return torch.stft(self.asarray(yf), n_fft, hop_length=hop_length, window=window,
+                          center=True, pad_mode="constant", return_complex=True).abs()
+
+    def centroid(self, S, freqs, frames=None):
+        torch = self.torch
+        S = self.asarray(S)
+        mag_sum = S.sum(dim=-2)
+        valid = mag_sum > 0
+        weighted = self.asarray(freqs) @ S
+        centroid = torch.where(valid, weighted / torch.where(valid, mag_sum, torch.ones_like(mag_sum)),
+                               torch.zeros_like(weighted))
+        return centroid, valid
+
+def _valid_mask(x, lengths):
+    """Maschera (B, N): True sui primi lengths[b] campioni di ogni riga."""
+    return np.arange(x.shape[-1]) < np.asarray(lengths).reshape(-1, 1)
+
+def to_host(x):
+    """Array numpy da un risultato di qualunque backend."""
+    if hasattr(x, "detach"):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+def available_backends() -> dict:
+    """Backend utilizzabili su questa macchina (nome -> istanza)."""
+    out = {"numpy": NumpyBackend()}
+    try:
+        import torch
+    except Exception:
+        return out
+    out["torch-cpu"] = TorchBackend("cpu")
+    if torch.cuda.is_available():
+        out["torch-cuda"] = TorchBackend("cuda")
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        out["torch-mps"] = TorchBackend("mps")
+    return out
+
+# ---------------------------------------
+# SELEZIONE
+# ---------------------------------------
+_backends = None
+_active = {}
+
+def _all():
+    global _backends
+    if _backends is None:
+        _backends = available_backends()
+    return _backends
+
+def backend_for(stage: str):
+    """Backend configurato per lo stadio (numpy se non configurato)."""
+    return _active.get(stage) or _all()[DEFAULT_BACKEND]
+
+def active_spec() -> str:
+    """Configurazione corrente, nel formato accettato da configure."""
+    return ",".join(f"{s}={backend_for(s).name}" for s in STAGES)
+
+def configure(spec: str = DEFAULT_BACKEND, log=None) -> dict:
+    """
+    Imposta il backend degli stadi (vedi docstring del modulo).
+    Backend non disponibili o senza lo stadio ricadono su numpy.
+    Ritorna {stadio: nome backend}.
+    """
+    spec = (spec or DEFAULT_BACKEND).strip()
+    if spec == "auto":
+        choice = select_backends(log=log)
+    elif "=" in spec:
+        choice = dict(item.split("=", 1) for item in spec.split(",") if item)
+    else:
+        choice = {s: spec for s in STAGES}
+
+    backends = _all()
+    _active.clear()
+    for stage in STAGES:
+        name = choice.get(stage, DEFAULT_BACKEND)
+        be = backends.get(name)
+        if be is None or stage not in be.stages:
+            if log is not None and name != DEFAULT_BACKEND:
+                log(f"Backend {name} non disponibile per {stage}: uso {DEFAULT_BACKEND}")
+            be = backends[DEFAULT_BACKEND]
+        _active[stage] = be
+    return {s: b.name for s, b in _active.items()}
+
+def _timed(fn, be, repeats=BENCH_REPEATS):
+    fn()                    # warm-up (kernel, allocazioni, plan FFT)
+    be.sync()
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        be.sync()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def benchmark(seconds: float = BENCH_SECONDS, sr: int = BENCH_SR) -> dict:
+    """
+    Tempi (s) per stadio e backend su rumore di `seconds` secondi, più il
+    costo di un trasferimento host <-> device del segnale ("transfer").
+    Ritorna {backend: {stadio: secondi, "transfer": secondi}}.
+    """
+    from analysis_engine import HOP_LENGTH, N_FFT, band_filter, lowpass_filter
+    rng = np.random.default_rng(0)
+    y = (0.1 * rng.standard_normal(int(seconds * sr))).astype(np.float32)
+    band, lp = band_filter(sr), lowpass_filter(sr)
+    freqs = np.fft.rfftfreq(N_FFT, 1.0 / sr)
+    n_fft, hop_length = N_FFT, HOP_LENGTH
+
+    times = {}
+    for name, be in _all().items():
+        t = {}
+        yf, _ = (be if "filter" in be.stages else _all()["numpy"]).filter(y, band, lp)
+        yf = be.asarray(yf)
+        S = be.stft(yf, n_fft, hop_length)
+        if "filter" in be.stages:
+            t["filter"] = _timed(lambda: be.filter(y, band, lp), be)
+        t["stft"] = _timed(lambda: be.stft(yf, n_fft, hop_length), be)
+        t["centroid"] = _timed(lambda: be.centroid(S, freqs), be)
+        t["transfer"] = 0.0 if name == "numpy" else _timed(lambda: to_host(be.asarray(y)), be)
+        times[name] = t
+    return times
+
+def select_backends(seconds: float = BENCH_SECONDS, log=None) -> dict:
+    """
+    Combinazione di backend (uno per stadio) con il tempo totale minimo,
+    compresi i trasferimenti quando due stadi consecutivi girano su
+    backend diversi (e il ritorno all'host dei risultati). Ritorna
+    {stadio: nome backend}.
+    """
+    times = benchmark(seconds)
+    names = list(times)
+    best, best_t = None, float("inf")
+    for combo in itertools.product(names, repeat=len(STAGES)):
+        if any(stage not in times[b] for stage, b in zip(STAGES, combo)):
+            continue
+        total = sum(times[b][stage] for stage, b in zip(STAGES, combo))
+        for prev, cur in zip(combo, combo[1:]):
+            if prev != cur:
+                total += times[prev]["transfer"] + times[cur]["transfer"]
+        # envelope (filter) e centroide tornano comunque all'host
+        total += times[combo[0]]["transfer"] + times[combo[-1]]["transfer"]
+        if total < best_t:
+            best, best_t = combo, total
+    choice = dict(zip(STAGES, best))
+    if log is not None:
+        for name, t in times.items():
+            log(f"  {name:11s} " + "  ".join(f"{k} {v * 1000:7.1f} ms" for k, v in t.items()))
+        log(f"Backend scelti ({seconds:.0f}s di audio, {best_t * 1000:.1f} ms): "
+            + ", ".join(f"{s}={b}" for s, b in choice.items()))
+    return choice
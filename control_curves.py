@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+control_curves.py
+
+Curve di automazione spaziale pre-renderizzate per SuperCollider.
+
+~startAutomationFor (MILKY_DJ.scd) faceva una Routine su AppClock con un
+wait e due .set per ogni onset: migliaia di eventi sclang per le drums,
+jitter e deriva dopo un seek. Qui le stesse mappature diventano due curve
+a gradini campionate a CURVE_RATE_HZ:
+
+  canale 0: rate dell'LFO azimuth   strength.clip(0, 1).linexp(0.02, 0.8, 0.15, 3.0)
+  canale 1: elevation in gradi      contrast.linlin(0, 1, 0, 180)
+
+Ogni valore vale dall'onset fino al successivo; prima del primo onset i
+valori iniziali dei synth (rate 0.5, elevation 90°).
+
+Le curve si salvano come WAV float a 2 canali in <cartella stem>/curves/
+<stem>.wav (sottocartella: il loader delle stems di SC e le scansioni delle
+cartelle non la vedono). SC le legge con BufRd alla posizione del player
+della stem, quindi seguono seek, loop e rate del deck senza eventi sclang.
+"""
+
+import os
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+
+from streaming_analysis import audio_info
+
+CURVE_RATE_HZ = 200           # 5 ms per frame
+CURVES_DIR = "curves"
+
+# Valori prima del primo onset (Synth \azLFO e \elevSmoother in MILKY_DJ.scd)
+LFO_RATE_DEFAULT = 0.5
+ELEV_DEG_DEFAULT = 90.0
+
+def linexp(x, in_lo, in_hi, out_lo, out_hi):
+    """Come SimpleNumber.linexp di SC (clip ai bordi)."""
+    x = np.clip(np.asarray(x, dtype=np.float64), in_lo, in_hi)
+    return out_lo * (out_hi / out_lo) ** ((x - in_lo) / (in_hi - in_lo))
+
+def linlin(x, in_lo, in_hi, out_lo, out_hi):
+    """Come SimpleNumber.linlin di SC (clip ai bordi)."""
+    x = np.clip(np.asarray(x, dtype=np.float64), in_lo, in_hi)
+    return out_lo + (x - in_lo) / (in_hi - in_lo) * (out_hi - out_lo)
+
+def lfo_rate(strength):
+    return linexp(np.clip(strength, 0, 1), 0.02, 0.8, 0.15, 3.0)
+
+def elevation_deg(contrast):
+    return linlin(contrast, 0, 1, 0, 180)
+
+def curves_path(stem_path: str, target_dir=None) -> Path:
+    d = Path(target_dir) if target_dir is not None else Path(stem_path).parent
+    return d / CURVES_DIR / f"{Path(stem_path).stem}.wav"
+
+# ---------------------------------------
+# RENDER
+# ---------------------------------------
+def render_curves(times, strength, contrast, duration: float,
+                  rate: int = CURVE_RATE_HZ):
+    """
+    Curve (n_frame, 2) float32 su duration secondi: per ogni frame il valore
+    dell'ultimo onset con tempo <= t (come la Routine che aspettava l'onset).
+    """
+    times = np.asarray(times, dtype=np.float64)
+    n = max(1, int(np.ceil(max(duration, 0.0) * rate)) + 1)
+    out = np.empty((n, 2), dtype=np.float32)
+    out[:, 0] = LFO_RATE_DEFAULT
+    out[:, 1] = ELEV_DEG_DEFAULT
+    if times.size == 0:
+        return out
+    t = np.arange(n, dtype=np.float64) / rate
+    idx = np.searchsorted(times, t, side="right") - 1
+    on = idx >= 0
+    out[on, 0] = lfo_rate(strength)[idx[on]]
+    out[on, 1] = elevation_deg(contrast)[idx[on]]
+    return out
+
+def save_curves(stem_path: str, data: dict, target_dir=None, duration: float | None = None,
+                rate: int = CURVE_RATE_HZ) -> Path:
+    """
+    Scrive le curve di stem_path da data (dict di prepare_json_analysis).
+    duration: secondi della stem (default: letti dall'header del file).
+    """
+    times = data.get('onset_times', [])
+    if duration is None:
+        info = audio_info(stem_path)
+        duration = info[1] / info[0] if info else (float(times[-1]) if len(times) else 0.0)
+    curves = render_curves(times, data.get('onset_strength', []),
+                           data.get('onset_contrast', []), duration, rate)
+    fp = curves_path(stem_path, target_dir)
+    fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp = fp.with_name(f".{fp.stem}.{os.getpid()}.tmp.wav")
+    sf.write(str(tmp), curves, rate, subtype="FLOAT", format="WAV")
+    os.replace(tmp, fp)     # SC non legge mai curve scritte a metà
+    return fp
@@ -80,6 +80,10 @@ class Deck {
   void setPeer(Deck other) { this.peer = other; }
 
   void loadAudioFile(java.io.File f) {
+    // La traccia precedente esce dal deck: la sua analisi non serve più
+    if (osc != null && currentFile != null && !currentFile.equals(f)) {
+        osc.requestCancelAnalysis(stemsPathFor(currentFile));
+    }
     currentFile = f;
     trackTitle = f.getName();
     
@@ -93,10 +97,9 @@ class Deck {
     // --- MODIFICA: Analisi Python (OSC) SEMPRE ---
     // Questo blocco viene eseguito in ogni caso, per informare il backend
     if (osc != null) {
-        String parent = f.getParent();
         String base = f.getName().replaceFirst("[.][^.]+$", "");
-        String stemsPath = parent + "/stems/" + base;
-        osc.requestAnalyzeFolder(stemsPath);
+        // Priorità deck: passa davanti alle scansioni di cartelle in background
+        osc.requestAnalyzeFolder(stemsPathFor(f), OscBridge.ANALYSIS_PRIORITY_DECK);
         println("[Deck] Richiesta analisi Python (OSC) inviata per: " + base);
     }
 
@@ -109,10 +112,38 @@ class Deck {
           return;
     }
     
+    // Sidecar Python (stems/<nome>/mix_peaks.mkp): waveform e griglia senza decodificare
+    TrackAnalysis pre = loadPeakSidecar(f);
+    if (pre != null) {
+        analysis = pre;
+        analysisError = null;
+        isAnalyzing = false;
+        println("[Deck] Waveform da sidecar: " + pre.levelCount() + " livelli, BPM " + pre.bpm);
+        return;
+    }
+
     // Altrimenti avvia analisi locale
     startAnalysis(f);
   }
 
+  TrackAnalysis loadPeakSidecar(java.io.File f) {
+    java.io.File side = new java.io.File(stemsPathFor(f), "mix_peaks.mkp");
+    if (!side.isFile() || side.lastModified() < f.lastModified()) return null;
+    try {
+        TrackAnalysis a = new PeakSidecarLoader().load(side);
+        // Senza griglia beat (mix non ancora analizzato) serve comunque BPMAnalyzer
+        return (a.beats.isEmpty() || a.bpm <= 0) ? null : a;
+    } catch (Exception e) {
+        println("[Deck] Sidecar peaks non leggibile: " + e);
+        return null;
+    }
+  }
+
+  String stemsPathFor(java.io.File f) {
+    String base = f.getName().replaceFirst("[.][^.]+$", "");
+    return f.getParent() + "/stems/" + base;
+  }
+
   void startAnalysis(java.io.File f) {
     analysis = null;
     analysisError = null;
@@ -565,15 +596,17 @@ class Deck {
     if (A == null || A.wfMin == null) { stroke(90, 200, 255, 120); line(left, cy, right, cy); return;
     }
     int cols = max(1, int(miniW - 12)); float scaleY = (miniH * 0.42f);
+    int lv = A.levelFor(A.durationSec / cols);
+    float[] wMin = A.minAt(lv), wMax = A.maxAt(lv); float hopSec = A.hopAt(lv);
     stroke(90, 200, 255);
     strokeWeight(1);
     for (int i = 0; i < cols; i++) {
       float px = left + i;
       float t = (i / (float)(cols - 1)) * A.durationSec;
-      float idxF = t / A.wfHopSec; int idx0 = floor(idxF);
-      int idx1 = min(A.wfMin.length - 1, idx0 + 1);
+      float idxF = t / hopSec; int idx0 = min(floor(idxF), wMin.length - 1);
+      int idx1 = min(wMin.length - 1, idx0 + 1);
       float frac = constrain(idxF - idx0, 0, 1);
-      float vMin = lerp(A.wfMin[idx0], A.wfMin[idx1], frac); float vMax = lerp(A.wfMax[idx0], A.wfMax[idx1], frac);
+      float vMin = lerp(wMin[idx0], wMin[idx1], frac); float vMax = lerp(wMax[idx0], wMax[idx1], frac);
       line(px, cy - vMax * scaleY, px, cy - vMin * scaleY);
     }
     float ratio = (A.durationSec > 0) ? (playheadSec / A.durationSec) : 0;
@@ -382,7 +382,15 @@ class OscBridge {
     return null;
   }
   
+  // Priorità dei job nel server Python (più basso = prima), vedi analysis_jobs.py
+  static final int ANALYSIS_PRIORITY_DECK = 0;
+  static final int ANALYSIS_PRIORITY_SCAN = 10;
+
   void requestAnalyzeFolder(String stemsPath) {
+    requestAnalyzeFolder(stemsPath, ANALYSIS_PRIORITY_SCAN);
+  }
+
+  void requestAnalyzeFolder(String stemsPath, int priority) {
     if (!connected) {
         app.println("[OSC][WARN] SC non connesso, skip analisi");
         return;
@@ -390,6 +398,7 @@ class OscBridge {
     NetAddress pythonAddr = new NetAddress("127.0.0.1", 57123);
     OscMessage msg = new OscMessage("/analyze_folder");
     msg.add(stemsPath);
+    msg.add(priority);
     try {
         osc.send(msg, pythonAddr);
         log("Richiesto analisi: " + stemsPath);
@@ -410,6 +419,19 @@ class OscBridge {
     }
   }
 
+  // Annulla l'analisi in coda o in corso di una cartella stems o di un file
+  void requestCancelAnalysis(String path) {
+    NetAddress pythonAddr = new NetAddress("127.0.0.1", 57123);
+    OscMessage msg = new OscMessage("/analysis/cancel");
+    msg.add(path);
+    try {
+        osc.send(msg, pythonAddr);
+        log("Annullata analisi: " + path);
+    } catch (Exception e) {
+        app.println("[OSC][ERR] Invio /analysis/cancel fallito: " + e);
+    }
+  }
+
   boolean isConnected() { return connected && receivedHello; }
   void setDebug(boolean d) { debug = d; }
 }
@@ -138,6 +138,12 @@ class WaveformStrip {
     int cols = max(1, int(w - 12));
     float tNow = deck.playheadSec;
 
+    // Livello della piramide adatto allo zoom (un bin per pixel al massimo)
+    int lv = A.levelFor(1.0 / pxPerSec);
+    float[] wMin = A.minAt(lv);
+    float[] wMax = A.maxAt(lv);
+    float hopSec = A.hopAt(lv);
+
     stroke(waveColor);
     strokeWeight(1);
 
@@ -147,13 +153,13 @@ class WaveformStrip {
       float t  = tNow + dt;
       if (t < 0 || t >= A.durationSec) continue;
 
-      float idxF = t / A.wfHopSec;
-      int idx0   = floor(idxF);
-      int idx1   = min(A.wfMin.length - 1, idx0 + 1);
+      float idxF = t / hopSec;
+      int idx0   = min(floor(idxF), wMin.length - 1);
+      int idx1   = min(wMin.length - 1, idx0 + 1);
       float frac = constrain(idxF - idx0, 0, 1);
 
-      float vMin = lerp(A.wfMin[idx0], A.wfMin[idx1], frac);
-      float vMax = lerp(A.wfMax[idx0], A.wfMax[idx1], frac);
+      float vMin = lerp(wMin[idx0], wMin[idx1], frac);
+      float vMax = lerp(wMax[idx0], wMax[idx1], frac);
 
       float yTop = cy - vMax * scaleY;
       float yBot = cy - vMin * scaleY;
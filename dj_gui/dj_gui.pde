@@ -20,6 +20,24 @@ class TrackAnalysis {
   float[] wfMax;
   float   wfHopSec; // ~0.01s
 
+  // Piramide dal sidecar Python (*_peaks.mkp): livello k = bin di wfHopSec * 2^k.
+  // null se la waveform viene dall'analisi locale (solo livello 0).
+  float[][] wfMinLevels;
+  float[][] wfMaxLevels;
+
+  int levelCount() { return wfMinLevels != null ? wfMinLevels.length : 1; }
+
+  // Livello più grossolano i cui bin non superano secPerPx (niente aliasing da zoom out)
+  int levelFor(float secPerPx) {
+    int lv = 0;
+    while (lv + 1 < levelCount() && wfHopSec * (1 << (lv + 1)) <= secPerPx) lv++;
+    return lv;
+  }
+
+  float[] minAt(int lv) { return (lv == 0 || wfMinLevels == null) ? wfMin : wfMinLevels[lv]; }
+  float[] maxAt(int lv) { return (lv == 0 || wfMaxLevels == null) ? wfMax : wfMaxLevels[lv]; }
+  float hopAt(int lv) { return wfHopSec * (1 << lv); }
+
   int beatIndexAtTime(float t) {
     if (beats == null || beats.isEmpty()) return -1;
     int lo = 0, hi = beats.size() - 1, ans = -1;
@@ -66,6 +84,58 @@ class TrackAnalysis {
 
 class IntRange { int i0, i1; }
 
+// Sidecar scritto da waveform_peaks.py (little-endian):
+// "MKPK" | u32 versione | u32 sr | u64 campioni | u32 hop0 | u32 livelli
+// f32 bpm | u32 n_beats | f32 picco | f32 beats[] | u32 n_bin[] | per livello i8 min[], i8 max[]
+class PeakSidecarLoader {
+
+  TrackAnalysis load(java.io.File file) throws Exception {
+    byte[] raw = java.nio.file.Files.readAllBytes(file.toPath());
+    java.nio.ByteBuffer bb = java.nio.ByteBuffer.wrap(raw).order(java.nio.ByteOrder.LITTLE_ENDIAN);
+
+    byte[] magic = new byte[4];
+    bb.get(magic);
+    int version = bb.getInt();
+    if (!new String(magic, "US-ASCII").equals("MKPK") || version != 1) {
+      throw new RuntimeException("Sidecar peaks non valido: " + file);
+    }
+    int sr = bb.getInt();
+    long nSamples = bb.getLong();
+    int hop = bb.getInt();
+    int nLevels = bb.getInt();
+    float bpm = bb.getFloat();
+    int nBeats = bb.getInt();
+    bb.getFloat(); // picco (i valori sono già normalizzati)
+
+    ArrayList<Float> beats = new ArrayList<Float>();
+    for (int i = 0; i < nBeats; i++) beats.add(bb.getFloat());
+
+    int[] sizes = new int[nLevels];
+    for (int i = 0; i < nLevels; i++) sizes[i] = bb.getInt();
+
+    float[][] mins = new float[nLevels][];
+    float[][] maxs = new float[nLevels][];
+    for (int lv = 0; lv < nLevels; lv++) {
+      mins[lv] = new float[sizes[lv]];
+      maxs[lv] = new float[sizes[lv]];
+      for (int i = 0; i < sizes[lv]; i++) mins[lv][i] = bb.get() / 127.0f;
+      for (int i = 0; i < sizes[lv]; i++) maxs[lv][i] = bb.get() / 127.0f;
+    }
+
+    TrackAnalysis a = new TrackAnalysis();
+    a.sampleRate = sr;
+    a.durationSec = nSamples / (float) sr;
+    a.bpm = bpm;
+    a.beats = beats;
+    a.wfMin = mins[0];
+    a.wfMax = maxs[0];
+    a.wfHopSec = hop / (float) sr;
+    a.wfMinLevels = mins;
+    a.wfMaxLevels = maxs;
+    return a;
+  }
+}
+
 class BPMAnalyzer {
 
   TrackAnalysis analyzeFile(java.io.File file, AnalysisProgress progress) throws Exception {
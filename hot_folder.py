@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+hot_folder.py
+
+Cartelle musicali sorvegliate (ambisonics_automation.py --watch): ogni
+traccia nuova o modificata viene separata e analizzata in background, così
+stems/<brano>/ (WAV, JSON, cache) è pronta prima che la traccia finisca su
+un deck.
+
+- FolderWatcher: scansione ricorsiva delle cartelle (salta stems/ e le
+  cartelle nascoste) con (size, mtime) per file. Su Linux inotify (via
+  ctypes, nessuna dipendenza) sveglia la scansione appena qualcosa cambia;
+  altrove, o senza inotify, scansione ogni POLL_S secondi. Un file entra in
+  coda solo quando è fermo da SETTLE_S secondi (download o copia in corso)
+  e is_pending(path) dice che va (ri)elaborato.
+- lower_priority(): nice massimo, e SCHED_IDLE su Linux, per il processo e
+  i suoi figli (worker di analisi, Demucs CLI).
+- ForegroundProbe: chiede /analysis/metrics al server OSC
+  (analize_onsets_simple.py); wait_idle() aspetta finché ha job in coda o
+  in corso, così le richieste dei deck hanno CPU e acceleratore. Server non
+  in ascolto = nessuna richiesta in primo piano.
+- HotFolderDaemon: un job alla volta, nell'ordine in cui i file si
+  assestano. process(path, checkpoint) è del chiamante; checkpoint() cede
+  il passo al server tra gli stadi.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import queue
+import select
+import socket
+import threading
+import time
+from pathlib import Path
+
+POLL_S = 5.0                  # intervallo di scansione senza inotify
+RESCAN_S = 300.0              # con inotify: scansione completa di sicurezza
+SETTLE_S = 10.0               # file fermo da tanto prima di entrare in coda
+YIELD_S = 2.0                 # attesa tra due controlli del server occupato
+WATCH_NICE = 19
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 57123           # analize_onsets_simple.py
+
+SKIP_DIRS = {"stems", "temp_demucs", "curves"}
+
+def lower_priority(nice: int = WATCH_NICE) -> list:
+    """
+    Priorità minima per il processo corrente (da chiamare prima di creare
+    thread e processi figli, che la ereditano). Ritorna le misure applicate.
+    """
+    applied = []
+    try:
+        current = os.nice(0)
+        if current < nice:
+            os.nice(nice - current)
+        applied.append(f"nice {os.nice(0)}")
+    except (AttributeError, OSError):
+        pass
+    if hasattr(os, "sched_setscheduler") and hasattr(os, "SCHED_IDLE"):
+        try:
+            os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+            applied.append("SCHED_IDLE")
+        except OSError:
+            pass
+    return applied
+
+# ---------------------------------------
+# INOTIFY (LINUX)
+# ---------------------------------------
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE)
+
+class _Inotify:
+    """Descrittore inotify: serve solo a svegliare la scansione, gli eventi non vengono letti."""
+
+    def __init__(self):
+        name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify non disponibile")
+        self._libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 fallita")
+        self.watched = set()
+
+    def watch(self, folder: str):
+        if folder in self.watched:
+            return
+        if self._libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK) >= 0:
+            self.watched.add(folder)
+        # limite max_user_watches: la cartella resta coperta dalla scansione periodica
+
+    def wait(self, timeout: float) -> bool:
+        """True se è arrivato almeno un evento entro timeout secondi."""
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+# ---------------------------------------
+# SCANSIONE
+# ---------------------------------------
+class FolderWatcher:
+    """
+    Sorveglia folders e mette in out_queue i file audio assestati per cui
+    is_pending(path) è vero. Un file fallito non viene ritentato finché non
+    cambia (size, mtime).
+    """
+
+    def __init__(self, folders, extensions, is_pending, out_queue: queue.Queue,
+                 poll_s: float | None = None, settle_s: float = SETTLE_S, log=print):
+        self.folders = [str(Path(f).expanduser().resolve()) for f in folders]
+        self.extensions = {e.lower() for e in extensions}
+        self.is_pending = is_pending
+        self.out = out_queue
+        self.settle_s = settle_s
+        self.log = log
+        self.seen = {}            # path -> (signature, istante dell'ultimo cambiamento)
+        self.queued = set()       # in coda o in elaborazione
+        self.failed = {}          # path -> signature al momento del fallimento
+        self.lock = threading.Lock()
+        self.inotify = None
+        if poll_s is None:
+            try:
+                self.inotify = _Inotify()
+            except (OSError, AttributeError, TypeError):
+                self.inotify = None
+        self.poll_s = poll_s or POLL_S
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if self.inotify is not None else f"polling {self.poll_s:.0f}s"
+
+    def _walk(self):
+        for root in self.folders:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [d for d in dirnames
+                               if d not in SKIP_DIRS and not d.startswith(".")]
+                if self.inotify is not None:
+                    self.inotify.watch(dirpath)
+                for name in filenames:
+                    if name.startswith(".") or Path(name).suffix.lower() not in self.extensions:
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, (st.st_size, st.st_mtime_ns)
+
+    def scan(self) -> bool:
+        """Una scansione; True se qualche file non è ancora assestato."""
+        now = time.monotonic()
+        current = dict(self._walk())
+        unsettled = False
+        for path, sig in current.items():
+            prev = self.seen.get(path)
+            if prev is None or prev[0] != sig:
+                self.seen[path] = (sig, now)
+                unsettled = True
+                continue
+            if now - prev[1] < self.settle_s:
+                unsettled = True
+                continue
+            with self.lock:
+                if path in self.queued or self.failed.get(path) == sig:
+                    continue
+            try:
+                pending = self.is_pending(path)
+            except Exception as e:
+                self.log(f"Stato non leggibile per {path}: {e}")
+                pending = False
+            if pending:
+                with self.lock:
+                    self.queued.add(path)
+                self.out.put(path)
+        for path in set(self.seen) - set(current):
+            del self.seen[path]
+        return unsettled
+
+    def done(self, path: str, ok: bool):
+        """Fine elaborazione di path (chiamata dal daemon)."""
+        with self.lock:
+            self.queued.discard(path)
+            if ok:
+                self.failed.pop(path, None)
+            else:
+                self.failed[path] = self.seen.get(path, (None,))[0]
+
+    def run(self, stop: threading.Event):
+        while not stop.is_set():
+            unsettled = self.scan()
+            if self.inotify is not None:
+                self.inotify.wait(self.settle_s if unsettled else RESCAN_S)
+            else:
+                stop.wait(self.poll_s)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+# ---------------------------------------
+# RICHIESTE IN PRIMO PIANO
+# ---------------------------------------
+class ForegroundProbe:
+    """Job del server OSC di analisi in coda o in corso (/analysis/metrics)."""
+
+    def __init__(self, host: str = SERVER_HOST, port: int = SERVER_PORT, timeout: float = 0.5,
+                 log=print):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.log = log
+
+    def busy(self) -> bool:
+        from pythonosc.osc_message import OscMessage
+        from pythonosc.osc_message_builder import OscMessageBuilder
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                sock.bind((self.host, 0))
+                sock.settimeout(self.timeout)
+                msg = OscMessageBuilder("/analysis/metrics")
+                msg.add_arg(sock.getsockname()[1])
+                sock.sendto(msg.build().dgram, (self.host, self.port))
+                params = OscMessage(sock.recv(65536)).params
+            except OSError:
+                return False      # server non in ascolto (o timeout)
+        try:
+            return int(params[0]) + int(params[1]) > 0
+        except (IndexError, TypeError, ValueError):
+            return False
+
+    def wait_idle(self):
+        """Aspetta che il server non abbia job in coda o in corso."""
+        waited = False
+        while self.busy():
+            if not waited:
+                self.log("Server di analisi occupato: in attesa")
+                waited = True
+            time.sleep(YIELD_S)
+        if waited:
+            self.log("Server di analisi libero: riprendo")
+
+# ---------------------------------------
+# DAEMON
+# ---------------------------------------
+class HotFolderDaemon:
+    """
+    Watcher + un job alla volta. process(path, checkpoint) separa e
+    analizza; checkpoint() va chiamata tra gli stadi (attende il server).
+    """
+
+    def __init__(self, folders, extensions, is_pending, process, poll_s: float | None = None,
+                 settle_s: float = SETTLE_S, probe: ForegroundProbe | None = None, log=print):
+        self.jobs = queue.Queue()
+        self.watcher = FolderWatcher(folders, extensions, is_pending, self.jobs,
+                                     poll_s=poll_s, settle_s=settle_s, log=log)
+        self.process = process
+        self.probe = probe or ForegroundProbe(log=log)
+        self.log = log
+        self.stop = threading.Event()
+
+    def serve_forever(self):
+        self.log(f"Cartelle sorvegliate ({self.watcher.mode}): " + ", ".join(self.watcher.folders))
+        threading.Thread(target=self.watcher.run, args=(self.stop,), name="hot-folder",
+                         daemon=True).start()
+        try:
+            while not self.stop.is_set():
+                try:
+                    path = self.jobs.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                self.probe.wait_idle()
+                self.log(f"Nuova traccia ({self.jobs.qsize()} in coda): {path}")
+                t0 = time.perf_counter()
+                try:
+                    self.process(path, self.probe.wait_idle)
+                    ok = True
+                    self.log(f"Pronta in {time.perf_counter() - t0:.1f}s: {path}")
+                except Exception as e:
+                    ok = False
+                    self.log(f"Elaborazione fallita {path}: {e}")
+                self.watcher.done(path, ok)
+        finally:
+            self.stop.set()
+            self.watcher.close()
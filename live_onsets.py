@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+live_onsets.py
+
+Analisi onset in tempo reale per ingressi live (microfono, deck esterno):
+la spazializzazione reagisce anche a ciò che non è un file.
+
+- OnlineOnsetDetector: spectral flux log-compresso su frame di LIVE_N_FFT
+  campioni ogni LIVE_HOP, normalizzato al picco corrente (con decadimento),
+  e peak picking causale come librosa.util.peak_pick ma con lookahead fisso
+  di LOOKAHEAD_FRAMES frame. L'onset è collocato nell'ultimo hop entrato
+  nella finestra; latenza algoritmica (lookahead + 1) * hop (~17 ms a
+  44.1 kHz con i valori di default).
+- Sorgenti: DeviceSource (scheda audio via sounddevice, opzionale) o
+  FileSource (file letto a blocchi al ritmo reale: stand-in del loopback
+  per prove senza hardware).
+- LiveOnsetStream: thread che elabora i blocchi e invia per ogni onset
+
+    /analysis/onset  name time strength centroid contrast latency_ms
+
+  time in secondi dall'avvio, strength 0..1, centroid in Hz, contrast 0..1
+  (centroide normalizzato sul range visto finora, come onset_contrast).
+- Latenza end-to-end misurata per ogni evento (cattura del campione
+  dell'onset -> invio OSC, compresa la latenza di ingresso della scheda) e
+  riportata a fine stream: media, p95, max e sforamenti di
+  LATENCY_BUDGET_MS.
+
+Uso da riga di comando (stampa gli eventi e li invia a SuperCollider):
+
+    python live_onsets.py default            # ingresso di default
+    python live_onsets.py 2 --name mic       # device per indice o nome
+    python live_onsets.py loop.wav           # file come sorgente live
+    python live_onsets.py --list-devices
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+SC_HOST = "127.0.0.1"
+SC_PORT = 57120
+
+LIVE_HOP = 256                # ~5.8 ms a 44.1 kHz
+LIVE_N_FFT = 1024
+BLOCK_SIZE = 256              # campioni per blocco dalla scheda
+LOOKAHEAD_FRAMES = 2          # post_max del peak picking
+PRE_MAX_FRAMES = 3
+PRE_AVG_FRAMES = 10
+WAIT_FRAMES = 4               # distanza minima tra onset (~23 ms)
+DELTA = 0.07                  # soglia sopra la media locale (envelope normalizzato)
+LOG_GAIN = 100.0              # compressione log1p(LOG_GAIN * |X|)
+FLUX_FLOOR = 0.05             # picco minimo per la normalizzazione
+NOISE_RATIO = 4.0             # picco >= NOISE_RATIO x flux medio: il rumore di fondo non diventa onset
+NOISE_TIME_S = 2.0            # costante di tempo della media del flux
+PEAK_HALF_LIFE_S = 10.0       # decadimento del picco di normalizzazione
+LATENCY_BUDGET_MS = 40.0
+
+def algorithmic_latency_s(sr: int, hop: int = LIVE_HOP, n_fft: int = LIVE_N_FFT,
+                          lookahead: int = LOOKAHEAD_FRAMES) -> float:
+    """Ritardo minimo tra l'onset (inizio dell'ultimo hop del frame) e la sua rilevazione."""
+    return (lookahead + 1) * hop / sr
+
+# ---------------------------------------
+# DETECTOR
+# ---------------------------------------
+class OnlineOnsetDetector:
+    """Onset detector a blocchi con lookahead limitato."""
+
+    def __init__(self, sr: int, hop: int = LIVE_HOP, n_fft: int = LIVE_N_FFT,
+                 lookahead: int = LOOKAHEAD_FRAMES, delta: float = DELTA,
+                 wait: int = WAIT_FRAMES):
+        self.sr = sr
+        self.hop = hop
+        self.n_fft = n_fft
+        self.lookahead = lookahead
+        self.delta = delta
+        self.wait = wait
+        self.window = np.hanning(n_fft + 1)[:-1].astype(np.float32)   # hann periodica
+        self.freqs = np.fft.rfftfreq(n_fft, 1.0 / sr).astype(np.float32)
+        self.decay = 0.5 ** (hop / (sr * PEAK_HALF_LIFE_S))
+        self.alpha = hop / (sr * NOISE_TIME_S)
+        self.reset()
+
+    def reset(self):
+        self.buf = np.zeros(self.n_fft, dtype=np.float32)
+        self.rest = np.zeros(0, dtype=np.float32)
+        self.prev = None
+        self.hist = deque(maxlen=max(PRE_MAX_FRAMES, PRE_AVG_FRAMES) + self.lookahead + 1)
+        self.frame = 0
+        self.peak = FLUX_FLOOR
+        self.noise = 0.0
+        self.last_onset = -self.wait - 1
+        self.cmin, self.cmax = np.inf, -np.inf
+
+    def process(self, x):
+        """
+        Elabora un blocco mono; ritorna gli onset confermati come lista di
+        (campione, strength, centroid_hz, contrast). campione: posizione
+        dell'onset dall'inizio dello stream.
+        """
+        x = np.asarray(x, dtype=np.float32)
+        if self.rest.size:
+            x = np.concatenate([self.rest, x])
+        hop = self.hop
+        n = x.size // hop
+        events = []
+        for i in range(n):
+            self.buf[:-hop] = self.buf[hop:]
+            self.buf[-hop:] = x[i * hop:(i + 1) * hop]
+            ev = self._frame()
+            if ev is not None:
+                events.append(ev)
+        self.rest = x[n * hop:].copy()
+        return events
+
+    def _frame(self):
+        mag = np.abs(np.fft.rfft(self.buf * self.window))
+        spec = np.log1p(LOG_GAIN * mag)
+        # Finché la finestra non è piena il flux misura solo l'ingresso del segnale
+        warm = self.frame >= self.n_fft // self.hop
+        flux = float(np.maximum(spec - self.prev, 0.0).mean()) if warm else 0.0
+        self.prev = spec
+        energy = float(mag.sum())
+        centroid = float(self.freqs @ mag) / energy if energy > 1e-9 else 0.0
+
+        if warm:
+            self.noise += self.alpha * (flux - self.noise) if self.noise else flux
+        self.peak = max(flux, self.peak * self.decay, NOISE_RATIO * self.noise, FLUX_FLOOR)
+        self.hist.append((self.frame, flux / self.peak, centroid))
+        self.frame += 1
+
+        # Candidato: il frame di lookahead posizioni fa (ha già il suo "futuro")
+        c = len(self.hist) - 1 - self.lookahead
+        if c < 0:
+            return None
+        frame, odf, centroid = self.hist[c]
+        if frame < self.n_fft // self.hop + PRE_AVG_FRAMES:
+            return None         # media locale e fondo non ancora stimati
+        vals = [h[1] for h in self.hist]
+        if odf <= 0.0 or odf < max(vals[max(0, c - PRE_MAX_FRAMES):]):
+            return None
+        if odf < np.mean(vals[max(0, c - PRE_AVG_FRAMES):c + 1]) + self.delta:
+            return None
+        if frame - self.last_onset <= self.wait:
+            return None
+        self.last_onset = frame
+
+        self.cmin, self.cmax = min(self.cmin, centroid), max(self.cmax, centroid)
+        span = self.cmax - self.cmin
+        contrast = (centroid - self.cmin) / span if span > 0 else 0.5
+        sample = frame * self.hop
+        return sample, min(odf, 1.0), centroid, contrast
+
+# ---------------------------------------
+# SORGENTI
+# ---------------------------------------
+class FileSource:
+    """
+    File audio letto a blocchi come se arrivasse da una scheda: ogni blocco
+    è consegnato quando il suo ultimo campione sarebbe stato catturato.
+    realtime=False: più veloce possibile (latenze misurate non significative).
+    """
+
+    input_latency = 0.0
+
+    def __init__(self, path: str, block: int = BLOCK_SIZE, realtime: bool = True):
+        import soundfile as sf
+        self.path = path
+        self.block = block
+        self.realtime = realtime
+        self.sr = sf.info(path).samplerate
+
+    def blocks(self, stop):
+        import soundfile as sf
+        t0 = time.perf_counter()
+        n = 0
+        for x in sf.blocks(self.path, blocksize=self.block, dtype="float32", always_2d=True):
+            if stop.is_set():
+                break
+            n += len(x)
+            due = t0 + n / self.sr
+            if self.realtime:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            yield x.mean(axis=1), (due if self.realtime else time.perf_counter())
+
+class DeviceSource:
+    """Ingresso da scheda audio (sounddevice): device per indice, nome o None (default)."""
+
+    def __init__(self, device=None, sr: int | None = None, block: int = BLOCK_SIZE,
+                 channels: int = 1):
+        try:
+            import sounddevice as sd
+        except ImportError as e:
+            raise RuntimeError("Ingresso live da scheda: serve il pacchetto sounddevice") from e
+        self.sd = sd
+        self.device = device
+        self.block = block
+        self.channels = channels
+        info = sd.query_devices(device, "input")
+        self.sr = int(sr or info["default_samplerate"])
+        self.input_latency = 0.0
+
+    def blocks(self, stop):
+        q = queue.Queue()
+
+        def callback(indata, frames, time_info, status):
+            # Solo copia e accodamento: l'analisi non gira nel thread audio
+            q.put((indata.mean(axis=1).copy(), time.perf_counter()))
+
+        with self.sd.InputStream(device=self.device, samplerate=self.sr, blocksize=self.block,
+                                 channels=self.channels, dtype="float32",
+                                 latency="low", callback=callback) as stream:
+            self.input_latency = float(stream.latency)
+            while not stop.is_set():
+                try:
+                    yield q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+def open_source(spec: str, block: int = BLOCK_SIZE, realtime: bool = True):
+    """File esistente -> FileSource; altrimenti device (indice, nome o "default")."""
+    if os.path.isfile(spec):
+        return FileSource(spec, block=block, realtime=realtime)
+    if spec in ("", "default"):
+        return DeviceSource(None, block=block)
+    return DeviceSource(int(spec) if spec.isdigit() else spec, block=block)
+
+# ---------------------------------------
+# STREAM
+# ---------------------------------------
+class LiveOnsetStream:
+    """
+    Sorgente -> OnlineOnsetDetector -> /analysis/onset, in un thread.
+    send(address, *args) invia a SuperCollider.
+    """
+
+    def __init__(self, source, name: str = "live", send=None,
+                 budget_ms: float = LATENCY_BUDGET_MS, log=print):
+        self.source = source
+        self.name = name
+        self.send = send
+        self.budget_ms = budget_ms
+        self.log = log
+        self.detector = OnlineOnsetDetector(source.sr)
+        self.latencies = []
+        self.n_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        algo = algorithmic_latency_s(self.source.sr) * 1000
+        if algo > self.budget_ms:
+            self.log(f"⚠️ Latenza algoritmica {algo:.1f} ms oltre il budget di {self.budget_ms:.0f} ms")
+        self._thread = threading.Thread(target=self.run, name=f"live-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 2.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.report()
+
+    def wait(self):
+        while self._thread is not None and self._thread.is_alive():
+            self._thread.join(0.2)
+
+    def run(self):
+        sr = self.source.sr
+        self.log(f"🎙 Live '{self.name}': {sr} Hz, hop {self.detector.hop}, "
+                 f"lookahead {self.detector.lookahead} frame")
+        for x, arrived in self.source.blocks(self._stop):
+            self.n_samples += x.size
+            end = self.n_samples
+            for sample, strength, centroid, contrast in self.detector.process(x):
+                # Istante di cattura del campione dell'onset (ultimo campione del blocco = arrived)
+                captured = arrived - self.source.input_latency - (end - sample) / sr
+                latency_ms = (time.perf_counter() - captured) * 1000
+                self.latencies.append(latency_ms)
+                if self.send is not None:
+                    self.send("/analysis/onset", self.name, sample / sr, float(strength),
+                              float(centroid), float(contrast), float(latency_ms))
+        self.log(self.format_report(self.report()))
+
+    def report(self) -> dict:
+        lat = np.asarray(self.latencies, dtype=np.float64)
+        rep = dict(name=self.name, n_onsets=int(lat.size),
+                   seconds=self.n_samples / self.source.sr,
+                   algorithmic_ms=algorithmic_latency_s(self.source.sr) * 1000,
+                   budget_ms=self.budget_ms)
+        if lat.size:
+            rep.update(mean_ms=float(lat.mean()), p95_ms=float(np.percentile(lat, 95)),
+                       max_ms=float(lat.max()), over_budget=int((lat > self.budget_ms).sum()))
+        return rep
+
+    @staticmethod
+    def format_report(rep: dict) -> str:
+        if not rep["n_onsets"]:
+            return f"⏱ Live '{rep['name']}': nessun onset in {rep['seconds']:.1f}s"
+        return (f"⏱ Live '{rep['name']}': {rep['n_onsets']} onset in {rep['seconds']:.1f}s | "
+                f"latenza media {rep['mean_ms']:.1f} ms, p95 {rep['p95_ms']:.1f} ms, "
+                f"max {rep['max_ms']:.1f} ms (algoritmica {rep['algorithmic_ms']:.1f} ms) | "
+                f"oltre budget {rep['budget_ms']:.0f} ms: {rep['over_budget']}")
+
+# ---------------------------------------
+# MAIN
+# ---------------------------------------
+def main():
+    ap = argparse.ArgumentParser(description="Onset live -> /analysis/onset verso SuperCollider")
+    ap.add_argument("source", nargs="?", default="default",
+                    help="Device (indice o nome, 'default') o file audio come stand-in")
+    ap.add_argument("--name", default="live", help="Nome della sorgente nei messaggi OSC")
+    ap.add_argument("--host", default=SC_HOST)
+    ap.add_argument("--port", type=int, default=SC_PORT)
+    ap.add_argument("--block", type=int, default=BLOCK_SIZE, help="Campioni per blocco")
+    ap.add_argument("--budget-ms", type=float, default=LATENCY_BUDGET_MS)
+    ap.add_argument("--fast", action="store_true", help="File: non rispettare il tempo reale")
+    ap.add_argument("--quiet", action="store_true", help="Non stampare ogni onset")
+    ap.add_argument("--list-devices", action="store_true")
+    args = ap.parse_args()
+
+    if args.list_devices:
+        import sounddevice as sd
+        print(sd.query_devices())
+        return
+
+    from pythonosc import udp_client
+    client = udp_client.SimpleUDPClient(args.host, args.port)
+
+    def send(address, *values):
+        client.send_message(address, list(values))
+        if not args.quiet:
+            print(f"  {values[1]:8.3f}s  strength {values[2]:.2f}  centroid {values[3]:7.0f} Hz  "
+                  f"latenza {values[5]:.1f} ms")
+
+    source = open_source(args.source, block=args.block, realtime=not args.fast)
+    stream = LiveOnsetStream(source, name=args.name, send=send, budget_ms=args.budget_ms).start()
+    try:
+        stream.wait()
+    except KeyboardInterrupt:
+        stream.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+osc_transport.py
+
+Invio dei risultati di analisi a SuperCollider in blocco, con consegna
+confermata.
+
+Le serie di una stem (times, pos, strength, spread, contrast) vengono
+impacchettate in un unico blob float32 big-endian (serie una dopo l'altra,
+n_onsets valori ciascuna), diviso in parti da BLOB_PART_BYTES:
+
+  /analysis/onset_blob      name seq part n_parts offset <blob>
+  /analysis/onset_blob_end  name seq n_parts n_onsets n_series reply_port
+
+SC risponde sulla porta reply_port del mittente con
+
+  /analysis/ack     name seq               tutte le parti ricevute
+  /analysis/resend  name seq part...       parti mancanti da rispedire
+
+Senza risposta entro ACK_TIMEOUT_S si rispedisce onset_blob_end (SC chiede
+allora le parti mancanti); dopo MAX_RETRIES tentativi il trasferimento
+ricade sul vecchio invio a chunk, così le patch SC senza gli OSCdef del blob
+continuano a funzionare. Nessuna sleep fissa: si aspetta solo l'ack.
+
+Modalità:
+- "blob":   un messaggio per parte
+- "bundle": le parti (e onset_blob_end) raggruppate in bundle OSC fino a
+            BUNDLE_MAX_BYTES, quindi pochi datagrammi per stem
+- "chunks": invio legacy, 128 valori per messaggio con pausa tra i chunk
+
+proto="tcp" usa una connessione TCP con framing SLIP (OSC 1.1,
+pythonosc.tcp_client) invece di UDP, per ricevitori in ascolto su TCP; ack
+e resend arrivano comunque via UDP sulla porta reply_port.
+"""
+
+import itertools
+import threading
+import time
+
+import numpy as np
+from pythonosc import osc_bundle_builder, osc_message_builder, udp_client
+
+from tracing import span
+
+SERIES = ("times", "pos", "strength", "spread", "contrast")
+LEGACY_ADDRESSES = {
+    "times": "/analysis/onset_times_chunk",
+    "pos": "/analysis/onset_pos_chunk",
+    "strength": "/analysis/onset_strength_chunk",
+    "spread": "/analysis/onset_spread_chunk",
+    "contrast": "/analysis/onset_contrast_chunk",
+}
+
+TRANSPORT_MODES = ("blob", "bundle", "chunks")
+BLOB_PART_BYTES = 4096        # payload per messaggio (datagramma < 8 KB, limite di socketserver)
+BUNDLE_MAX_BYTES = 32768      # bundle su UDP (sclang accetta datagrammi fino a 64 KB)
+CHUNK_SIZE = 128              # modalità legacy
+CHUNK_SLEEP_S = 0.0005
+ACK_TIMEOUT_S = 0.5
+MAX_RETRIES = 4
+
+def pack_series(series) -> bytes:
+    """Serie di uguale lunghezza -> blob float32 big-endian (serie per serie)."""
+    return np.asarray(series, dtype=">f4").tobytes()
+
+def unpack_series(blob: bytes, n_onsets: int, n_series: int = len(SERIES)):
+    """Inverso di pack_series: array (n_series, n_onsets) float32."""
+    return np.frombuffer(blob, dtype=">f4").reshape(n_series, n_onsets).astype(np.float32)
+
+def _message(address, args):
+    b = osc_message_builder.OscMessageBuilder(address=address)
+    for a in args:
+        if isinstance(a, (bytes, bytearray)):
+            b.add_arg(bytes(a), arg_type="b")
+        else:
+            b.add_arg(a)
+    return b.build()
+
+# ---------------------------------------
+# TRASFERIMENTO
+# ---------------------------------------
+class _Transfer:
+    """Stato di un invio in attesa di ack."""
+
+    def __init__(self, name, seq, parts):
+        self.name = name
+        self.seq = seq
+        self.parts = parts          # messaggi OSC già costruiti, uno per parte
+        self.event = threading.Event()
+        self.acked = False
+        self.missing = None         # parti richieste da /analysis/resend
+
+class OnsetTransport:
+    """
+    Invio delle serie di onset verso SC con numeri di sequenza e ack.
+    Gli handler on_ack/on_resend vanno registrati nel dispatcher del server
+    che ascolta su reply_port (bind).
+    """
+
+    def __init__(self, host: str, port: int, reply_port: int, mode: str = "blob",
+                 proto: str = "udp", part_bytes: int = BLOB_PART_BYTES,
+                 ack_timeout: float = ACK_TIMEOUT_S, retries: int = MAX_RETRIES, log=print):
+        if mode not in TRANSPORT_MODES:
+            raise ValueError(f"Modalità di trasporto sconosciuta: {mode}")
+        if proto not in ("udp", "tcp"):
+            raise ValueError(f"Protocollo sconosciuto: {proto}")
+        self.host = host
+        self.port = port
+        self.reply_port = reply_port
+        self.mode = mode
+        self.proto = proto
+        self.part_bytes = part_bytes - part_bytes % 4
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.log = log
+        self._seq = itertools.count(1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._client = None
+
+    # --- socket ---
+    def _get_client(self):
+        if self._client is None:
+            if self.proto == "tcp":
+                from pythonosc import tcp_client
+                self._client = tcp_client.TCPClient(self.host, self.port, mode="1.1")
+            else:
+                self._client = udp_client.UDPClient(self.host, self.port)
+        return self._client
+
+    def _send(self, packets):
+        with self._send_lock:
+            client = self._get_client()
+            for p in packets:
+                client.send(p)
+
+    def _bundles(self, messages):
+        """Raggruppa i messaggi in bundle OSC di al più BUNDLE_MAX_BYTES."""
+        out, builder, size = [], None, 16
+        for m in messages:
+            if builder is not None and size + 4 + m.size > BUNDLE_MAX_BYTES:
+                out.append(builder.build())
+                builder = None
+            if builder is None:
+                builder = osc_bundle_builder.OscBundleBuilder(osc_bundle_builder.IMMEDIATELY)
+                size = 16
+            builder.add_content(m)
+            size += 4 + m.size
+        if builder is not None:
+            out.append(builder.build())
+        return out
+
+    # --- handler OSC (thread del server) ---
+    def bind(self, dispatcher):
+        dispatcher.map("/analysis/ack", self.on_ack)
+        dispatcher.map("/analysis/resend", self.on_resend)
+
+    def _lookup(self, args):
+        if len(args) < 2:
+            return None
+        with self._lock:
+            return self._pending.get((str(args[0]), int(args[1])))
+
+    def on_ack(self, address, *args):
+        t = self._lookup(args)
+        if t is not None:
+            t.acked = True
+            t.event.set()
+
+    def on_resend(self, address, *args):
+        t = self._lookup(args)
+        if t is not None:
+            t.missing = [int(i) for i in args[2:]]
+            t.event.set()
+
+    # --- invio ---
+    def send(self, name: str, series) -> bool:
+        """
+        Invia le serie (sequenza di array di uguale lunghezza, nell'ordine di
+        SERIES) per la stem name. Ritorna True se SC ha confermato con ack.
+        """
+        if self.mode == "chunks":
+            self.send_chunks(name, series)
+            return True
+
+        data = pack_series(series)
+        n_series, n_onsets = len(series), (len(series[0]) if len(series) else 0)
+        seq = next(self._seq)
+        step = self.part_bytes
+        n_parts = max(1, (len(data) + step - 1) // step)
+        parts = [_message("/analysis/onset_blob",
+                          [name, seq, i, n_parts, i * step // 4, data[i * step:(i + 1) * step]])
+                 for i in range(n_parts)]
+        end = _message("/analysis/onset_blob_end",
+                       [name, seq, n_parts, n_onsets, n_series, self.reply_port])
+
+        t = _Transfer(name, seq, parts)
+        with self._lock:
+            self._pending[(name, seq)] = t
+        try:
+            # Dall'invio della prima parte all'ack (compresi i tentativi)
+            with span("osc_blob", cat="osc", file=name, parts=n_parts):
+                todo = parts
+                for attempt in range(self.retries + 1):
+                    t.event.clear()
+                    t.missing = None
+                    messages = todo + [end]
+                    self._send(self._bundles(messages) if self.mode == "bundle" else messages)
+                    if t.event.wait(self.ack_timeout) and t.acked:
+                        return True
+                    # SC ha chiesto parti precise, altrimenti basta rispedire la chiusura
+                    todo = [parts[i] for i in (t.missing or []) if 0 <= i < n_parts]
+                    if t.missing:
+                        self.log(f"↻ {name}: rispedite {len(todo)}/{n_parts} parti (seq {seq})")
+        finally:
+            with self._lock:
+                self._pending.pop((name, seq), None)
+
+        self.log(f"⚠️ {name}: nessun ack da SC (seq {seq}), invio a chunk")
+        self.send_chunks(name, series)
+        return False
+
+    def send_chunks(self, name: str, series):
+        """Invio legacy: CHUNK_SIZE valori per messaggio, una serie alla volta."""
+        client = udp_client.SimpleUDPClient(self.host, self.port) if self.proto == "tcp" \
+            else None
+        with span("osc_chunks", cat="osc", file=name):
+            for key, arr in zip(SERIES, series):
+                arr = [float(v) for v in arr]
+                for i in range(0, len(arr), CHUNK_SIZE):
+                    chunk = arr[i:i + CHUNK_SIZE]
+                    msg = _message(LEGACY_ADDRESSES[key], [name, i // CHUNK_SIZE, len(chunk), *chunk])
+                    if client is not None:
+                        client.send(msg)
+                    else:
+                        self._send([msg])
+                    time.sleep(CHUNK_SLEEP_S)
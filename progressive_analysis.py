@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+progressive_analysis.py
+
+Analisi progressiva per il server OSC (analize_onsets_simple.py): una stem
+appena caricata su un deck riceve subito gli onset attorno al cue, senza
+aspettare l'analisi dell'intero file.
+
+- analyze_region(path, t0, t1): beat, onset, features e beat mapping di una
+  sola porzione del file, decodificata con REGION_PAD_S secondi di margine
+  per lato (backtrack degli onset e finestre di release ai bordi). Tempi in
+  secondi della sorgente; posizioni nella griglia contate dall'inizio del
+  file (analysis_pipeline.beat_mapping con offset). Normalizzazione, soglia
+  top_db e griglia sono quelle della regione: valori vicini all'analisi
+  completa ma non identici. Le regioni non vanno in cache: l'analisi
+  completa le sostituisce.
+- first_region(cue): la prima regione, REGION_SECONDS a partire da
+  REGION_LEAD_S prima del cue.
+- PartialAnalysis: regioni già analizzate di un file, unite in un'unica
+  tabella a colonne (ONSET_COLUMNS) ordinata per tempo. missing(t0, t1)
+  dice cosa resta da analizzare di un intervallo (/analyze_region dopo un
+  seek in una zona non ancora analizzata); next_region(duration) è la
+  prossima regione del riempimento in background (dopo la prima regione
+  fino alla fine, poi dall'inizio).
+"""
+
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from analysis_engine import ONSET_COLUMNS, StemContext, analysis_frames, onset_columns
+from analysis_pipeline import (analysis_rate, beat_mapping, envelope_features, load_audio)
+from streaming_analysis import audio_info
+from tracing import span
+
+REGION_SECONDS = 60.0         # prima regione (e default di /analyze_region)
+REGION_LEAD_S = 5.0           # la prima regione parte poco prima del cue
+REGION_PAD_S = 3.0            # audio decodificato in più per lato
+REGION_MIN_S = 20.0           # regione minima (beat tracking su pochi secondi inaffidabile)
+
+def first_region(cue: float = 0.0, seconds: float = REGION_SECONDS):
+    """(t0, t1) della prima regione da analizzare attorno al cue."""
+    t0 = max(0.0, float(cue) - REGION_LEAD_S)
+    return t0, t0 + seconds
+
+def analyze_region(path: str, t0: float, t1: float, pad: float = REGION_PAD_S):
+    """
+    Analizza [t0, t1) secondi di path. Ritorna (bpm, colonne) con i soli
+    onset della regione; (0.0, colonne vuote) se la regione è vuota o il
+    file non si decodifica.
+    """
+    name = Path(path).name
+    info = audio_info(path)
+    a = max(0.0, t0 - pad)
+    b = t1 + pad if info is None else min(t1 + pad, info[1] / info[0])
+    if b <= a:
+        return 0.0, onset_columns([])
+    rate = analysis_rate(path, False)
+    with span("analyze_region", file=name, t0=round(t0, 3), t1=round(t1, 3)):
+        y, sr = load_audio(path, rate, offset=a, duration=b - a)
+        if y is None or not y.size:
+            return 0.0, onset_columns([])
+        ctx = StemContext.from_audio(y, sr, **analysis_frames(rate))
+        try:
+            bpm, beat_frames = ctx.beat_track()
+        except Exception:
+            bpm, beat_frames = 0.0, []
+        onset_samples = np.asarray(ctx.onset_samples(), dtype=np.int64)
+        cols = beat_mapping(np.asarray(beat_frames, dtype=np.int32), onset_samples, sr,
+                            envelope_features(ctx, onset_samples), hop_length=ctx.hop_length,
+                            offset=a)
+    keep = (cols['onset_time'] >= t0) & (cols['onset_time'] < t1)
+    return float(bpm), {k: np.asarray(cols[k][keep], dtype=dtype)
+                        for k, dtype in ONSET_COLUMNS.items()}
+
+# ---------------------------------------
+# REGIONI DI UN FILE
+# ---------------------------------------
+class PartialAnalysis:
+    """
+    Regioni analizzate di un file. lock serializza unione e invio a SC;
+    final=True quando l'analisi completa è pronta (le regioni in corso
+    vengono scartate, così non sovrascrivono i dati completi in SC).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.bpm = 0.0
+        self.spans = []               # intervalli analizzati, ordinati e disgiunti
+        self.columns = onset_columns([])
+        self.final = False
+        self.filling = False          # riempimento in background avviato
+        self.lock = threading.Lock()
+
+    def missing(self, t0: float, t1: float, min_s: float = REGION_MIN_S) -> list:
+        """
+        Parti di [t0, t1) non ancora analizzate, ognuna estesa ad almeno
+        min_s secondi.
+        """
+        out, cur = [], t0
+        for a, b in self.spans:
+            if b <= cur:
+                continue
+            if a >= t1:
+                break
+            if a > cur:
+                out.append((cur, a))
+            cur = max(cur, b)
+        if cur < t1:
+            out.append((cur, t1))
+        return [(a, max(b, a + min_s)) for a, b in out]
+
+    def next_region(self, duration: float, seconds: float = REGION_SECONDS):
+        """(t0, t1) della prossima regione da riempire, o None se il file è coperto."""
+        start = self.spans[0][0] if self.spans else 0.0
+        gaps = self.missing(start, duration) or self.missing(0.0, duration)
+        if not gaps:
+            return None
+        a, b = gaps[0]
+        return a, min(b, a + seconds)
+
+    def add(self, t0: float, t1: float, bpm: float, columns: dict):
+        """Unisce la regione [t0, t1): i suoi onset sostituiscono quelli già presenti."""
+        t = self.columns['onset_time']
+        keep = (t < t0) | (t >= t1)
+        merged = {k: np.concatenate([self.columns[k][keep], np.asarray(columns[k], dtype=dtype)])
+                  for k, dtype in ONSET_COLUMNS.items()}
+        order = np.argsort(merged['onset_time'], kind='stable')
+        self.columns = {k: v[order] for k, v in merged.items()}
+        if not self.bpm:
+            self.bpm = bpm          # griglia della prima regione (attorno al cue)
+
+        spans = sorted(self.spans + [(t0, t1)])
+        self.spans = [spans[0]]
+        for a, b in spans[1:]:
+            if a <= self.spans[-1][1]:
+                self.spans[-1] = (self.spans[-1][0], max(self.spans[-1][1], b))
+            else:
+                self.spans.append((a, b))
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+separation_service.py
+
+Separazione Demucs in-process con modello residente.
+
+- DemucsSeparator: carica htdemucs una volta (demucs.pretrained.get_model)
+  e separa con demucs.apply.apply_model, con gli stessi segment/overlap/
+  shifts della CLI demucs (DEMUCS_OPTIONS). Ogni canzone paga solo
+  decodifica + inferenza, non avvio di Python/torch e caricamento modello.
+- SeparatedTrack: stems in memoria, quantizzate a 16 bit come i WAV della
+  CLI. La scrittura dei WAV avviene in background, un thread per stem.
+  mono() restituisce per l'analisi lo stesso segnale che librosa.load
+  leggerebbe dal WAV, quindi risultati e chiavi di cache non cambiano.
+- SeparationService: servizio OSC a lunga vita. Riceve /separate <path>
+  [force], mette i job in una coda singola (una inferenza alla volta) e
+  risponde con /separation/done <path> <stems_dir> <secondi> oppure
+  /separation/error <path> <messaggio>.
+
+Richiede torch e demucs importabili nell'interprete corrente (altrimenti
+ambisonics_automation usa la CLI demucs in subprocess).
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from tracing import span
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 57124          # analize_onsets_simple.py usa 57123, SuperCollider 57120
+REPLY_PORT = 57120
+
+MODEL_NAME = "htdemucs"
+
+# Parametri Demucs per device (condivisi con la CLI in separate_4stems)
+DEMUCS_OPTIONS = {
+    "mps": dict(segment=7, overlap=0.05, shifts=1, jobs=1),
+    "cuda": dict(segment=7, overlap=0.1, shifts=1),
+    "cpu": dict(segment=6, overlap=0.15, shifts=1),
+}
+
+def inprocess_available() -> bool:
+    """True se torch e demucs sono importabili (separazione senza subprocess)."""
+    try:
+        import torch  # noqa: F401
+        import demucs.apply  # noqa: F401
+        import demucs.pretrained  # noqa: F401
+    except Exception:
+        return False
+    return True
+
+# ---------------------------------------
+# STEMS IN MEMORIA
+# ---------------------------------------
+class SeparatedTrack:
+    """
+    Risultato di una separazione: stems int16 (campioni, canali) a sr del
+    modello e scritture WAV in corso (una Future per stem).
+    """
+
+    def __init__(self, source: str, out_dir: Path, sr: int, stems: dict, writes: dict,
+                 timings: dict):
+        self.source = source
+        self.out_dir = out_dir
+        self.sr = sr
+        self.stems = stems
+        self.writes = writes
+        self.timings = timings
+
+    @property
+    def names(self):
+        return list(self.stems)
+
+    def path(self, name: str) -> Path:
+        return self.out_dir / f"{name}.wav"
+
+    def mono(self, name: str):
+        """Mono float32 identico a librosa.load(<stem>.wav, sr=None, mono=True)."""
+        x = self.stems[name].astype(np.float32) / np.float32(32768.0)
+        return np.ascontiguousarray(np.mean(x.T, axis=0))
+
+    def wait_written(self, name: str) -> Path:
+        """Attende la scrittura del WAV della stem e ne ritorna il path."""
+        self.writes[name].result()
+        return self.path(name)
+
+    def wait_all(self) -> dict:
+        return {name: str(self.wait_written(name)) for name in self.stems}
+
+def _to_int16(wav):
+    """Come demucs save_audio(clip="rescale", bits_per_sample=16); wav (canali, campioni)."""
+    peak = float(np.abs(wav).max()) if wav.size else 0.0
+    wav = wav / max(1.01 * peak, 1.0)
+    return np.clip(np.round(wav.T * 32768.0), -32768, 32767).astype(np.int16)
+
+def _write_wav(path: Path, data, sr: int):
+    import soundfile as sf
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with span("write_stem", cat="separation", file=path.name):
+        sf.write(str(tmp), data, sr, subtype="PCM_16", format="WAV")
+        os.replace(tmp, path)   # chi osserva la cartella non vede mai WAV parziali
+    return path
+
+# ---------------------------------------
+# MODELLO RESIDENTE
+# ---------------------------------------
+class DemucsSeparator:
+    """Modello Demucs caricato una volta e riusato per tutti i job."""
+
+    def __init__(self, device: str, model_name: str = MODEL_NAME, write_workers: int = 4):
+        self.device = device
+        self.model_name = model_name
+        self.options = DEMUCS_OPTIONS.get(device, DEMUCS_OPTIONS["cpu"])
+        self._model = None
+        self._lock = threading.Lock()       # una inferenza alla volta sul device
+        self._writer = ThreadPoolExecutor(max_workers=write_workers,
+                                          thread_name_prefix="stem-writer")
+
+    @property
+    def model(self):
+        if self._model is None:
+            from demucs.pretrained import get_model
+            t0 = time.perf_counter()
+            model = get_model(self.model_name)
+            model.to(self.device)
+            model.eval()
+            self._model = model
+            self.load_s = time.perf_counter() - t0
+        return self._model
+
+    def warm_up(self):
+        """Carica il modello subito (invece che al primo job)."""
+        return self.model
+
+    def separate(self, input_file: str, out_dir: Path) -> SeparatedTrack:
+        """
+        Separa input_file in memoria e avvia la scrittura dei WAV in out_dir.
+        Ritorna subito dopo l'inferenza: le scritture proseguono in background.
+        """
+        import torch
+        import librosa
+        from demucs.apply import apply_model
+
+        model = self.model
+        name = Path(input_file).name
+        t0 = time.perf_counter()
+        with span("separate_decode", cat="separation", file=name):
+            wav, sr = librosa.load(input_file, sr=model.samplerate, mono=False)
+            wav = np.atleast_2d(wav)
+            if wav.shape[0] == 1 and model.audio_channels == 2:
+                wav = np.repeat(wav, 2, axis=0)
+        t_load = time.perf_counter() - t0
+
+        # Normalizzazione come demucs.separate
+        mix = torch.from_numpy(np.ascontiguousarray(wav[:model.audio_channels]))
+        ref = mix.mean(0)
+        mean, std = ref.mean(), ref.std()
+        mix = (mix - mean) / (std + 1e-8)
+        opts = self.options
+        t1 = time.perf_counter()
+        with self._lock, span("demucs", cat="separation", file=name, device=self.device), \
+                torch.inference_mode():
+            sources = apply_model(model, mix[None], device=self.device,
+                                  shifts=opts["shifts"], split=True,
+                                  overlap=opts["overlap"], segment=opts["segment"],
+                                  num_workers=opts.get("jobs", 0), progress=False)[0]
+        sources = (sources * (std + 1e-8) + mean).cpu().numpy()
+        t_infer = time.perf_counter() - t1
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stems, writes = {}, {}
+        for name, src in zip(model.sources, sources):
+            stems[name] = _to_int16(src)
+            writes[name] = self._writer.submit(_write_wav, out_dir / f"{name}.wav",
+                                               stems[name], sr)
+        return SeparatedTrack(input_file, out_dir, sr, stems, writes,
+                              dict(load_s=t_load, infer_s=t_infer))
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+
+# ---------------------------------------
+# SERVIZIO OSC
+# ---------------------------------------
+class SeparationService:
+    """
+    Servizio di separazione a lunga vita su OSC/UDP locale.
+    on_job(input_file, force) -> stems_dir esegue separazione (+ analisi) e
+    gira nel thread dei job; i messaggi OSC vengono solo accodati.
+    """
+
+    def __init__(self, on_job, host: str = SERVICE_HOST, port: int = SERVICE_PORT,
+                 reply_port: int = REPLY_PORT, log=print):
+        self.on_job = on_job
+        self.host = host
+        self.port = port
+        self.reply_port = reply_port
+        self.log = log
+        self.jobs = queue.Queue()
+        self._clients = {}
+
+    def _client(self, host: str):
+        from pythonosc import udp_client
+        c = self._clients.get(host)
+        if c is None:
+            c = self._clients[host] = udp_client.SimpleUDPClient(host, self.reply_port)
+        return c
+
+    def _on_separate(self, client_address, address, *args):
+        if not args:
+            return
+        force = bool(args[1]) if len(args) > 1 else False
+        self.jobs.put((client_address[0], str(args[0]), force))
+        self.log(f"Job in coda ({self.jobs.qsize()}): {args[0]}")
+
+    def _worker(self):
+        while True:
+            host, path, force = self.jobs.get()
+            t0 = time.perf_counter()
+            try:
+                stems_dir = self.on_job(path, force)
+                dt = time.perf_counter() - t0
+                self._client(host).send_message("/separation/done", [path, str(stems_dir), dt])
+                self.log(f"Job completato in {dt:.1f}s: {path}")
+            except Exception as e:
+                self._client(host).send_message("/separation/error", [path, str(e)])
+                self.log(f"Job fallito: {path}: {e}")
+
+    def serve_forever(self):
+        from pythonosc.dispatcher import Dispatcher
+        from pythonosc import osc_server
+
+        dispatcher = Dispatcher()
+        dispatcher.map("/separate", self._on_separate, needs_reply_address=True)
+        threading.Thread(target=self._worker, name="separation-jobs", daemon=True).start()
+        server = osc_server.ThreadingOSCUDPServer((self.host, self.port), dispatcher)
+        self.log(f"Servizio separazione in ascolto su {self.host}:{self.port}")
+        server.serve_forever()
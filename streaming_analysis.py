@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+streaming_analysis.py
+
+Analisi a memoria limitata per file lunghi (mix e registrazioni di ore).
+L'audio viene letto a blocchi (soundfile) e non è mai in memoria per intero:
+
+  passo 1  picco del segnale e massimo del mel-spettrogramma (soglia top_db
+           di power_to_db, che dipende dal massimo globale)
+  passo 2  segnale normalizzato: mel dB -> onset envelope (media) e beat
+           envelope (mediana); filtro passa-banda + envelope (massimo
+           globale) e curva del centroide dalla STFT del filtrato
+  -------  beat tracking e onset detection sulle curve per frame
+  passo 3  envelope per campione e features degli onset, emessi a gruppi
+           (callback on_onsets) appena la loro finestra è completa
+
+Lo stato dei filtri passa da un blocco all'altro (sosfilt zi) e le STFT sono
+calcolate frame per frame con lo stesso padding di center=True: i risultati
+coincidono con StemContext a meno di arrotondamenti. La memoria dipende dalla
+dimensione del blocco più le curve per frame (pochi byte per frame, ~10 MB
+per 2 ore a 48 kHz), non dalla lunghezza dell'audio.
+"""
+
+import numpy as np
+import librosa
+import soundfile as sf
+
+from analysis_engine import (HOP_LENGTH, N_FFT, MAX_WIN_S, band_filter, lowpass_filter,
+                             beat_track_env, detect_onsets, segment_envelope_features)
+
+STREAM_BLOCK = 1 << 18        # campioni letti per blocco (~5 s a 48 kHz)
+STREAM_MIN_S = 20 * 60.0      # sopra questa durata l'analisi passa in streaming
+TOP_DB = 80.0                 # come librosa.power_to_db
+AMIN = 1e-10
+
+def audio_info(path: str):
+    """(sr, n_campioni) senza decodificare, o None se soundfile non legge il file."""
+    try:
+        info = sf.info(path)
+    except Exception:
+        return None
+    return info.samplerate, info.frames
+
+def should_stream(path: str, force: bool = False) -> bool:
+    """
+    True se il file va analizzato in streaming: forzato o più lungo di
+    STREAM_MIN_S. Solo formati letti da soundfile (gli altri restano
+    sul percorso in memoria di librosa.load).
+    """
+    info = audio_info(path)
+    if info is None or info[1] == 0:
+        return False
+    return force or info[1] / info[0] > STREAM_MIN_S
+
+def read_blocks(path: str, block: int = STREAM_BLOCK):
+    """Blocchi mono float32 (media dei canali, come librosa.to_mono)."""
+    with sf.SoundFile(path) as f:
+        for b in f.blocks(blocksize=block, dtype="float32", always_2d=True):
+            yield b[:, 0].copy() if b.shape[1] == 1 else b.mean(axis=1)
+
+# ---------------------------------------
+# STFT INCREMENTALE
+# ---------------------------------------
+class FrameSTFT:
+    """
+    Magnitudo STFT frame per frame da blocchi consecutivi, equivalente a
+    librosa.stft(center=True, pad_mode="constant") sull'intero segnale:
+    n_fft//2 zeri in testa, frame emessi appena la finestra è completa,
+    zeri in coda in finish(). Tiene solo gli ultimi n_fft campioni.
+    """
+
+    def __init__(self, n_fft=N_FFT, hop_length=HOP_LENGTH, dtype=np.float32):
+        self.n_fft = n_fft
+        self.hop = hop_length
+        self.buf = np.zeros(n_fft // 2, dtype=dtype)
+        self.n_in = 0
+        self.n_frames = 0
+
+    def _emit(self, k):
+        if k <= 0:
+            return np.zeros((self.n_fft // 2 + 1, 0), dtype=np.float32)
+        used = (k - 1) * self.hop + self.n_fft
+        D = librosa.stft(self.buf[:used], n_fft=self.n_fft, hop_length=self.hop, center=False)
+        self.buf = self.buf[k * self.hop:]
+        self.n_frames += k
+        return np.abs(D)
+
+    def push(self, x):
+        self.buf = np.concatenate([self.buf, x])
+        self.n_in += x.size
+        n = self.buf.size
+        return self._emit(1 + (n - self.n_fft) // self.hop if n >= self.n_fft else 0)
+
+    def finish(self):
+        total = 1 + self.n_in // self.hop
+        k = total - self.n_frames
+        need = (k - 1) * self.hop + self.n_fft if k > 0 else 0
+        pad = max(self.n_fft // 2, need - self.buf.size)
+        self.buf = np.concatenate([self.buf, np.zeros(pad, dtype=self.buf.dtype)])
+        return self._emit(k)
+
+def _mel_power(mag, mel_basis):
+    # Come librosa.feature.melspectrogram (power=2)
+    return np.einsum("ft,mf->mt", mag ** 2.0, mel_basis, optimize=True)
+
+# ---------------------------------------
+# PASSI
+# ---------------------------------------
+def _pass_levels(path, sr, n_fft, hop, block):
+    """Passo 1: (n_campioni, picco, massimo del mel-spettrogramma grezzo)."""
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft)
+    stft = FrameSTFT(n_fft, hop, np.float32)
+    n, peak, mel_max = 0, 0.0, 0.0
+    for x in read_blocks(path, block):
+        n += x.size
+        if x.size:
+            peak = max(peak, float(np.abs(x).max()))
+        mag = stft.push(x)
+        if mag.shape[1]:
+            mel_max = max(mel_max, float(_mel_power(mag, mel_basis).max()))
+    mag = stft.finish()
+    if mag.shape[1]:
+        mel_max = max(mel_max, float(_mel_power(mag, mel_basis).max()))
+    return n, peak, mel_max
+
+def _normalized_blocks(path, block, peak):
+    scale = np.float32(peak) if peak > 0 else None   # come librosa.util.normalize
+    for x in read_blocks(path, block):
+        yield x / scale if scale is not None else x
+
+def _pass_frames(path, sr, n, peak, mel_max, n_fft, hop, block):
+    """
+    Passo 2: curve per frame. Ritorna dict(onset_env, beat_env, centroid,
+    centroid_valid, env_max).
+    """
+    from scipy.signal import sosfilt
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft)
+    freqs = librosa.fft_frequencies(sr=sr, n_fft=n_fft)
+    band, lp = band_filter(sr), lowpass_filter(sr)
+    zi_band = np.zeros((band.shape[0], 2))
+    zi_lp = np.zeros((lp.shape[0], 2))
+
+    # Soglia top_db: massimo del mel del segnale normalizzato (mel scala con il picco^2)
+    norm_max = mel_max / (peak * peak) if peak > 0 else mel_max
+    floor = np.float32(10.0 * np.log10(max(AMIN, norm_max)) - TOP_DB)
+
+    mel_stft = FrameSTFT(n_fft, hop, np.float32)
+    filt_stft = FrameSTFT(n_fft, hop, np.float64)
+    on_parts, beat_parts, cent_parts, valid_parts = [], [], [], []
+    prev_db = None
+    env_max = 0.0
+
+    def consume(mag, fmag):
+        nonlocal prev_db
+        if mag.shape[1]:
+            db = 10.0 * np.log10(np.maximum(AMIN, _mel_power(mag, mel_basis)))
+            np.maximum(db, floor, out=db)
+            full = db if prev_db is None else np.concatenate([prev_db, db], axis=1)
+            d = np.maximum(0.0, full[:, 1:] - full[:, :-1])
+            on_parts.append(np.mean(d, axis=0))
+            beat_parts.append(np.median(d, axis=0))
+            prev_db = db[:, -1:]
+        if fmag.shape[1]:
+            mag_sum = fmag.sum(axis=0)
+            valid = mag_sum > 0
+            weighted = freqs @ fmag
+            cent_parts.append(np.divide(weighted, mag_sum, out=np.zeros_like(weighted),
+                                        where=valid))
+            valid_parts.append(valid)
+
+    for y in _normalized_blocks(path, block, peak):
+        yf, zi_band = sosfilt(band, y, zi=zi_band)
+        env, zi_lp = sosfilt(lp, np.abs(yf), zi=zi_lp)
+        if env.size:
+            env_max = max(env_max, float(env.max()))
+        consume(mel_stft.push(y), filt_stft.push(yf))
+    consume(mel_stft.finish(), filt_stft.finish())
+
+    # Come onset_strength(center=True): lag + n_fft//(2*hop) zeri in testa
+    n_frames = 1 + n // hop
+    pad = np.zeros(1 + n_fft // (2 * hop), dtype=np.float32)
+    return dict(
+        onset_env=np.concatenate([pad] + on_parts)[:n_frames],
+        beat_env=np.concatenate([pad] + beat_parts)[:n_frames],
+        centroid=np.concatenate(cent_parts) if cent_parts else np.zeros(0),
+        centroid_valid=np.concatenate(valid_parts) if valid_parts else np.zeros(0, bool),
+        env_max=env_max,
+    )
+
+def _pass_features(path, sr, n, peak, onsets, curves, hop, block, on_onsets=None):
+    """
+    Passo 3: envelope per campione e features, calcolate per gruppi di onset
+    appena il blocco letto copre la loro finestra. In memoria resta solo
+    l'envelope dal primo onset non ancora emesso in poi.
+    """
+    from scipy.signal import sosfilt
+    k = onsets.size
+    feats = dict(attack_time=np.zeros(k), release_time=np.zeros(k),
+                 velocity_value=np.zeros(k), spectral_mean_freq=np.zeros(k))
+    if k == 0:
+        return feats
+
+    band, lp = band_filter(sr), lowpass_filter(sr)
+    zi_band = np.zeros((band.shape[0], 2))
+    zi_lp = np.zeros((lp.shape[0], 2))
+    env_max = curves["env_max"]
+    max_win = int(MAX_WIN_S * sr)
+    ends = np.minimum(np.minimum(onsets + max_win, np.append(onsets[1:], n)), n)
+
+    buf = np.zeros(0)
+    buf_start = 0           # posizione assoluta di buf[0]
+    i = 0                   # primo onset non ancora emesso
+
+    def emit(j):
+        nonlocal i
+        base = int(onsets[i])
+        local = buf[base - buf_start:int(ends[j - 1]) - buf_start]
+        f = segment_envelope_features(local, onsets[i:j] - base, sr, curves["centroid"],
+                                      centroid_valid=curves["centroid_valid"],
+                                      hop_length=hop, offset=base)
+        for name, col in f.items():
+            feats[name][i:j] = col
+        if on_onsets is not None:
+            on_onsets(onsets[i:j], f)
+        i = j
+
+    for y in _normalized_blocks(path, block, peak):
+        yf, zi_band = sosfilt(band, y, zi=zi_band)
+        env, zi_lp = sosfilt(lp, np.abs(yf), zi=zi_lp)
+        if env_max > 0:
+            env /= env_max
+        buf = np.concatenate([buf, env])
+        pos = buf_start + buf.size
+        j = int(np.searchsorted(ends, pos, side="right"))
+        if j > i:
+            emit(j)
+        keep_from = min(int(onsets[i]), pos) if i < k else pos
+        buf = buf[keep_from - buf_start:]
+        buf_start = keep_from
+    if i < k:
+        emit(k)
+    return feats
+
+# ---------------------------------------
+# ANALISI COMPLETA
+# ---------------------------------------
+def analyze_stream(path: str, hop_length=HOP_LENGTH, n_fft=N_FFT, block=STREAM_BLOCK,
+                   on_onsets=None) -> dict:
+    """
+    Analisi in streaming di un file (tre letture a blocchi).
+    on_onsets(onset_samples, features): chiamata per ogni gruppo di onset
+    completato durante il passo 3 (features: dict di array, vedi
+    segment_envelope_features).
+    Ritorna dict(sr, n_samples, bpm, beat_frames, onset_samples, features).
+    """
+    info = audio_info(path)
+    if info is None:
+        raise ValueError(f"Formato non leggibile a blocchi: {path}")
+    sr = info[0]
+    n, peak, mel_max = _pass_levels(path, sr, n_fft, hop_length, block)
+    curves = _pass_frames(path, sr, n, peak, mel_max, n_fft, hop_length, block)
+    bpm, beat_frames = beat_track_env(curves["beat_env"], sr, hop_length)
+    onsets = np.asarray(detect_onsets(curves["onset_env"], sr, hop_length), dtype=np.int64)
+    feats = _pass_features(path, sr, n, peak, onsets, curves, hop_length, block, on_onsets)
+    return dict(sr=sr, n_samples=n, bpm=bpm, beat_frames=beat_frames,
+                onset_samples=onsets, features=feats)
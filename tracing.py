@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+tracing.py
+
+Span di tempo per stadio, condivisi da CLI (ambisonics_automation.py) e
+server OSC (analize_onsets_simple.py):
+
+    with span("decode", file="drums.wav"):
+        ...
+
+Ogni span chiuso:
+- aggiorna le statistiche dello stadio (conteggio, tempo totale e p50 /
+  p95 / max sulle ultime STATS_WINDOW durate), lette da stage_stats():
+  /analysis/metrics del server e riepilogo della CLI;
+- a registrazione attiva (start_recording) diventa un evento "complete"
+  del formato Chrome trace, scritto da export_chrome_trace (si apre in
+  chrome://tracing o ui.perfetto.dev). Gli span annidati nello stesso
+  thread appaiono come stack.
+
+I processi worker della CLI rimandano i loro eventi al padre (drain /
+merge): nel trace compaiono come processi separati. Senza registrazione
+il costo di uno span è un append su un deque.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+STATS_WINDOW = 512            # durate recenti per p50/p95 di ogni stadio
+
+_lock = threading.Lock()
+_recent = {}                  # stadio -> deque di durate (s)
+_totals = {}                  # stadio -> [conteggio, secondi totali]
+_events = None                # eventi Chrome trace (None: registrazione spenta)
+_threads = {}                 # (pid, tid) -> nome del thread
+
+# ---------------------------------------
+# SPAN
+# ---------------------------------------
+@contextmanager
+def span(name: str, cat: str = "analysis", **args):
+    """Misura il blocco come stadio `name`; args finiscono nell'evento del trace."""
+    t0 = time.perf_counter_ns()
+    try:
+        yield
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        _add(name, cat, t0, time.perf_counter_ns() - t0, args)
+
+def record(name: str, start_ns: int, cat: str = "analysis", **args):
+    """Chiude uno stadio iniziato a start_ns (time.perf_counter_ns), es. attese in coda."""
+    _add(name, cat, start_ns, time.perf_counter_ns() - start_ns, args)
+
+def _add(name, cat, t0_ns, dur_ns, args):
+    with _lock:
+        _stat(name, dur_ns / 1e9)
+        if _events is not None:
+            pid, tid = os.getpid(), threading.get_ident()
+            _threads.setdefault((pid, tid), threading.current_thread().name)
+            _events.append(dict(name=name, cat=cat, ph="X", ts=t0_ns / 1000, dur=dur_ns / 1000,
+                                pid=pid, tid=tid, args=args))
+
+def _stat(name, seconds):
+    _recent.setdefault(name, deque(maxlen=STATS_WINDOW)).append(seconds)
+    tot = _totals.setdefault(name, [0, 0.0])
+    tot[0] += 1
+    tot[1] += seconds
+
+# ---------------------------------------
+# STATISTICHE
+# ---------------------------------------
+def stage_stats() -> dict:
+    """{stadio: dict(count, total_s, p50_ms, p95_ms, max_ms)} (percentili sulle ultime durate)."""
+    with _lock:
+        recent = {k: np.fromiter(v, dtype=np.float64) for k, v in _recent.items()}
+        totals = {k: tuple(v) for k, v in _totals.items()}
+    out = {}
+    for name, d in recent.items():
+        p50, p95 = np.percentile(d, [50, 95]) * 1000 if d.size else (0.0, 0.0)
+        out[name] = dict(count=totals[name][0], total_s=totals[name][1], p50_ms=float(p50),
+                         p95_ms=float(p95), max_ms=float(d.max() * 1000) if d.size else 0.0)
+    return out
+
+def format_stats(stats: dict | None = None) -> list:
+    """Righe di riepilogo per stadio, in ordine di tempo totale."""
+    stats = stage_stats() if stats is None else stats
+    rows = sorted(stats.items(), key=lambda kv: -kv[1]["total_s"])
+    return [f"{name:20s} {s['count']:5d}x  totale {s['total_s']:8.2f}s  "
+            f"p50 {s['p50_ms']:9.1f} ms  p95 {s['p95_ms']:9.1f} ms" for name, s in rows]
+
+def reset():
+    with _lock:
+        _recent.clear()
+        _totals.clear()
+        if _events is not None:
+            _events.clear()
+        _threads.clear()
+
+# ---------------------------------------
+# TRACE
+# ---------------------------------------
+def start_recording():
+    """Conserva gli span come eventi per export_chrome_trace."""
+    global _events
+    with _lock:
+        if _events is None:
+            _events = []
+
+def recording() -> bool:
+    return _events is not None
+
+def drain():
+    """Eventi registrati finora (e li toglie): dal worker al processo padre."""
+    if _events is None:
+        return None
+    with _lock:
+        out = dict(events=list(_events), threads=[[p, t, n] for (p, t), n in _threads.items()])
+        _events.clear()
+    return out
+
+def merge(data):
+    """Aggiunge eventi di drain() di un altro processo (anche alle statistiche)."""
+    if not data:
+        return
+    with _lock:
+        for ev in data["events"]:
+            _stat(ev["name"], ev["dur"] / 1e6)
+        if _events is not None:
+            _events.extend(data["events"])
+            for pid, tid, name in data["threads"]:
+                _threads.setdefault((pid, tid), name)
+
+def export_chrome_trace(path) -> Path:
+    """Scrive gli eventi registrati nel formato Chrome trace (JSON)."""
+    with _lock:
+        events = list(_events or [])
+        threads = dict(_threads)
+    meta = [dict(name="thread_name", ph="M", pid=pid, tid=tid, args=dict(name=name))
+            for (pid, tid), name in threads.items()]
+    meta += [dict(name="process_name", ph="M", pid=pid, args=dict(name=f"milkydj {pid}"))
+             for pid in sorted({pid for pid, _ in threads})]
+    path = Path(path)
+    path.write_text(json.dumps(dict(traceEvents=meta + events, displayTimeUnit="ms")))
+    return path
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+waveform_peaks.py
+
+Piramide di picchi della waveform (min/max) salvata accanto a
+*_analysis.json, così la GUI disegna la waveform a qualunque zoom senza
+decodificare l'audio.
+
+- Livello 0: min/max ogni round(sr * 10 ms) campioni (stessi bin di
+  BPMAnalyzer in dj_gui.pde), sul mono normalizzato al picco.
+- Livello k: bin di hop0 * 2^k campioni (min dei min, max dei max), fino a
+  meno di PYRAMID_MIN_BINS bin.
+- Valori quantizzati a int8 (x127): ~2 byte per bin, ~1.5 MB per un'ora
+  al livello 0, tutta la piramide meno del doppio.
+- Nell'header anche bpm e tempi dei beat (dallo stadio beats della cache,
+  o dalla griglia del brano con --beat-grid), se disponibili: alla GUI
+  basta il sidecar per waveform e griglia. Se la griglia cambia (nuova
+  analisi, --analysis-sr, --beat-grid) viene riscritto solo l'header.
+
+Formato <nome>_peaks.mkp (little-endian):
+
+  "MKPK" | u32 versione | u32 sr | u64 n_campioni | u32 hop0 | u32 n_livelli
+  f32 bpm | u32 n_beats | f32 picco | f32 beats[n_beats] (secondi)
+  u32 n_bin[n_livelli] | per livello: i8 min[n_bin], i8 max[n_bin]
+
+L'audio si legge a blocchi (soundfile), oppure si usa il segnale già in
+memoria (y, sr) quando l'analisi lo ha decodificato.
+"""
+
+import os
+import struct
+from pathlib import Path
+
+import numpy as np
+
+from streaming_analysis import audio_info, read_blocks
+from analysis_pipeline import load_audio
+
+PEAKS_SUFFIX = "_peaks.mkp"
+PEAKS_MAGIC = b"MKPK"
+PEAKS_VERSION = 1
+BASE_HOP_S = 0.010            # 10 ms, come wfHopSec della GUI
+PYRAMID_MIN_BINS = 256        # livello più grossolano: meno di così non serve
+QUANT = 127.0
+
+_HEADER = struct.Struct("<4sIIQIIfIf")
+
+def peaks_path(target_dir: Path, name: str) -> Path:
+    return Path(target_dir) / f"{name}{PEAKS_SUFFIX}"
+
+def base_hop(sr: int) -> int:
+    return max(1, int(round(sr * BASE_HOP_S)))
+
+# ---------------------------------------
+# CALCOLO
+# ---------------------------------------
+class PeakAccumulator:
+    """Min/max per bin di hop campioni da blocchi consecutivi."""
+
+    def __init__(self, hop: int):
+        self.hop = hop
+        self.rest = np.zeros(0, dtype=np.float32)
+        self.mins, self.maxs = [], []
+        self.n = 0
+
+    def push(self, x):
+        self.n += x.size
+        x = np.concatenate([self.rest, x]) if self.rest.size else x
+        k = x.size // self.hop * self.hop
+        if k:
+            r = x[:k].reshape(-1, self.hop)
+            self.mins.append(r.min(axis=1))
+            self.maxs.append(r.max(axis=1))
+        self.rest = x[k:].copy()
+
+    def finish(self):
+        if self.rest.size:
+            self.mins.append(self.rest.min(keepdims=True))
+            self.maxs.append(self.rest.max(keepdims=True))
+            self.rest = np.zeros(0, dtype=np.float32)
+        if not self.mins:
+            return np.zeros(0, np.float32), np.zeros(0, np.float32)
+        return np.concatenate(self.mins), np.concatenate(self.maxs)
+
+def build_pyramid(mins, maxs, min_bins: int = PYRAMID_MIN_BINS) -> list:
+    """[(min, max)] dal livello 0 in giù, dimezzando il numero di bin."""
+    levels = [(mins, maxs)]
+    while mins.size > min_bins:
+        if mins.size % 2:
+            mins = np.append(mins, mins[-1])
+            maxs = np.append(maxs, maxs[-1])
+        mins = mins.reshape(-1, 2).min(axis=1)
+        maxs = maxs.reshape(-1, 2).max(axis=1)
+        levels.append((mins, maxs))
+    return levels
+
+def _quantize(x, scale):
+    return np.clip(np.round(x * scale), -QUANT, QUANT).astype(np.int8)
+
+# ---------------------------------------
+# FILE
+# ---------------------------------------
+def write_peaks(fp: Path, sr: int, n_samples: int, hop: int, levels: list,
+                bpm: float = 0.0, beats=None):
+    """Scrive il sidecar (tmp + rename: chi legge non vede mai file parziali)."""
+    mn0, mx0 = levels[0]
+    peak = float(max(-mn0.min(), mx0.max())) if mn0.size else 0.0
+    scale = QUANT / peak if peak > 0 else 0.0
+    beats = np.asarray(beats if beats is not None else [], dtype="<f4")
+    parts = [_HEADER.pack(PEAKS_MAGIC, PEAKS_VERSION, int(sr), int(n_samples), int(hop),
+                          len(levels), float(bpm), beats.size, peak),
+             beats.tobytes(),
+             np.asarray([mn.size for mn, _ in levels], dtype="<u4").tobytes()]
+    for mn, mx in levels:
+        parts.append(_quantize(mn, scale).tobytes())
+        parts.append(_quantize(mx, scale).tobytes())
+    fp = Path(fp)
+    tmp = fp.with_name(f".{fp.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(b"".join(parts))
+    os.replace(tmp, fp)
+    return fp
+
+def read_peaks(fp: Path) -> dict:
+    """Legge il sidecar: dict(sr, n_samples, hop, bpm, peak, beats, levels=[(min, max)])."""
+    raw = Path(fp).read_bytes()
+    magic, version, sr, n, hop, n_levels, bpm, n_beats, peak = _HEADER.unpack_from(raw)
+    if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+        raise ValueError(f"Sidecar peaks non valido: {fp}")
+    off = _HEADER.size
+    beats = np.frombuffer(raw, dtype="<f4", count=n_beats, offset=off)
+    off += 4 * n_beats
+    sizes = np.frombuffer(raw, dtype="<u4", count=n_levels, offset=off)
+    off += 4 * n_levels
+    levels = []
+    for size in sizes.tolist():
+        mn = np.frombuffer(raw, dtype=np.int8, count=size, offset=off)
+        mx = np.frombuffer(raw, dtype=np.int8, count=size, offset=off + size)
+        levels.append((mn.astype(np.float32) / QUANT, mx.astype(np.float32) / QUANT))
+        off += 2 * size
+    return dict(sr=sr, n_samples=n, hop=hop, bpm=bpm, peak=peak, beats=beats, levels=levels)
+
+def read_grid(fp: Path):
+    """(bpm, beats) dall'header del sidecar senza leggere i livelli, o None."""
+    try:
+        with open(fp, "rb") as f:
+            head = f.read(_HEADER.size)
+            magic, version, _, _, _, _, bpm, n_beats, _ = _HEADER.unpack(head)
+            if magic != PEAKS_MAGIC or version != PEAKS_VERSION:
+                return None
+            beats = np.frombuffer(f.read(4 * n_beats), dtype="<f4")
+    except (OSError, struct.error):
+        return None
+    return bpm, beats
+
+def grid_matches(fp: Path, bpm: float = 0.0, beats=None) -> bool:
+    """True se l'header del sidecar ha già bpm e beats (confronto a float32)."""
+    grid = read_grid(fp)
+    if grid is None:
+        return False
+    beats = np.asarray(beats if beats is not None else [], dtype="<f4")
+    return np.float32(grid[0]) == np.float32(bpm) and np.array_equal(grid[1], beats)
+
+def rewrite_grid(fp: Path, bpm: float = 0.0, beats=None) -> Path:
+    """Sostituisce bpm e beats nell'header; i livelli restano quelli già calcolati."""
+    raw = Path(fp).read_bytes()
+    magic, version, sr, n, hop, n_levels, _, n_beats, peak = _HEADER.unpack_from(raw)
+    beats = np.asarray(beats if beats is not None else [], dtype="<f4")
+    rest = raw[_HEADER.size + 4 * n_beats:]
+    fp = Path(fp)
+    tmp = fp.with_name(f".{fp.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(_HEADER.pack(magic, version, sr, n, hop, n_levels, float(bpm), beats.size, peak)
+                    + beats.tobytes() + rest)
+    os.replace(tmp, fp)
+    return fp
+
+def is_fresh(audio_path: str, fp: Path) -> bool:
+    """True se il sidecar esiste ed è più recente dell'audio."""
+    try:
+        return os.stat(fp).st_mtime_ns >= os.stat(audio_path).st_mtime_ns
+    except OSError:
+        return False
+
+def save_peaks(audio_path: str, target_dir: Path, name: str | None = None, y=None, sr=None,
+               bpm: float = 0.0, beats=None, force: bool = False) -> Path:
+    """
+    Calcola e salva la piramide di audio_path in target_dir/<name>_peaks.mkp
+    (name: nome del file senza estensione). Salta il calcolo se il sidecar
+    è già aggiornato, a meno di force; se è cambiata solo la griglia (bpm,
+    beats) riscrive l'header. y/sr: mono già decodificato.
+    """
+    fp = peaks_path(target_dir, name or Path(audio_path).stem)
+    if not force and is_fresh(audio_path, fp):
+        return fp if grid_matches(fp, bpm, beats) else rewrite_grid(fp, bpm, beats)
+    if y is None:
+        info = audio_info(audio_path)
+        if info is not None:
+            sr = info[0]
+            acc = PeakAccumulator(base_hop(sr))
+            for x in read_blocks(audio_path):
+                acc.push(x)
+        else:
+            y, sr = load_audio(audio_path)
+            if y is None:
+                raise ValueError(f"Audio non leggibile: {audio_path}")
+    if y is not None:
+        acc = PeakAccumulator(base_hop(sr))
+        acc.push(np.asarray(y, dtype=np.float32))
+    mins, maxs = acc.finish()
+    return write_peaks(fp, sr, acc.n, acc.hop, build_pyramid(mins, maxs), bpm, beats)